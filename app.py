@@ -1,96 +1,234 @@
-"""
-Основно приложение на ObzorWeather система
-Този файл инициализира FastAPI приложението и зарежда всички модули.
-"""
-
-import os
-import uvicorn
-from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
-
-# Импортиране на модули
-from modules.rtsp_capture import router as rtsp_router
-from modules.rtsp_capture.config import get_capture_config
-# Добавяме нов модул за анализ на изображения
-from modules.image_analysis import router as analysis_router
-from modules.image_analysis.config import get_analysis_config
-from utils.logger import setup_logger
-
-# Инициализиране на логване
-logger = setup_logger("app")
-
-# Създаваме FastAPI приложение
-app = FastAPI(
-    title="ObzorWeather System",
-    description="Модулна система за метеорологичен мониторинг",
-    version="1.0.0"
-)
-
-# Създаваме директории, ако не съществуват
-os.makedirs("static", exist_ok=True)
-os.makedirs("templates", exist_ok=True)
-
-# Конфигуриране на статични файлове и шаблони
-app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
-
-# Регистриране на маршрутизаторите от модулите
-app.include_router(rtsp_router, prefix="/rtsp", tags=["RTSP Capture"])
-# Регистрираме новия модул
-app.include_router(analysis_router, prefix="/analysis", tags=["Image Analysis"])
-
-# Ако има допълнителни модули, ще ги регистрираме тук
-# app.include_router(weather_data_router, prefix="/weather", tags=["Weather Data"])
-
-@app.get("/", response_class=HTMLResponse)
-async def index(request: Request):
-    """Главна страница с информация за системата"""
-    
-    # Вземаме информация от модулите
-    rtsp_config = get_capture_config()
-    # Добавяме информация от новия модул
-    analysis_config = get_analysis_config()
-    
-    return templates.TemplateResponse("index.html", {
-        "request": request,
-        "title": "ObzorWeather System",
-        "rtsp_config": rtsp_config,
-        "analysis_config": analysis_config
-    })
-
-@app.get("/health")
-async def health():
-    """Проверка на здравословното състояние на системата"""
-    # Добавяме информация за статуса на новия модул
-    analysis_config = get_analysis_config()
-    
-    return {
-        "status": "healthy",
-        "version": "1.0.0",
-        "modules": {
-            "rtsp_capture": "active",
-            "image_analysis": analysis_config.status
-        }
-    }
-
-# Маршрут за пренасочване от /rtsp към последното изображение
-@app.get("/latest.jpg")
-async def latest_image_redirect():
-    return RedirectResponse(url="/rtsp/latest.jpg")
-
-if __name__ == "__main__":
-    # Настройки от environment променливи
-    host = os.getenv("HOST", "0.0.0.0")
-    port = int(os.getenv("PORT", "7860"))
-    
-    logger.info(f"Стартиране на ObzorWeather System на {host}:{port}")
-    logger.info("Инициализирани модули: RTSP Capture, Image Analysis")
-    
-    # Проверка за наличие на Anthropic API ключ
-    if not os.getenv("ANTHROPIC_API_KEY"):
-        logger.warning("ANTHROPIC_API_KEY не е наличен! Image Analysis модулът няма да работи правилно.")
-    
-    # Стартиране на сървъра
+"""
+Основно приложение на ObzorWeather система
+Този файл инициализира FastAPI приложението и зарежда всички модули.
+"""
+
+import os
+import time
+import asyncio
+from contextlib import asynccontextmanager
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, PlainTextResponse
+from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
+
+# Импортиране на модули
+from modules.rtsp_capture import router as rtsp_router
+from modules.rtsp_capture.api import latest_jpg
+from modules.rtsp_capture.config import get_capture_config
+from modules.rtsp_capture import capture as rtsp_capture
+# Добавяме нов модул за анализ на изображения
+from modules.image_analysis import router as analysis_router
+from modules.image_analysis.config import get_analysis_config
+from modules.image_analysis import analyzer as image_analyzer
+from utils.logger import setup_logger
+from utils.events import get_event_bus
+from utils.shared_frames import rings_snapshot
+from utils.state import get_leader_election, get_state_refresher
+from utils.metrics import Counter, Histogram, get_metrics_registry, metrics_enabled
+
+# Инициализиране на логване
+logger = setup_logger("app")
+
+# Метрики на HTTP заявките по шаблон на маршрута (например /rtsp/{camera_id}/latest.jpg)
+HTTP_REQUESTS_TOTAL = Counter("http_requests_total", "HTTP заявки по маршрут и статус", ["route", "method", "status"])
+HTTP_REQUEST_SECONDS = Histogram("http_request_seconds", "Време до отговор на HTTP заявките", ["route", "method"])
+
+# Модули, които се инициализират при стартиране: име -> (initialize, shutdown)
+STARTUP_MODULES = {
+    "rtsp_capture": (rtsp_capture.initialize, rtsp_capture.stop_capture_thread),
+    "image_analysis": (image_analyzer.initialize, image_analyzer.stop_analysis_thread)
+}
+
+# Фонова работа, която се изпълнява само в процеса лидер: име -> (start, stop)
+LEADER_TASKS = {
+    "rtsp_capture": (rtsp_capture.start_capture_thread, rtsp_capture.stop_capture_thread),
+    "image_analysis": (image_analyzer.start_analysis_thread, image_analyzer.stop_analysis_thread)
+}
+
+def _leadership_changed(ready_modules: set, leader: bool):
+    """Стартира фоновата работа при спечелено лидерство и я спира при загубено"""
+    for name, (start, stop) in LEADER_TASKS.items():
+        if name in ready_modules:
+            (start if leader else stop)()
+
+async def _timed_startup(name: str, initialize) -> dict:
+    """Изпълнява инициализацията на модул в отделен thread и измерва времето"""
+    start_time = time.perf_counter()
+    try:
+        result = await asyncio.to_thread(initialize)
+        status = "ok" if result is not False else "error"
+        error = None
+    except Exception as e:
+        status = "error"
+        error = str(e)
+    
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    logger.info(f"Модул {name} инициализиран за {elapsed_ms:.1f} ms ({status})")
+    return {"module": name, "status": status, "time_ms": round(elapsed_ms, 1), "error": error}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Стартира модулите паралелно при стартиране и ги спира при изключване"""
+    start_time = time.perf_counter()
+    results = await asyncio.gather(*[
+        _timed_startup(name, initialize) for name, (initialize, _) in STARTUP_MODULES.items()
+    ])
+    
+    app.state.startup_report = {
+        "total_ms": round((time.perf_counter() - start_time) * 1000, 1),
+        "modules": {result["module"]: result for result in results}
+    }
+    logger.info(f"Стартиране завършено за {app.state.startup_report['total_ms']} ms")
+    
+    # Само един процес (лидерът) извлича кадри и анализира; останалите обслужват заявките
+    ready_modules = {result["module"] for result in results if result["status"] == "ok"}
+    election = get_leader_election()
+    election.on_change(lambda leader: _leadership_changed(ready_modules, leader))
+    await asyncio.to_thread(election.start)
+    # Последователите взимат състоянието на лидера във фонова нишка
+    refresher = get_state_refresher()
+    refresher.start()
+    
+    yield
+    
+    await asyncio.to_thread(refresher.stop)
+    await asyncio.to_thread(election.stop)
+    
+    for name, (_, shutdown) in STARTUP_MODULES.items():
+        try:
+            await asyncio.to_thread(shutdown)
+        except Exception as e:
+            logger.error(f"Грешка при спиране на модул {name}: {str(e)}")
+
+class MetricsMiddleware:
+    """
+    ASGI middleware, което отчита заявките и времето до изпращане на заглавките
+
+    Маршрутът се взима от шаблона на съвпадналия route, за да не се създава
+    отделна серия за всеки път. Времето на поточните отговори (MJPEG) се мери
+    до началото на отговора, а не до края на потока.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not metrics_enabled():
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                route = scope.get("route")
+                HTTP_REQUEST_SECONDS.observe(
+                    time.perf_counter() - started,
+                    route=getattr(route, "path", "other"), method=scope["method"]
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            HTTP_REQUESTS_TOTAL.inc(route=getattr(route, "path", "other"), method=scope["method"], status=status[0])
+
+# Създаваме FastAPI приложение
+app = FastAPI(
+    title="ObzorWeather System",
+    description="Модулна система за метеорологичен мониторинг",
+    version="1.0.0",
+    lifespan=lifespan
+)
+
+app.add_middleware(MetricsMiddleware)
+
+# Създаваме директории, ако не съществуват
+os.makedirs("static", exist_ok=True)
+os.makedirs("templates", exist_ok=True)
+
+# Конфигуриране на статични файлове и шаблони
+app.mount("/static", StaticFiles(directory="static"), name="static")
+templates = Jinja2Templates(directory="templates")
+
+# Регистриране на маршрутизаторите от модулите
+app.include_router(rtsp_router, prefix="/rtsp", tags=["RTSP Capture"])
+# Регистрираме новия модул
+app.include_router(analysis_router, prefix="/analysis", tags=["Image Analysis"])
+
+# Ако има допълнителни модули, ще ги регистрираме тук
+# app.include_router(weather_data_router, prefix="/weather", tags=["Weather Data"])
+
+@app.get("/", response_class=HTMLResponse)
+async def index(request: Request):
+    """Главна страница с информация за системата"""
+    
+    # Вземаме информация от модулите
+    rtsp_config = get_capture_config()
+    # Добавяме информация от новия модул
+    analysis_config = get_analysis_config()
+    
+    return templates.TemplateResponse("index.html", {
+        "request": request,
+        "title": "ObzorWeather System",
+        "rtsp_config": rtsp_config,
+        "analysis_config": analysis_config
+    })
+
+@app.get("/health")
+async def health():
+    """Проверка на здравословното състояние на системата"""
+    # Добавяме информация за статуса на новия модул
+    analysis_config = get_analysis_config()
+    
+    return {
+        "status": "healthy",
+        "version": "1.0.0",
+        "modules": {
+            "rtsp_capture": "active",
+            "image_analysis": analysis_config.status
+        },
+        "leader": get_leader_election().get_status(),
+        "startup": getattr(app.state, "startup_report", None)
+    }
+
+@app.get("/pipeline")
+async def pipeline():
+    """Състояние на етапите, които получават новите кадри (опашки и изхвърлени кадри)"""
+    return {
+        **get_event_bus().snapshot(),
+        "shared_frames": rings_snapshot()
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Метрики във формата на Prometheus"""
+    return PlainTextResponse(
+        get_metrics_registry().render(),
+        media_type="text/plain; version=0.0.4"
+    )
+
+# Сервираме последното изображение директно от кеша, без пренасочване към /rtsp
+@app.get("/latest.jpg")
+async def latest_image(request: Request):
+    return await latest_jpg(request)
+
+if __name__ == "__main__":
+    # Настройки от environment променливи
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", "7860"))
+    
+    logger.info(f"Стартиране на ObzorWeather System на {host}:{port}")
+    logger.info("Инициализирани модули: RTSP Capture, Image Analysis")
+    
+    # Проверка за наличие на Anthropic API ключ
+    if not os.getenv("ANTHROPIC_API_KEY"):
+        logger.warning("ANTHROPIC_API_KEY не е наличен! Image Analysis модулът няма да работи правилно.")
+    
+    # Стартиране на сървъра
     uvicorn.run(app, host=host, port=port)
\ No newline at end of file
@@ -0,0 +1,13 @@
+"""
+Бенчмаркове на ObzorWeather System
+
+Работят изцяло локално (без RTSP камера и без Anthropic API) и записват
+резултатите като JSON, за да се сравняват между версиите:
+- capture  - capture_frame() с локален видео файл вместо RTSP поток
+- encode   - преоразмеряване и JPEG кодиране на синтетични кадри
+- http     - натоварване на /rtsp/latest.jpg и /analysis/latest
+- analysis - analyze_image_with_anthropic() срещу локален mock на API-то
+
+Стартиране от корена на проекта:
+    python -m benchmarks.run [--suites capture,encode] [--output results.json]
+"""
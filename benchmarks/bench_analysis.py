@@ -0,0 +1,119 @@
+"""
+analyze_image_with_anthropic() срещу локалния mock на API-то
+
+Mock сървърът (benchmarks.mock_api) работи в отделен процес със зададена
+латентност. overhead е времето над латентността на mock-а - подготовката
+на изображението, base64, HTTP клиентът и разборът на отговора.
+"""
+
+import os
+import time
+import asyncio
+from typing import Any, Dict
+
+from .common import free_port, start_server, stop_server, summarize, synthetic_frame
+
+async def _measure(images, iterations: int, concurrency: int) -> Dict[str, Any]:
+    from modules.image_analysis.analyzer import analyze_image_with_anthropic
+    from modules.image_analysis.batch import analyze_images_with_anthropic
+    from modules.image_analysis.http_client import get_http_client
+
+    async def single() -> float:
+        started = time.perf_counter()
+        success, result = await analyze_image_with_anthropic(images[0])
+        if not success:
+            raise RuntimeError(result.get("error"))
+        return time.perf_counter() - started
+
+    # Първата заявка отваря връзката - не влиза в измерванията
+    await single()
+
+    sequential = [await single() for _ in range(iterations)]
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited() -> float:
+        async with semaphore:
+            return await single()
+
+    started = time.perf_counter()
+    concurrent = await asyncio.gather(*(limited() for _ in range(iterations)))
+    concurrent_elapsed = time.perf_counter() - started
+
+    batch = []
+    for _ in range(max(iterations // len(images), 1)):
+        started = time.perf_counter()
+        outcomes = await analyze_images_with_anthropic(images)
+        if not all(success for success, _ in outcomes):
+            raise RuntimeError("Неуспешен групов анализ")
+        batch.append(time.perf_counter() - started)
+
+    # Клиентът е обвързан с loop-а на asyncio.run() и се затваря с него
+    await get_http_client().aclose()
+
+    return {
+        "sequential": sequential,
+        "concurrent": list(concurrent),
+        "concurrent_elapsed": concurrent_elapsed,
+        "batch": batch
+    }
+
+def run(
+    iterations: int = 20,
+    latency: float = 0.2,
+    jitter: float = 0.0,
+    concurrency: int = 4,
+    batch_size: int = 4,
+    image_size=(1920, 1080)
+) -> Dict[str, Any]:
+    """Измерва един, паралелни и групови анализи срещу mock с латентност latency"""
+    import cv2
+
+    port = free_port()
+    server = start_server(
+        ["benchmarks.mock_api", "--port", str(port), "--latency", str(latency), "--jitter", str(jitter)],
+        port
+    )
+
+    from modules.image_analysis.config import get_analysis_config, update_analysis_config
+
+    config = get_analysis_config()
+    previous_url = config.anthropic_api_url
+    previous_key = os.environ.get("ANTHROPIC_API_KEY")
+
+    images = [
+        cv2.imencode(".jpg", synthetic_frame(*image_size, seed=seed), [cv2.IMWRITE_JPEG_QUALITY, 85])[1].tobytes()
+        for seed in range(batch_size)
+    ]
+
+    try:
+        os.environ["ANTHROPIC_API_KEY"] = "benchmark"
+        update_analysis_config(anthropic_api_url=f"http://127.0.0.1:{port}/v1/messages")
+        samples = asyncio.run(_measure(images, iterations, concurrency))
+    finally:
+        stop_server(server)
+        update_analysis_config(anthropic_api_url=previous_url)
+        if previous_key is None:
+            os.environ.pop("ANTHROPIC_API_KEY", None)
+        else:
+            os.environ["ANTHROPIC_API_KEY"] = previous_key
+
+    overhead = [max(sample - latency, 0.0) for sample in samples["sequential"]]
+    return {
+        "mock_latency_ms": latency * 1000,
+        "mock_jitter_ms": jitter * 1000,
+        "image_bytes": len(images[0]),
+        "iterations": iterations,
+        "sequential": summarize(samples["sequential"]),
+        "overhead": summarize(overhead) if not jitter else None,
+        "concurrent": {
+            **summarize(samples["concurrent"]),
+            "concurrency": concurrency,
+            "throughput_rps": round(iterations / samples["concurrent_elapsed"], 2)
+        },
+        "batch": {
+            **summarize(samples["batch"]),
+            "batch_size": batch_size,
+            "per_image_ms": round(sum(samples["batch"]) / len(samples["batch"]) / batch_size * 1000, 3)
+        }
+    }
@@ -0,0 +1,88 @@
+"""
+capture_frame() с локален видео файл вместо RTSP поток
+
+RTSPSession отваря източника с cv2.VideoCapture(..., CAP_FFMPEG), така че
+MJPEG файл минава през същия път като камерата: отваряне, фоново декодиране,
+преоразмеряване, JPEG кодиране, кеш в паметта и запис в архива. Вместо файла
+може да се подаде URL на локален RTSP сървър (например mediamtx с ffmpeg).
+
+Измерва се всяко извикване в два режима:
+- inline         - без абониран етап за архива, записът е в извикващия thread
+- archive_writer - записът е в ArchiveWriter през опашката на шината
+"""
+
+import os
+import time
+import tempfile
+from typing import Any, Dict, Optional
+
+from .common import summarize, write_test_video
+
+CAMERA_ID = "bench"
+
+def run(
+    iterations: int = 100,
+    source: Optional[str] = None,
+    width: int = 640,
+    height: int = 480,
+    quality: int = 85,
+    work_dir: Optional[str] = None
+) -> Dict[str, Any]:
+    """Измерва capture_frame() за камера, която чете от source"""
+    work_dir = work_dir or tempfile.mkdtemp(prefix="obzor_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    source = source or write_test_video(os.path.join(work_dir, "stream.avi"))
+
+    # Каталогът на архива се създава при първи запис - държим го във временната директория
+    os.environ.setdefault("FRAME_CATALOG", os.path.join(work_dir, "catalog.db"))
+
+    from modules.rtsp_capture.config import add_camera, remove_camera
+    from modules.rtsp_capture.capture import capture_frame
+    from modules.rtsp_capture.session import get_session, stop_session
+    from modules.rtsp_capture.archive import get_archive_writer
+
+    add_camera(
+        CAMERA_ID, source, save_dir=os.path.join(work_dir, "frames"),
+        width=width, height=height, quality=quality
+    )
+
+    try:
+        # Отваряне на потока до първия декодиран кадър
+        started = time.perf_counter()
+        frame, _ = get_session(source, CAMERA_ID).get_frame(timeout=30)
+        first_frame = time.perf_counter() - started
+        if frame is None:
+            raise RuntimeError(f"Няма кадър от {source}")
+
+        modes = {}
+        for mode in ("inline", "archive_writer"):
+            writer = get_archive_writer()
+            if mode == "archive_writer":
+                writer.start()
+
+            samples = []
+            failures = 0
+            for _ in range(iterations):
+                started = time.perf_counter()
+                if not capture_frame(CAMERA_ID):
+                    failures += 1
+                samples.append(time.perf_counter() - started)
+
+            modes[mode] = {**summarize(samples), "failures": failures}
+
+            if mode == "archive_writer":
+                # Кадрите, отказани от пълната опашка на архива
+                modes[mode]["archive_dropped"] = writer.get_status()["queue"]["dropped"]
+                writer.stop()
+
+        return {
+            "source": source,
+            "source_frame": {"width": frame.shape[1], "height": frame.shape[0]},
+            "output": {"width": width, "height": height, "quality": quality},
+            "iterations": iterations,
+            "first_frame_ms": round(first_frame * 1000, 3),
+            "capture_frame": modes
+        }
+    finally:
+        stop_session(CAMERA_ID)
+        remove_camera(CAMERA_ID)
@@ -0,0 +1,62 @@
+"""
+Преоразмеряване и JPEG кодиране на синтетични кадри
+
+Повтаря стъпките на capture_frame() (cv2.resize до width x height и
+cv2.imencode с quality) за всяка комбинация от размери и качество.
+"""
+
+import time
+from typing import Any, Dict, List, Sequence, Tuple
+
+from .common import summarize, synthetic_frame
+
+DEFAULT_SOURCE = (1920, 1080)
+DEFAULT_SIZES = ((640, 480), (1280, 720), (1920, 1080))
+DEFAULT_QUALITIES = (70, 85, 95)
+
+def run(
+    iterations: int = 30,
+    source: Tuple[int, int] = DEFAULT_SOURCE,
+    sizes: Sequence[Tuple[int, int]] = DEFAULT_SIZES,
+    qualities: Sequence[int] = DEFAULT_QUALITIES
+) -> Dict[str, Any]:
+    """Измерва resize и encode за всички комбинации"""
+    import cv2
+
+    frame = synthetic_frame(*source)
+    cases: List[Dict[str, Any]] = []
+
+    for width, height in sizes:
+        # Само едно преоразмеряване на размер - не зависи от качеството
+        resize_times = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            resized = cv2.resize(frame, (width, height))
+            resize_times.append(time.perf_counter() - started)
+
+        for quality in qualities:
+            encode_params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+            cv2.imencode(".jpg", resized, encode_params)  # Загряване
+
+            encode_times = []
+            size_bytes = 0
+            for _ in range(iterations):
+                started = time.perf_counter()
+                is_success, buffer = cv2.imencode(".jpg", resized, encode_params)
+                encode_times.append(time.perf_counter() - started)
+                size_bytes = len(buffer)
+
+            cases.append({
+                "width": width,
+                "height": height,
+                "quality": quality,
+                "resize": summarize(resize_times),
+                "encode": summarize(encode_times),
+                "jpeg_bytes": size_bytes
+            })
+
+    return {
+        "source": {"width": source[0], "height": source[1]},
+        "iterations": iterations,
+        "cases": cases
+    }
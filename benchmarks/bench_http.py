@@ -0,0 +1,121 @@
+"""
+HTTP натоварване на /rtsp/latest.jpg и /analysis/latest
+
+Приложението се стартира с uvicorn в отделен процес, като камерата чете
+локалния видео файл, а анализът е локален (без API ключ). След като има
+кадър и анализ, всеки endpoint получава заявки от concurrency паралелни
+клиента.
+"""
+
+import os
+import time
+import asyncio
+import tempfile
+from typing import Any, Dict, Optional, Sequence
+
+import httpx
+
+from .common import free_port, start_server, stop_server, summarize, write_test_video
+
+DEFAULT_ENDPOINTS = ("/rtsp/latest.jpg", "/analysis/latest")
+
+async def _wait_ready(client: httpx.AsyncClient, endpoints: Sequence[str], timeout: float):
+    """Изчаква всички endpoint-и да върнат 200 (има кадър и анализ)"""
+    deadline = time.monotonic() + timeout
+    pending = list(endpoints)
+    while pending:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Няма данни от {', '.join(pending)} за {timeout} секунди")
+        try:
+            response = await client.get(pending[0])
+            if response.status_code == 200:
+                pending.pop(0)
+                continue
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.5)
+
+async def _load(client: httpx.AsyncClient, endpoint: str, requests: int, concurrency: int) -> Dict[str, Any]:
+    samples = []
+    errors = 0
+    transferred = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors, transferred
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            try:
+                response = await client.get(endpoint)
+                if response.status_code != 200:
+                    errors += 1
+                transferred += len(response.content)
+            except httpx.TransportError:
+                errors += 1
+            samples.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        **summarize(samples),
+        "errors": errors,
+        "concurrency": concurrency,
+        "throughput_rps": round(len(samples) / elapsed, 2),
+        "bytes_per_response": transferred // max(len(samples), 1)
+    }
+
+async def _run(base_url: str, endpoints: Sequence[str], requests: int, concurrency: int, timeout: float) -> Dict[str, Any]:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        await _wait_ready(client, endpoints, timeout)
+
+        results = {}
+        for endpoint in endpoints:
+            # Загряване - кешове и връзки
+            await _load(client, endpoint, concurrency * 2, concurrency)
+            results[endpoint] = await _load(client, endpoint, requests, concurrency)
+        return results
+
+def run(
+    requests: int = 500,
+    concurrency: int = 16,
+    endpoints: Sequence[str] = DEFAULT_ENDPOINTS,
+    source: Optional[str] = None,
+    work_dir: Optional[str] = None,
+    ready_timeout: float = 90
+) -> Dict[str, Any]:
+    """Натоварва endpoint-ите на стартирано приложение"""
+    work_dir = work_dir or tempfile.mkdtemp(prefix="obzor_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    source = source or write_test_video(os.path.join(work_dir, "stream.avi"))
+
+    port = free_port()
+    env = {
+        "RTSP_URL": source,
+        "SAVE_DIR": os.path.join(work_dir, "frames"),
+        "INTERVAL": "1",
+        "ANALYSIS_ENGINE": "local",
+        "ANTHROPIC_API_KEY": "",
+        "ANALYSIS_HISTORY_DB": os.path.join(work_dir, "history.db"),
+        "FRAME_CATALOG": os.path.join(work_dir, "catalog.db"),
+        "STATE_DB": os.path.join(work_dir, "state.db"),
+        "IMAGE_URL": os.path.join(work_dir, "frames", "latest.jpg")
+    }
+    server = start_server(
+        ["uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        port, env
+    )
+
+    try:
+        results = asyncio.run(_run(f"http://127.0.0.1:{port}", endpoints, requests, concurrency, ready_timeout))
+    finally:
+        stop_server(server)
+
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "endpoints": results
+    }
@@ -0,0 +1,155 @@
+"""
+Общи помощни функции за бенчмарковете: статистики, синтетични кадри,
+видео файл и стартиране на локални сървъри
+"""
+
+import os
+import sys
+import time
+import socket
+import platform
+import subprocess
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence
+
+# Коренът на проекта (за subprocess-ите и за import на модулите)
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def summarize(samples: Sequence[float]) -> Dict[str, Any]:
+    """Статистики на измерванията в милисекунди"""
+    if not samples:
+        return {"count": 0}
+
+    ordered = sorted(samples)
+
+    def percentile(p: float) -> float:
+        index = min(int(round(p / 100 * (len(ordered) - 1))), len(ordered) - 1)
+        return ordered[index] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "min_ms": round(ordered[0] * 1000, 3),
+        "p50_ms": round(percentile(50), 3),
+        "p90_ms": round(percentile(90), 3),
+        "p99_ms": round(percentile(99), 3),
+        "max_ms": round(ordered[-1] * 1000, 3)
+    }
+
+def environment_info() -> Dict[str, Any]:
+    """Версии и машина, на които е пуснат бенчмаркът"""
+    info: Dict[str, Any] = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count()
+    }
+
+    try:
+        info["git_commit"] = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR,
+            capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+    except Exception:
+        info["git_commit"] = None
+
+    for package in ("numpy", "cv2", "fastapi", "httpx"):
+        try:
+            info[package] = __import__(package).__version__
+        except Exception:
+            info[package] = None
+    return info
+
+def synthetic_frame(width: int, height: int, seed: int = 0):
+    """
+    Кадър, подобен на изглед от камера: градиент на небето, облаци и шум
+
+    Чистият градиент се компресира нереалистично добре, затова се добавят
+    облаци и шум на сензора - размерът на JPEG е близък до реалния.
+    """
+    import cv2
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    rows = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+
+    frame = np.empty((height, width, 3), dtype=np.float32)
+    frame[..., 0] = 230 - 60 * rows  # B
+    frame[..., 1] = 180 - 40 * rows  # G
+    frame[..., 2] = 120 - 20 * rows  # R
+
+    # Облаци - размазан шум с ниска честота
+    clouds = rng.random((max(height // 32, 2), max(width // 32, 2)), dtype=np.float32)
+    clouds = cv2.resize(clouds, (width, height), interpolation=cv2.INTER_CUBIC)
+    clouds = np.clip((clouds - 0.5) * 2, 0, 1)[..., None] * 255
+    frame = frame * (1 - clouds / 400) + clouds * 0.6
+
+    # Земя в долната четвърт
+    frame[int(height * 0.75):] *= 0.35
+
+    frame += rng.normal(0, 4, frame.shape).astype(np.float32)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+def write_test_video(path: str, width: int = 1280, height: int = 720, frames: int = 250, fps: float = 25.0) -> str:
+    """Записва MJPEG видео от синтетични кадри (заместител на RTSP поток)"""
+    import cv2
+
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), fps, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError(f"Не може да се създаде видео файл: {path}")
+
+    # Няколко различни кадъра, които се редуват - декодирането е като при истински поток
+    variants = [synthetic_frame(width, height, seed) for seed in range(8)]
+    for index in range(frames):
+        writer.write(variants[index % len(variants)])
+    writer.release()
+    return path
+
+def free_port() -> int:
+    """Свободен TCP порт на localhost"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_server(module_args: List[str], port: int, env: Optional[Dict[str, str]] = None, timeout: float = 60) -> subprocess.Popen:
+    """Стартира python -m <module_args> в отделен процес и изчаква порта да се отвори"""
+    process_env = dict(os.environ)
+    process_env["PYTHONPATH"] = ROOT_DIR + os.pathsep + process_env.get("PYTHONPATH", "")
+    process_env.update(env or {})
+
+    process = subprocess.Popen(
+        [sys.executable, "-m", *module_args],
+        cwd=ROOT_DIR,
+        env=process_env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Сървърът спря при стартиране: {' '.join(module_args)}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return process
+        except OSError:
+            time.sleep(0.1)
+
+    stop_server(process)
+    raise RuntimeError(f"Сървърът не отвори порт {port} за {timeout} секунди")
+
+def stop_server(process: subprocess.Popen):
+    """Спира стартиран сървър"""
+    if process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
@@ -0,0 +1,77 @@
+"""
+Локален mock на Anthropic Messages API със зададена латентност
+
+Отговаря на POST /v1/messages във формата на истинското API: един JSON обект
+за едно изображение или JSON масив с полето "image" при групова заявка.
+Латентността (и случайното отклонение) симулират времето на модела, така че
+бенчмаркът мери собствените разходи на клиента - подготовка на изображението,
+пул от връзки, разбор на отговора.
+
+Стартиране:
+    python -m benchmarks.mock_api --port 8200 --latency 0.8 --jitter 0.2
+"""
+
+import json
+import random
+import asyncio
+import argparse
+
+import uvicorn
+from fastapi import FastAPI, Request
+
+app = FastAPI(title="Mock Anthropic API")
+app.state.latency = 0.5
+app.state.jitter = 0.0
+app.state.requests = 0
+
+def _analysis(index: int) -> dict:
+    return {
+        "image": index,
+        "cloud_coverage": 40 + index,
+        "cloud_type": "Cumulus",
+        "weather_conditions": "Разкъсана облачност",
+        "visibility": "добра",
+        "confidence": 85
+    }
+
+@app.post("/v1/messages")
+async def messages(request: Request):
+    payload = await request.json()
+    app.state.requests += 1
+
+    content = payload["messages"][0]["content"]
+    images = sum(1 for block in content if block.get("type") == "image")
+
+    delay = app.state.latency + random.uniform(0, app.state.jitter)
+    await asyncio.sleep(delay)
+
+    if images > 1:
+        text = json.dumps([_analysis(index) for index in range(images)], ensure_ascii=False)
+    else:
+        text = json.dumps(_analysis(0), ensure_ascii=False)
+
+    return {
+        "id": f"msg_mock_{app.state.requests}",
+        "type": "message",
+        "role": "assistant",
+        "model": payload.get("model"),
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "usage": {"input_tokens": 1500 * max(images, 1), "output_tokens": 80 * max(images, 1)}
+    }
+
+@app.get("/stats")
+async def stats():
+    return {"requests": app.state.requests, "latency": app.state.latency, "jitter": app.state.jitter}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock на Anthropic Messages API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8200)
+    parser.add_argument("--latency", type=float, default=0.5, help="Време за отговор в секунди")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Случайно добавено време до толкова секунди")
+    args = parser.parse_args()
+
+    app.state.latency = args.latency
+    app.state.jitter = args.jitter
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,164 @@
+"""
+Стартира бенчмарковете и записва резултатите като JSON
+
+Примери:
+    python -m benchmarks.run
+    python -m benchmarks.run --suites encode,capture --output bench.json
+    python -m benchmarks.run --suites analysis --mock-latency 0.8 --mock-jitter 0.2
+    python -m benchmarks.run --compare benchmarks/results/previous.json
+
+Всеки набор се пуска независимо - грешка в един се записва в резултата и
+не спира останалите.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import traceback
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+from .common import ROOT_DIR, environment_info
+
+SUITES = ("encode", "capture", "http", "analysis")
+
+# Стойностите, които се сравняват с --compare (min/max/p99 са твърде шумни)
+COMPARED_KEYS = ("mean_ms", "p50_ms", "p90_ms", "throughput_rps")
+
+def parse_sizes(value: str) -> List[Tuple[int, int]]:
+    """Разчита "640x480,1280x720" в списък от (ширина, височина)"""
+    sizes = []
+    for item in value.split(","):
+        width, height = item.lower().split("x")
+        sizes.append((int(width), int(height)))
+    return sizes
+
+def run_suite(name: str, args: argparse.Namespace, work_dir: str) -> Dict[str, Any]:
+    """Пуска един набор с параметрите от командния ред"""
+    if name == "encode":
+        from . import bench_encode
+        return bench_encode.run(
+            iterations=args.iterations,
+            sizes=parse_sizes(args.sizes),
+            qualities=[int(quality) for quality in args.qualities.split(",")]
+        )
+    if name == "capture":
+        from . import bench_capture
+        width, height = parse_sizes(args.capture_size)[0]
+        return bench_capture.run(
+            iterations=args.iterations * 3, source=args.source,
+            width=width, height=height, quality=args.capture_quality,
+            work_dir=os.path.join(work_dir, "capture")
+        )
+    if name == "http":
+        from . import bench_http
+        return bench_http.run(
+            requests=args.http_requests, concurrency=args.http_concurrency, source=args.source,
+            work_dir=os.path.join(work_dir, "http")
+        )
+    if name == "analysis":
+        from . import bench_analysis
+        return bench_analysis.run(
+            iterations=args.iterations, latency=args.mock_latency, jitter=args.mock_jitter,
+            concurrency=args.analysis_concurrency, batch_size=args.batch_size
+        )
+    raise ValueError(f"Непознат набор: {name}")
+
+def _flatten(value: Any, prefix: str = "") -> Dict[str, float]:
+    """Стойностите от COMPARED_KEYS с пълния им път в резултата"""
+    flat = {}
+    if isinstance(value, dict):
+        for key, item in value.items():
+            flat.update(_flatten(item, f"{prefix}.{key}" if prefix else str(key)))
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            flat.update(_flatten(item, f"{prefix}[{index}]"))
+    elif isinstance(value, (int, float)) and prefix.rsplit(".", 1)[-1] in COMPARED_KEYS:
+        flat[prefix] = value
+    return flat
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[Dict[str, Any]]:
+    """
+    Стойностите, влошени с повече от threshold (относително) спрямо baseline
+
+    За времената по-голямо е по-лошо, а за throughput_rps - по-малко.
+    """
+    current_values = _flatten(current.get("suites", {}))
+    baseline_values = _flatten(baseline.get("suites", {}))
+
+    regressions = []
+    for key, value in current_values.items():
+        previous = baseline_values.get(key)
+        if not previous:
+            continue
+        change = (value - previous) / previous
+        if key.endswith("throughput_rps"):
+            change = -change
+        if change > threshold:
+            regressions.append({"metric": key, "baseline": previous, "current": value, "change": round(change, 3)})
+    return regressions
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Бенчмаркове на ObzorWeather System")
+    parser.add_argument("--suites", default=",".join(SUITES), help=f"Наборите за пускане ({', '.join(SUITES)})")
+    parser.add_argument("--output", help="JSON файл за резултата (по подразбиране benchmarks/results/)")
+    parser.add_argument("--iterations", type=int, default=30, help="Повторения на измерване")
+    parser.add_argument("--source", help="Видео файл или RTSP URL вместо генерирания файл")
+    parser.add_argument("--sizes", default="640x480,1280x720,1920x1080", help="Размери за encode")
+    parser.add_argument("--qualities", default="70,85,95", help="JPEG качества за encode")
+    parser.add_argument("--capture-size", default="640x480", help="Размер на кадъра за capture")
+    parser.add_argument("--capture-quality", type=int, default=85, help="JPEG качество за capture")
+    parser.add_argument("--http-requests", type=int, default=500, help="Заявки на endpoint")
+    parser.add_argument("--http-concurrency", type=int, default=16, help="Паралелни HTTP клиенти")
+    parser.add_argument("--mock-latency", type=float, default=0.2, help="Латентност на mock API в секунди")
+    parser.add_argument("--mock-jitter", type=float, default=0.0, help="Случайно отклонение на латентността в секунди")
+    parser.add_argument("--analysis-concurrency", type=int, default=4, help="Паралелни анализи")
+    parser.add_argument("--batch-size", type=int, default=4, help="Изображения в групов анализ")
+    parser.add_argument("--compare", help="Предишен JSON резултат за сравнение")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Допустимо влошаване при --compare (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    # Модулите на приложението се импортират спрямо корена на проекта
+    if ROOT_DIR not in sys.path:
+        sys.path.insert(0, ROOT_DIR)
+
+    report: Dict[str, Any] = {"environment": environment_info(), "suites": {}, "errors": {}}
+    started = time.perf_counter()
+
+    # Видео файлът, кадрите и базите на наборите се изтриват след края
+    with tempfile.TemporaryDirectory(prefix="obzor_bench_") as work_dir:
+        for name in [item.strip() for item in args.suites.split(",") if item.strip()]:
+            print(f"[{name}] ...", flush=True)
+            suite_started = time.perf_counter()
+            try:
+                report["suites"][name] = run_suite(name, args, work_dir)
+            except Exception as e:
+                report["errors"][name] = {"error": str(e), "traceback": traceback.format_exc()}
+            elapsed = time.perf_counter() - suite_started
+            print(f"[{name}] {'грешка' if name in report['errors'] else 'готово'} за {elapsed:.1f} s", flush=True)
+
+    report["total_seconds"] = round(time.perf_counter() - started, 2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            report["regressions"] = compare(report, json.load(f), args.threshold)
+        report["baseline"] = args.compare
+
+    output = args.output or os.path.join(
+        ROOT_DIR, "benchmarks", "results", f"bench-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Резултатът е записан в {output}")
+
+    for regression in report.get("regressions", []):
+        print(f"Влошаване: {regression['metric']} {regression['baseline']} -> {regression['current']}")
+
+    return 1 if report["errors"] or report.get("regressions") else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,5 @@
-"""
-Инициализация на модулите за ObzorWeather System
-"""
-
+"""
+Инициализация на модулите за ObzorWeather System
+"""
+
 # Празен файл, само за да обозначи директорията като Python пакет
\ No newline at end of file
@@ -1,385 +1,638 @@
-"""
-Логика за анализ на изображения с помощта на Anthropic API
-"""
-
-import os
-import json
-import time
-import threading
-import httpx
-from datetime import datetime
-from io import BytesIO
-from PIL import Image
-from typing import Dict, Any, Optional, Tuple
-import base64
-
-from .config import (
-    get_analysis_config, 
-    update_analysis_config, 
-    add_analysis_result,
-    AnalysisResult
-)
-from utils.logger import setup_logger
-
-# Инициализиране на логър
-logger = setup_logger("image_analyzer")
-
-# Глобални променливи
-analysis_thread = None
-
-def get_anthropic_api_key() -> Optional[str]:
-    """
-    Взима Anthropic API ключа от средата на Hugging Face
-    
-    Hugging Face съхранява секретите като environment променливи,
-    така че можем да ги достъпим безопасно.
-    """
-    api_key = os.getenv("ANTHROPIC_API_KEY")
-    if not api_key:
-        logger.error("ANTHROPIC_API_KEY не е наличен! Моля, добавете го като секрет в Hugging Face.")
-        return None
-    return api_key
-
-async def download_image(url: str) -> Optional[bytes]:
-    """Чете изображение от локален файл или URL"""
-    try:
-        # Проверяваме дали URL е локален път
-        if not url.startswith(('http://', 'https://')):
-            # Това е локален път, опитваме да го прочетем директно
-            # Проверяваме няколко възможни пътища
-            paths_to_try = [
-                url,  # Оригиналния път
-                os.path.join("/app", url),  # В case на Docker среда
-                os.path.join(os.getcwd(), url)  # Относително от текущата директория
-            ]
-            
-            for path in paths_to_try:
-                if os.path.exists(path):
-                    logger.info(f"Четене на изображение от локален файл: {path}")
-                    try:
-                        with open(path, "rb") as f:
-                            image_data = f.read()
-                        logger.info(f"Успешно прочетено изображение от {path}, размер: {len(image_data)} bytes")
-                        
-                        # Проверяваме дали изображението е валидно
-                        try:
-                            Image.open(BytesIO(image_data))
-                            return image_data
-                        except Exception as e:
-                            logger.error(f"Невалидно изображение от {path}: {e}")
-                            continue  # Опитваме със следващия път
-                    except Exception as e:
-                        logger.error(f"Грешка при четене на локален файл {path}: {e}")
-                        continue  # Опитваме със следващия път
-            
-            # Ако стигнем дотук, не сме намерили валиден файл
-            logger.error(f"Не може да се намери или прочете локален файл: {url}")
-            logger.error(f"Опитани пътища: {paths_to_try}")
-            return None
-            
-        else:
-            # Това е URL, използваме HTTP заявка
-            logger.info(f"Опит за изтегляне на изображение от URL: {url}")
-            async with httpx.AsyncClient() as client:
-                response = await client.get(url, timeout=30.0, follow_redirects=True)
-                
-                if response.status_code != 200:
-                    logger.error(f"Грешка при изтегляне на изображението: HTTP {response.status_code}")
-                    return None
-                
-                image_data = response.content
-                logger.info(f"Успешно изтеглено изображение от URL, размер: {len(image_data)} bytes")
-                
-                # Проверяваме дали изображението е валидно
-                try:
-                    Image.open(BytesIO(image_data))
-                    return image_data
-                except Exception as e:
-                    logger.error(f"Невалидно изображение от URL: {e}")
-                    return None
-    except Exception as e:
-        logger.error(f"Грешка при изтегляне/четене на изображението: {e}")
-        return None
-
-def encode_image_base64(image_data: bytes) -> str:
-    """Кодира изображението в base64"""
-    return base64.b64encode(image_data).decode('utf-8')
-
-async def analyze_image_with_anthropic(image_data: bytes) -> Tuple[bool, Dict[str, Any]]:
-    """
-    Анализира изображение с помощта на Anthropic API
-    
-    Args:
-        image_data: Байтове на изображението
-    
-    Returns:
-        (успех, резултат) tuple
-    """
-    config = get_analysis_config()
-    api_key = get_anthropic_api_key()
-    
-    if not api_key:
-        return False, {"error": "Липсва Anthropic API ключ"}
-    
-    try:
-        # Кодираме изображението в base64
-        base64_image = encode_image_base64(image_data)
-        
-        # Създаваме заглавки за заявката
-        headers = {
-            "x-api-key": api_key,
-            "anthropic-version": "2023-06-01",
-            "content-type": "application/json"
-        }
-        
-        # Изграждаме съобщение за Claude
-        prompt = """
-        Ти си експерт метеоролог, който анализира изображения от камери. Анализирай предоставеното изображение и дай детайлна информация за:
-        
-        1. Процент облачност (0-100%)
-        2. Тип на облаците (ако има такива)
-        3. Видимост (отлична, добра, умерена, лоша)
-        4. Общо описание на метеорологичните условия в момента
-        5. Отговори на български език
-        6. Анализите между 21:00 и 06:00 българско време ги отбелязвай като: Анализа се извършва в светлата част на деня!
-        
-        Отговори в следния JSON формат:
-        {
-          "cloud_coverage": [число от 0 до 100],
-          "cloud_type": "[тип на облаците, например: кумулус, стратус, нимбостратус и т.н.]",
-          "visibility": "[отлична/добра/умерена/лоша]",
-          "weather_conditions": "[кратко описание на метеорологичните условия]",
-          "confidence": [число от 0 до 100, показващо твоята увереност в анализа]
-        }
-        
-        Бъди възможно най-точен и прецизен. Базирай се САМО на това, което виждаш на изображението, без да правиш предположения извън видимото съдържание.
-        
-        Ако изображението е твърде тъмно, замъглено или по друг начин неясно, отбележи това в полето "weather_conditions" и намали стойността на "confidence".
-        
-        Отговори САМО с JSON обект без допълнителен текст или обяснения.
-        """
-        
-        # Създаваме payload за заявката
-        payload = {
-            "model": config.anthropic_model,
-            "messages": [
-                {
-                    "role": "user", 
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image", 
-                            "source": {
-                                "type": "base64", 
-                                "media_type": "image/jpeg", 
-                                "data": base64_image
-                            }
-                        }
-                    ]
-                }
-            ],
-            "max_tokens": config.max_tokens,
-            "temperature": config.temperature
-        }
-        
-        logger.info(f"Изпращане на заявка към Anthropic API с модел {config.anthropic_model}")
-        start_time = time.time()
-        
-        # Изпращаме заявката
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                config.anthropic_api_url, 
-                json=payload,
-                headers=headers,
-                timeout=60.0
-            )
-            
-            elapsed_time = time.time() - start_time
-            logger.info(f"Получен отговор от Anthropic API за {elapsed_time:.2f} секунди")
-            
-            if response.status_code != 200:
-                logger.error(f"Грешка от Anthropic API: {response.status_code} - {response.text}")
-                return False, {
-                    "error": f"Грешка от Anthropic API: {response.status_code}",
-                    "details": response.text
-                }
-            
-            # Обработваме отговора
-            result = response.json()
-            
-            # Извличаме текстовия отговор
-            if "content" in result and len(result["content"]) > 0:
-                content = result["content"][0].get("text", "")
-                
-                # Опитваме се да извлечем JSON от отговора
-                try:
-                    # Намираме началото и края на JSON обекта
-                    start_idx = content.find('{')
-                    end_idx = content.rfind('}') + 1
-                    
-                    if start_idx >= 0 and end_idx > start_idx:
-                        json_str = content[start_idx:end_idx]
-                        analysis_result = json.loads(json_str)
-                        
-                        # Добавяме метаданни
-                        analysis_result["analysis_time"] = elapsed_time
-                        analysis_result["full_analysis"] = content
-                        
-                        logger.info(f"Успешен анализ: {analysis_result}")
-                        return True, analysis_result
-                    else:
-                        logger.error(f"Не е намерен валиден JSON в отговора: {content}")
-                        return False, {"error": "Не е намерен валиден JSON в отговора", "raw_response": content}
-                except Exception as e:
-                    logger.error(f"Грешка при обработка на JSON: {e}")
-                    return False, {"error": f"Грешка при обработка на JSON: {e}", "raw_response": content}
-            else:
-                logger.error("Празен отговор от Anthropic API")
-                return False, {"error": "Празен отговор от Anthropic API", "raw_response": result}
-    
-    except Exception as e:
-        logger.error(f"Неочаквана грешка при анализ на изображението: {e}")
-        return False, {"error": f"Неочаквана грешка: {e}"}
-
-async def perform_image_analysis() -> AnalysisResult:
-    """
-    Изпълнява целия процес на анализ на изображение
-    
-    Returns:
-        AnalysisResult обект с резултата от анализа
-    """
-    config = get_analysis_config()
-    
-    # Създаваме начален обект за резултата
-    result = AnalysisResult(
-        timestamp=datetime.now()
-    )
-    
-    try:
-        # Изтегляме/четем изображението
-        image_data = await download_image(config.image_url)
-        
-        if not image_data:
-            logger.error(f"Не може да се прочете/изтегли изображение от {config.image_url}")
-            result.weather_conditions = "Не може да се прочете/изтегли изображение"
-            update_analysis_config(status="error")
-            return result
-        
-        # Анализираме изображението
-        success, analysis = await analyze_image_with_anthropic(image_data)
-        
-        if not success:
-            logger.error(f"Грешка при анализ на изображението: {analysis.get('error', 'Unknown error')}")
-            result.weather_conditions = f"Грешка при анализ: {analysis.get('error', 'Unknown error')}"
-            update_analysis_config(status="error")
-            return result
-        
-        # Обновяваме резултата с данните от анализа
-        result.cloud_coverage = float(analysis.get("cloud_coverage", 0))
-        result.cloud_type = analysis.get("cloud_type", "")
-        result.weather_conditions = analysis.get("weather_conditions", "")
-        result.confidence = float(analysis.get("confidence", 0))
-        result.analysis_time = float(analysis.get("analysis_time", 0))
-        result.full_analysis = analysis.get("full_analysis", "")
-        result.raw_response = analysis
-        
-        # Обновяваме статуса
-        update_analysis_config(status="ok")
-        
-        logger.info(f"Успешен анализ: {result.weather_conditions} (облачност: {result.cloud_coverage}%, тип: {result.cloud_type})")
-        
-        return result
-    
-    except Exception as e:
-        logger.error(f"Неочаквана грешка при анализ: {e}")
-        result.weather_conditions = f"Неочаквана грешка: {str(e)}"
-        update_analysis_config(status="error")
-        return result
-
-def analysis_loop():
-    """Основен цикъл за периодичен анализ на изображения"""
-    config = get_analysis_config()
-    
-    while config.running:
-        try:
-            # Изпълняваме анализ асинхронно
-            import asyncio
-            result = asyncio.run(perform_image_analysis())
-            
-            # Добавяме резултата в историята
-            add_analysis_result(result)
-            
-        except Exception as e:
-            logger.error(f"Неочаквана грешка в analysis_loop: {e}")
-        
-        # Обновяваме конфигурацията (за случай, че е променена)
-        config = get_analysis_config()
-        
-        # Спим до следващия анализ
-        time.sleep(config.analysis_interval)
-
-def start_analysis_thread():
-    """Стартира фонов процес за анализ на изображения"""
-    global analysis_thread
-    
-    if analysis_thread is None or not analysis_thread.is_alive():
-        analysis_thread = threading.Thread(target=analysis_loop)
-        analysis_thread.daemon = True
-        analysis_thread.start()
-        logger.info("Analysis thread started")
-        return True
-    
-    return False
-
-def stop_analysis_thread():
-    """Спира фоновия процес за анализ на изображения"""
-    update_analysis_config(running=False)
-    logger.info("Analysis thread stopping")
-    return True
-
-async def analyze_image_now() -> AnalysisResult:
-    """Принудително изпълнява анализ на изображение веднага"""
-    result = await perform_image_analysis()
-    add_analysis_result(result)
-    return result
-
-# Функция за инициализиране на модула
-def initialize():
-    """Инициализира модула"""
-    # Проверяваме дали имаме API ключ
-    api_key = get_anthropic_api_key()
-    if not api_key:
-        logger.error("ANTHROPIC_API_KEY не е наличен - Image Analysis модулът не може да бъде инициализиран")
-        update_analysis_config(status="error")
-        return False
-    
-    # Логваме къде се очаква да бъде изображението
-    config = get_analysis_config()
-    logger.info(f"Модулът ще анализира изображения от: {config.image_url}")
-    
-    # Проверяваме дали файла съществува в момента
-    if not config.image_url.startswith(('http://', 'https://')):
-        paths_to_try = [
-            config.image_url,
-            os.path.join("/app", config.image_url),
-            os.path.join(os.getcwd(), config.image_url)
-        ]
-        
-        file_exists = False
-        for path in paths_to_try:
-            if os.path.exists(path):
-                logger.info(f"Изображението съществува на път: {path}")
-                file_exists = True
-                break
-                
-        if not file_exists:
-            logger.warning(f"Изображението не съществува в нито един от опитаните пътища: {paths_to_try}")
-            logger.warning("Модулът ще работи, но първоначалният анализ може да се провали")
-    
-    # Стартираме thread за анализ
-    start_analysis_thread()
-    logger.info("Image Analysis модул инициализиран успешно")
-    return True
-
-# Автоматично инициализиране при import
-initialize()
\ No newline at end of file
+"""
+Логика за анализ на изображения с помощта на Anthropic API
+"""
+
+import os
+import json
+import time
+import asyncio
+import threading
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+import base64
+
+import httpx
+
+from .config import (
+    get_analysis_config, 
+    update_analysis_config, 
+    add_analysis_result,
+    load_recent_history,
+    get_analysis_sources,
+    AnalysisResult
+)
+from .http_client import get_http_client, parse_retry_after
+from .change_detection import get_change_detector, compute_signature
+from .result_cache import get_analysis_cache, make_cache_key
+from .local_estimator import estimate_sky
+from .preprocess import preprocess_for_api, preprocessing_signature, read_image_size
+from utils.logger import setup_logger
+from utils.events import StageQueue, get_event_bus, DROP_OLDEST
+from utils.shared_frames import open_ring
+from utils.metrics import Counter, Histogram
+
+# Инициализиране на логър
+logger = setup_logger("image_analyzer")
+
+# Глобални променливи
+analysis_thread = None
+
+# Име на етапа за анализ в шината за събития
+ANALYSIS_STAGE = "analysis"
+
+# Метрики на анализа
+API_LATENCY_SECONDS = Histogram(
+    "analysis_api_seconds", "Време за отговор на Anthropic API", ["mode", "status"]
+)
+PARSE_FAILURES_TOTAL = Counter(
+    "analysis_parse_failures_total", "Отговори на API без валиден JSON", ["mode"]
+)
+ANALYSIS_SECONDS = Histogram(
+    "analysis_seconds", "Време за целия анализ на един кадър", ["camera", "outcome"]
+)
+
+# Инструкции към модела; участват и в ключа на кеша на анализите
+ANALYSIS_PROMPT = """
+    Ти си експерт метеоролог, който анализира изображения от камери. Анализирай предоставеното изображение и дай детайлна информация за:
+    
+    1. Процент облачност (0-100%)
+    2. Тип на облаците (ако има такива)
+    3. Видимост (отлична, добра, умерена, лоша)
+    4. Общо описание на метеорологичните условия в момента
+    5. Отговори на български език
+    6. Анализите между 21:00 и 06:00 българско време ги отбелязвай като: Анализа се извършва в светлата част на деня!
+    
+    Отговори в следния JSON формат:
+    {
+      "cloud_coverage": [число от 0 до 100],
+      "cloud_type": "[тип на облаците, например: кумулус, стратус, нимбостратус и т.н.]",
+      "visibility": "[отлична/добра/умерена/лоша]",
+      "weather_conditions": "[кратко описание на метеорологичните условия]",
+      "confidence": [число от 0 до 100, показващо твоята увереност в анализа]
+    }
+    
+    Бъди възможно най-точен и прецизен. Базирай се САМО на това, което виждаш на изображението, без да правиш предположения извън видимото съдържание.
+    
+    Ако изображението е твърде тъмно, замъглено или по друг начин неясно, отбележи това в полето "weather_conditions" и намали стойността на "confidence".
+    
+    Отговори САМО с JSON обект без допълнителен текст или обяснения.
+    """
+
+def get_anthropic_api_key() -> Optional[str]:
+    """
+    Взима Anthropic API ключа от средата на Hugging Face
+    
+    Hugging Face съхранява секретите като environment променливи,
+    така че можем да ги достъпим безопасно.
+    """
+    api_key = os.getenv("ANTHROPIC_API_KEY")
+    if not api_key:
+        logger.error("ANTHROPIC_API_KEY не е наличен! Моля, добавете го като секрет в Hugging Face.")
+        return None
+    return api_key
+
+async def download_image(url: str) -> Optional[bytes]:
+    """Чете изображение от локален файл или URL"""
+    try:
+        # Проверяваме дали URL е локален път
+        if not url.startswith(('http://', 'https://')):
+            # Това е локален път, опитваме да го прочетем директно
+            # Проверяваме няколко възможни пътища
+            paths_to_try = [
+                url,  # Оригиналния път
+                os.path.join("/app", url),  # В case на Docker среда
+                os.path.join(os.getcwd(), url)  # Относително от текущата директория
+            ]
+            
+            for path in paths_to_try:
+                if os.path.exists(path):
+                    logger.info(f"Четене на изображение от локален файл: {path}")
+                    try:
+                        with open(path, "rb") as f:
+                            image_data = f.read()
+                        logger.info(f"Успешно прочетено изображение от {path}, размер: {len(image_data)} bytes")
+                        
+                        # Проверяваме дали изображението е валидно (само заглавката)
+                        if read_image_size(image_data) is None:
+                            logger.error(f"Невалидно изображение от {path}")
+                            continue  # Опитваме със следващия път
+                        return image_data
+                    except Exception as e:
+                        logger.error(f"Грешка при четене на локален файл {path}: {e}")
+                        continue  # Опитваме със следващия път
+            
+            # Ако стигнем дотук, не сме намерили валиден файл
+            logger.error(f"Не може да се намери или прочете локален файл: {url}")
+            logger.error(f"Опитани пътища: {paths_to_try}")
+            return None
+            
+        else:
+            # Това е URL, използваме HTTP заявка
+            logger.info(f"Опит за изтегляне на изображение от URL: {url}")
+            response = await get_http_client().request("GET", url, timeout=30.0)
+            
+            if response.status_code != 200:
+                logger.error(f"Грешка при изтегляне на изображението: HTTP {response.status_code}")
+                return None
+            
+            image_data = response.content
+            logger.info(f"Успешно изтеглено изображение от URL, размер: {len(image_data)} bytes")
+            
+            # Проверяваме дали изображението е валидно (само заглавката)
+            if read_image_size(image_data) is None:
+                logger.error("Невалидно изображение от URL")
+                return None
+            return image_data
+    except Exception as e:
+        logger.error(f"Грешка при изтегляне/четене на изображението: {e}")
+        return None
+
+def encode_image_base64(image_data: bytes) -> str:
+    """Кодира изображението в base64"""
+    return base64.b64encode(image_data).decode('utf-8')
+
+async def analyze_image_with_anthropic(image_data: bytes) -> Tuple[bool, Dict[str, Any]]:
+    """
+    Анализира изображение с помощта на Anthropic API
+    
+    Args:
+        image_data: Байтове на изображението
+    
+    Returns:
+        (успех, резултат) tuple
+    """
+    config = get_analysis_config()
+    api_key = get_anthropic_api_key()
+    
+    if not api_key:
+        return False, {"error": "Липсва Anthropic API ключ"}
+    
+    try:
+        # Намаляваме и прекодираме изображението, после го кодираме в base64
+        image_data = await asyncio.to_thread(preprocess_for_api, image_data)
+        base64_image = encode_image_base64(image_data)
+        
+        # Създаваме заглавки за заявката
+        headers = {
+            "x-api-key": api_key,
+            "anthropic-version": "2023-06-01",
+            "content-type": "application/json"
+        }
+        
+        # Създаваме payload за заявката
+        payload = {
+            "model": config.anthropic_model,
+            "messages": [
+                {
+                    "role": "user", 
+                    "content": [
+                        {"type": "text", "text": ANALYSIS_PROMPT},
+                        {
+                            "type": "image", 
+                            "source": {
+                                "type": "base64", 
+                                "media_type": "image/jpeg", 
+                                "data": base64_image
+                            }
+                        }
+                    ]
+                }
+            ],
+            "max_tokens": config.max_tokens,
+            "temperature": config.temperature
+        }
+        
+        logger.info(f"Изпращане на заявка към Anthropic API с модел {config.anthropic_model}")
+        start_time = time.time()
+        
+        # Изпращаме заявката
+        response = await get_http_client().request(
+            "POST",
+            config.anthropic_api_url, 
+            json=payload,
+            headers=headers,
+            timeout=config.http_timeout
+        )
+        
+        elapsed_time = time.time() - start_time
+        logger.info(f"Получен отговор от Anthropic API за {elapsed_time:.2f} секунди")
+        API_LATENCY_SECONDS.observe(elapsed_time, mode="single", status=response.status_code)
+        
+        if response.status_code != 200:
+            logger.error(f"Грешка от Anthropic API: {response.status_code} - {response.text}")
+            return False, {
+                "error": f"Грешка от Anthropic API: {response.status_code}",
+                "details": response.text,
+                "status_code": response.status_code,
+                "retry_after": parse_retry_after(response.headers.get("retry-after"))
+            }
+        
+        # Обработваме отговора
+        result = response.json()
+        
+        # Извличаме текстовия отговор
+        if "content" in result and len(result["content"]) > 0:
+            content = result["content"][0].get("text", "")
+            
+            # Опитваме се да извлечем JSON от отговора
+            try:
+                # Намираме началото и края на JSON обекта
+                start_idx = content.find('{')
+                end_idx = content.rfind('}') + 1
+                
+                if start_idx >= 0 and end_idx > start_idx:
+                    json_str = content[start_idx:end_idx]
+                    analysis_result = json.loads(json_str)
+                    
+                    # Добавяме метаданни
+                    analysis_result["analysis_time"] = elapsed_time
+                    analysis_result["full_analysis"] = content
+                    
+                    logger.info(f"Успешен анализ: {analysis_result}")
+                    return True, analysis_result
+                else:
+                    logger.error(f"Не е намерен валиден JSON в отговора: {content}")
+                    PARSE_FAILURES_TOTAL.inc(mode="single")
+                    return False, {"error": "Не е намерен валиден JSON в отговора", "raw_response": content}
+            except Exception as e:
+                logger.error(f"Грешка при обработка на JSON: {e}")
+                PARSE_FAILURES_TOTAL.inc(mode="single")
+                return False, {"error": f"Грешка при обработка на JSON: {e}", "raw_response": content}
+        else:
+            logger.error("Празен отговор от Anthropic API")
+            return False, {"error": "Празен отговор от Anthropic API", "raw_response": result}
+
+    except Exception as e:
+        logger.error(f"Неочаквана грешка при анализ на изображението: {e}")
+        # Мрежовите грешки и таймаутите са временни и могат да се повторят
+        return False, {"error": f"Неочаквана грешка: {e}", "retryable": isinstance(e, httpx.TransportError)}
+
+async def request_remote_analysis(image_data: bytes, camera_id: str = "default") -> Tuple[bool, Dict[str, Any]]:
+    """
+    Изпраща изображението към API през планировчика (лимити, повторения,
+    приоритети) - самостоятелно или в група с други изображения
+    """
+    # Импортира се тук, защото планировчикът използва функциите от този модул
+    from .scheduler import get_analysis_scheduler
+    return await get_analysis_scheduler().submit(image_data, camera_id)
+
+def build_local_result(estimate: Dict[str, Any], timestamp: datetime, camera_id: str = "default") -> AnalysisResult:
+    """Създава AnalysisResult от локалната оценка"""
+    return AnalysisResult(
+        timestamp=timestamp,
+        camera_id=camera_id,
+        cloud_coverage=estimate["cloud_coverage"],
+        weather_conditions=estimate["weather_conditions"],
+        confidence=estimate["confidence"],
+        analysis_time=estimate["analysis_time"],
+        brightness=estimate["brightness"],
+        visibility=estimate["visibility"],
+        raw_response=estimate,
+        source="local"
+    )
+
+def local_estimate_is_enough(estimate: Optional[Dict[str, Any]]) -> bool:
+    """Решава дали локалната оценка е достатъчна или е нужен отдалечен анализ"""
+    config = get_analysis_config()
+    
+    if estimate is None or config.analysis_engine == "anthropic":
+        return False
+    if config.analysis_engine == "local" or not os.getenv("ANTHROPIC_API_KEY"):
+        return True
+    
+    # hybrid - API се използва само когато локалната оценка е несигурна
+    return estimate["confidence"] >= config.local_confidence_threshold
+
+def analysis_outcome(result: AnalysisResult) -> str:
+    """Вид на резултата за метриките: error, local, cached, reused или api"""
+    if result.error:
+        return "error"
+    if result.source == "local":
+        return "local"
+    if result.cached:
+        return "cached"
+    if result.reused_from is not None:
+        return "reused"
+    return "api"
+
+async def perform_image_analysis(camera_id: str = "default", image_data: Optional[bytes] = None) -> AnalysisResult:
+    """
+    Изпълнява целия процес на анализ на изображение
+    
+    Args:
+        camera_id: Източник от analysis_sources (по подразбиране image_url)
+        image_data: Кадър, получен от capture; без него изображението се чете от източника
+    
+    Returns:
+        AnalysisResult обект с резултата от анализа
+    """
+    started = time.perf_counter()
+    result = await _analyze_image(camera_id, image_data)
+    ANALYSIS_SECONDS.observe(time.perf_counter() - started, camera=camera_id, outcome=analysis_outcome(result))
+    return result
+
+async def _analyze_image(camera_id: str, image_data: Optional[bytes]) -> AnalysisResult:
+    """Стъпките на perform_image_analysis()"""
+    config = get_analysis_config()
+    image_url = get_analysis_sources().get(camera_id, config.image_url)
+    
+    # Създаваме начален обект за резултата
+    result = AnalysisResult(
+        timestamp=datetime.now(),
+        camera_id=camera_id
+    )
+    
+    try:
+        # Последният кадър от споделената памет, ако камерата се извлича от друг процес
+        if image_data is None:
+            ring = open_ring(camera_id)
+            shared = ring.read_jpeg() if ring is not None else None
+            if shared is not None:
+                image_data = shared[2]
+        
+        # Изтегляме/четем изображението, ако не е подаден кадър от capture
+        if image_data is None:
+            image_data = await download_image(image_url)
+        
+        if not image_data:
+            logger.error(f"Не може да се прочете/изтегли изображение от {image_url}")
+            result.weather_conditions = "Не може да се прочете/изтегли изображение"
+            result.error = "download"
+            update_analysis_config(status="error")
+            return result
+        
+        # Локална оценка - милисекунди на CPU, без мрежа
+        estimate = None
+        if config.analysis_engine in ("local", "hybrid"):
+            estimate = await asyncio.to_thread(estimate_sky, image_data, config.local_cloud_ratio)
+            if local_estimate_is_enough(estimate):
+                result = build_local_result(estimate, result.timestamp, camera_id)
+                update_analysis_config(status="ok")
+                logger.info(
+                    f"Локална оценка: {result.weather_conditions} (облачност: {result.cloud_coverage}%, "
+                    f"увереност: {result.confidence}%, {result.analysis_time * 1000:.1f} ms)"
+                )
+                return result
+        
+        detector = get_change_detector(camera_id)
+        signature = await asyncio.to_thread(compute_signature, image_data)
+        
+        # Същото изображение със същите настройки вече е анализирано
+        # Резултатите от групови заявки (BATCH_PROMPT) се пазят под отделен ключ
+        cache = get_analysis_cache()
+        variant = preprocessing_signature()
+        cache_key = make_cache_key(
+            image_data, config.anthropic_model, ANALYSIS_PROMPT, config.temperature, config.max_tokens,
+            variant=variant
+        )
+        batch_cache_key = make_cache_key(
+            image_data, config.anthropic_model, ANALYSIS_PROMPT, config.temperature, config.max_tokens,
+            variant=f"{variant}|batch"
+        )
+        analysis = await asyncio.to_thread(cache.get, cache_key)
+        if analysis is None and config.analysis_batch_size > 1:
+            analysis = await asyncio.to_thread(cache.get, batch_cache_key)
+        
+        if analysis is not None:
+            logger.info("Резултатът е взет от кеша на анализите")
+            analysis = {**analysis, "analysis_time": 0.0}
+            result.cached = True
+        else:
+            # Пропускаме платения анализ, ако кадърът не се е променил от последния анализ
+            previous = detector.find_reusable(signature)
+            if previous is not None:
+                result = previous.model_copy(update={
+                    "timestamp": result.timestamp,
+                    "analysis_time": 0.0,
+                    "reused_from": previous.reused_from or previous.timestamp
+                })
+                update_analysis_config(status="ok")
+                return result
+            
+            # Анализираме изображението
+            success, analysis = await request_remote_analysis(image_data, camera_id)
+            
+            if not success:
+                logger.error(f"Грешка при анализ на изображението: {analysis.get('error', 'Unknown error')}")
+                result.weather_conditions = f"Грешка при анализ: {analysis.get('error', 'Unknown error')}"
+                result.error = analysis.get("error", "Unknown error")
+                update_analysis_config(status="error")
+                return result
+            
+            await asyncio.to_thread(cache.put, batch_cache_key if analysis.get("batch_size") else cache_key, analysis)
+        
+        # Обновяваме резултата с данните от анализа
+        result.cloud_coverage = float(analysis.get("cloud_coverage", 0))
+        result.cloud_type = analysis.get("cloud_type", "")
+        result.weather_conditions = analysis.get("weather_conditions", "")
+        result.confidence = float(analysis.get("confidence", 0))
+        result.analysis_time = float(analysis.get("analysis_time", 0))
+        result.full_analysis = analysis.get("full_analysis", "")
+        result.visibility = analysis.get("visibility")
+        result.brightness = estimate["brightness"] if estimate else None
+        result.raw_response = analysis
+        
+        # Обновяваме статуса
+        update_analysis_config(status="ok")
+        detector.remember(signature, result)
+        
+        logger.info(f"Успешен анализ: {result.weather_conditions} (облачност: {result.cloud_coverage}%, тип: {result.cloud_type})")
+        
+        return result
+    
+    except Exception as e:
+        logger.error(f"Неочаквана грешка при анализ: {e}")
+        result.weather_conditions = f"Неочаквана грешка: {str(e)}"
+        result.error = str(e)
+        update_analysis_config(status="error")
+        return result
+
+async def perform_sources_analysis(frames: Optional[Dict[str, Optional[bytes]]] = None) -> List[AnalysisResult]:
+    """
+    Анализира няколко източника едновременно
+    
+    При analysis_batch_size > 1 отдалечените анализи се събират в общи заявки.
+    
+    Args:
+        frames: camera_id -> кадър от capture (None - чете се източникът);
+            по подразбиране всички източници
+    """
+    if frames is None:
+        frames = dict.fromkeys(get_analysis_sources())
+    
+    return await asyncio.gather(*(
+        perform_image_analysis(camera_id, image_data) for camera_id, image_data in frames.items()
+    ))
+
+def collect_due_frames(queue: Optional[StageQueue], due_at: Dict[str, float]) -> Dict[str, Optional[bytes]]:
+    """
+    Изчаква до секунда и връща изображенията, на които им е ред за анализ
+    
+    Кадър от capture се анализира веднага, ако на камерата ѝ е дошъл редът.
+    Изображението се чете от източника (стойност None), когато източникът не
+    получава кадри от capture или нов кадър не е дошъл до analysis_frame_wait.
+    
+    Args:
+        queue: Опашката на етапа за анализ (None - режим "interval")
+        due_at: camera_id -> monotonic време, от което камерата е на ред
+    """
+    config = get_analysis_config()
+    sources = get_analysis_sources()
+    frames: Dict[str, Optional[bytes]] = {}
+    
+    if queue is None:
+        time.sleep(1.0)
+        events = []
+    else:
+        event = queue.get(timeout=1.0)
+        # Кадрите на няколко камери, пристигнали заедно, се анализират заедно
+        events = [event] + queue.drain() if event is not None else []
+    
+    now = time.monotonic()
+    for event in events:
+        if event.camera_id in sources and now >= due_at.get(event.camera_id, now):
+            frames[event.camera_id] = event.data
+    
+    bus = get_event_bus()
+    for camera_id in sources:
+        due = due_at.setdefault(camera_id, now)
+        if camera_id in frames or now < due:
+            continue
+        if queue is None or bus.seconds_since_event(camera_id) is None or now - due >= config.analysis_frame_wait:
+            frames[camera_id] = None
+    
+    return frames
+
+def analysis_loop():
+    """
+    Основен цикъл за анализ на изображения
+    
+    В режим "frame" цикълът е етап от шината за събития: нов кадър от capture
+    се анализира веднага (ако на камерата ѝ е дошъл редът по analysis_interval),
+    без да се чете latest.jpg от диска. В режим "interval" изображенията се
+    четат от източниците по таймер.
+    """
+    config = get_analysis_config()
+    
+    # Един постоянен event loop за целия живот на thread-а, за да се запазват
+    # отворените HTTP връзки между анализите
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    
+    bus = get_event_bus()
+    queue = None
+    if config.analysis_trigger == "frame":
+        # За анализа е важен само най-новият кадър - по-старите се изхвърлят
+        queue = bus.subscribe(ANALYSIS_STAGE, config.analysis_queue_size, DROP_OLDEST)
+    due_at: Dict[str, float] = {}
+    
+    try:
+        while config.running:
+            frames = collect_due_frames(queue, due_at)
+            if frames:
+                try:
+                    # Изпълняваме анализ асинхронно за всички източници на ред
+                    results = loop.run_until_complete(perform_sources_analysis(frames))
+                    
+                    # Добавяме резултатите в историята
+                    for result in results:
+                        add_analysis_result(result)
+                    
+                except Exception as e:
+                    logger.error(f"Неочаквана грешка в analysis_loop: {e}")
+                
+                # Следващият анализ на тези камери е след analysis_interval
+                next_due = time.monotonic() + get_analysis_config().analysis_interval
+                for camera_id in frames:
+                    due_at[camera_id] = next_due
+            
+            # Обновяваме конфигурацията (за случай, че е променена)
+            config = get_analysis_config()
+    finally:
+        if queue is not None:
+            bus.unsubscribe(ANALYSIS_STAGE, queue)
+        loop.run_until_complete(get_http_client().aclose())
+        loop.close()
+
+def start_analysis_thread():
+    """Стартира фонов процес за анализ на изображения"""
+    global analysis_thread
+    
+    # Ако предишният thread още не е излязъл след спиране, той продължава да работи
+    update_analysis_config(running=True)
+    
+    if analysis_thread is None or not analysis_thread.is_alive():
+        analysis_thread = threading.Thread(target=analysis_loop)
+        analysis_thread.daemon = True
+        analysis_thread.start()
+        logger.info("Analysis thread started")
+        return True
+    
+    return False
+
+def stop_analysis_thread():
+    """Спира фоновия процес за анализ на изображения"""
+    update_analysis_config(running=False)
+    logger.info("Analysis thread stopping")
+    return True
+
+async def analyze_image_now(camera_id: str = "default") -> AnalysisResult:
+    """Принудително изпълнява анализ на изображение веднага"""
+    result = await perform_image_analysis(camera_id)
+    await asyncio.to_thread(add_analysis_result, result)
+    return result
+
+async def analyze_sources_now() -> List[AnalysisResult]:
+    """Принудително изпълнява анализ на всички източници веднага"""
+    results = await perform_sources_analysis()
+    for result in results:
+        await asyncio.to_thread(add_analysis_result, result)
+    return results
+
+# Функция за инициализиране на модула
+def initialize():
+    """Инициализира модула (извиква се от lifespan на приложението, не при import)"""
+    config = get_analysis_config()
+    
+    # Проверяваме дали имаме API ключ; без него работи само локалната оценка
+    api_key = get_anthropic_api_key()
+    if not api_key:
+        if config.analysis_engine == "anthropic":
+            logger.error("ANTHROPIC_API_KEY не е наличен - Image Analysis модулът не може да бъде инициализиран")
+            update_analysis_config(status="error")
+            return False
+        logger.warning("ANTHROPIC_API_KEY не е наличен - ще се използва само локалната оценка")
+    
+    # Логваме къде се очаква да бъде изображението
+    logger.info(f"Модулът ще анализира изображения от: {config.image_url}")
+    
+    # Проверяваме дали файла съществува в момента
+    if not config.image_url.startswith(('http://', 'https://')):
+        paths_to_try = [
+            config.image_url,
+            os.path.join("/app", config.image_url),
+            os.path.join(os.getcwd(), config.image_url)
+        ]
+        
+        file_exists = False
+        for path in paths_to_try:
+            if os.path.exists(path):
+                logger.info(f"Изображението съществува на път: {path}")
+                file_exists = True
+                break
+                
+        if not file_exists:
+            logger.warning(f"Изображението не съществува в нито един от опитаните пътища: {paths_to_try}")
+            logger.warning("Модулът ще работи, но първоначалният анализ може да се провали")
+    
+    # Възстановяваме последните анализи и тенденциите от постоянната история
+    try:
+        from .trend import warm_from_history
+        load_recent_history()
+        warm_from_history()
+    except Exception as e:
+        logger.error(f"Историята на анализите не може да бъде заредена: {e}")
+    
+    # Thread-ът за анализ се стартира от приложението само в процеса лидер
+    logger.info("Image Analysis модул инициализиран успешно")
+    return True
\ No newline at end of file
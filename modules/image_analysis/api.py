@@ -1,189 +1,485 @@
-"""
-API маршрути за Image Analysis модул
-"""
-
-import os
-import time
-from fastapi import APIRouter, HTTPException, Request, Form
-from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.templating import Jinja2Templates
-from typing import Optional, List
-
-from .config import get_analysis_config, update_analysis_config, get_analysis_history
-from .analyzer import analyze_image_now, start_analysis_thread, stop_analysis_thread
-from utils.logger import setup_logger
-
-# Инициализиране на логър
-logger = setup_logger("image_analysis_api")
-
-# Регистриране на API router
-router = APIRouter()
-
-# Настройване на шаблони
-templates_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "templates")
-templates = Jinja2Templates(directory=templates_dir)
-
-@router.get("/", response_class=HTMLResponse)
-async def analysis_index(request: Request):
-    """Страница за Image Analysis модула"""
-    config = get_analysis_config()
-    history = get_analysis_history(5)  # Последните 5 анализа
-    
-    return templates.TemplateResponse("analysis_index.html", {
-        "request": request,
-        "config": config,
-        "history": history,
-        "timestamp": int(time.time()),
-        "last_update": config.last_analysis_time.strftime("%H:%M:%S") if config.last_analysis_time else "Няма",
-        "status": config.status,
-        "status_text": "OK" if config.status == "ok" else "Грешка" if config.status == "error" else "Инициализация",
-        "has_api_key": bool(os.getenv("ANTHROPIC_API_KEY")),
-        "image_display_url": "/latest.jpg"
-    })
-
-@router.get("/latest")
-async def latest_analysis():
-    """Връща последния резултат от анализа"""
-    config = get_analysis_config()
-    
-    if not config.last_result:
-        return JSONResponse({
-            "status": "no_analysis",
-            "message": "Все още няма извършен анализ"
-        }, status_code=404)
-    
-    # Форматиране на отговора с по-четима структура
-    return JSONResponse({
-        "status": config.status,
-        "timestamp": config.last_result.timestamp.isoformat() if config.last_result.timestamp else None,
-        "cloud_coverage": config.last_result.cloud_coverage,
-        "cloud_type": config.last_result.cloud_type,
-        "weather_conditions": config.last_result.weather_conditions,
-        "confidence": config.last_result.confidence,
-        "analysis_time": config.last_result.analysis_time
-    })
-
-@router.get("/history")
-async def analysis_history(limit: Optional[int] = 10):
-    """Връща историята на анализите"""
-    history = get_analysis_history(limit)
-    
-    if not history:
-        return JSONResponse({
-            "status": "no_history",
-            "message": "Няма налична история на анализите"
-        }, status_code=404)
-    
-    # Форматиране на отговора
-    history_list = []
-    for item in history:
-        history_list.append({
-            "timestamp": item.timestamp.isoformat() if item.timestamp else None,
-            "cloud_coverage": item.cloud_coverage,
-            "cloud_type": item.cloud_type,
-            "weather_conditions": item.weather_conditions,
-            "confidence": item.confidence,
-            "analysis_time": item.analysis_time
-        })
-    
-    return JSONResponse({
-        "status": "ok",
-        "count": len(history_list),
-        "history": history_list
-    })
-
-@router.get("/analyze")
-async def api_analyze():
-    """Принудително извършване на нов анализ"""
-    try:
-        result = await analyze_image_now()
-        
-        return JSONResponse({
-            "status": "ok",
-            "message": "Анализът е успешно извършен",
-            "timestamp": result.timestamp.isoformat() if result.timestamp else None,
-            "cloud_coverage": result.cloud_coverage,
-            "cloud_type": result.cloud_type,
-            "weather_conditions": result.weather_conditions,
-            "confidence": result.confidence,
-            "analysis_time": result.analysis_time
-        })
-    except Exception as e:
-        logger.error(f"Грешка при анализ на изображението: {str(e)}")
-        return JSONResponse({
-            "status": "error",
-            "message": f"Не може да се извърши анализ: {str(e)}"
-        }, status_code=500)
-
-@router.post("/config")
-async def update_config(
-    image_url: str = Form(None),
-    analysis_interval: int = Form(None),
-    anthropic_model: str = Form(None),
-    max_tokens: int = Form(None),
-    temperature: float = Form(None)
-):
-    """Обновява конфигурацията на Image Analysis модула"""
-    update_params = {}
-    
-    if image_url is not None:
-        update_params["image_url"] = image_url
-    
-    if analysis_interval is not None:
-        update_params["analysis_interval"] = analysis_interval
-    
-    if anthropic_model is not None:
-        update_params["anthropic_model"] = anthropic_model
-    
-    if max_tokens is not None:
-        update_params["max_tokens"] = max_tokens
-    
-    if temperature is not None:
-        update_params["temperature"] = temperature
-    
-    # Обновяваме конфигурацията
-    updated_config = update_analysis_config(**update_params)
-    
-    return JSONResponse({
-        "status": "ok",
-        "message": "Конфигурацията е обновена успешно",
-        "config": {
-            "image_url": updated_config.image_url,
-            "analysis_interval": updated_config.analysis_interval,
-            "anthropic_model": updated_config.anthropic_model,
-            "max_tokens": updated_config.max_tokens,
-            "temperature": updated_config.temperature
-        }
-    })
-
-@router.get("/start")
-async def start_analysis():
-    """Стартира процеса за анализ на изображения"""
-    success = start_analysis_thread()
-    
-    if success:
-        return JSONResponse({
-            "status": "ok",
-            "message": "Analysis thread started successfully"
-        })
-    else:
-        return JSONResponse({
-            "status": "warning",
-            "message": "Analysis thread is already running"
-        })
-
-@router.get("/stop")
-async def stop_analysis():
-    """Спира процеса за анализ на изображения"""
-    success = stop_analysis_thread()
-    
-    if success:
-        return JSONResponse({
-            "status": "ok",
-            "message": "Analysis thread stopping"
-        })
-    else:
-        return JSONResponse({
-            "status": "error",
-            "message": "Failed to stop analysis thread"
+"""
+API маршрути за Image Analysis модул
+"""
+
+import os
+import time
+import asyncio
+from datetime import datetime
+from fastapi import APIRouter, HTTPException, Request, Form, Query
+from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.templating import Jinja2Templates
+from typing import Optional, List
+
+from .config import get_analysis_config, update_analysis_config, get_analysis_history, get_analysis_sources
+from .analyzer import analyze_image_now, analyze_sources_now, start_analysis_thread, stop_analysis_thread, download_image
+from .batch import get_batch_stats
+from .scheduler import get_analysis_scheduler
+from .history import get_history_store, get_recent_history, BUCKETS
+from .local_estimator import estimate_sky
+from .preprocess import get_preprocess_stats
+from .http_client import get_http_client, HTTP2_AVAILABLE
+from .change_detection import get_change_detection_stats
+from .result_cache import get_analysis_cache
+from utils.logger import setup_logger
+from utils.state import is_leader
+
+# Инициализиране на логър
+logger = setup_logger("image_analysis_api")
+
+# Регистриране на API router
+router = APIRouter()
+
+# Настройване на шаблони
+templates_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "templates")
+templates = Jinja2Templates(directory=templates_dir)
+
+def _require_leader():
+    """Анализите (платените заявки и записът в историята) се изпълняват само в процеса лидер"""
+    if not is_leader():
+        raise HTTPException(status_code=409, detail="Анализите се изпълняват от друг процес (лидер)")
+
+@router.get("/", response_class=HTMLResponse)
+async def analysis_index(request: Request):
+    """Страница за Image Analysis модула"""
+    config = get_analysis_config()
+    history = get_analysis_history(5)  # Последните 5 анализа
+    
+    return templates.TemplateResponse("analysis_index.html", {
+        "request": request,
+        "config": config,
+        "history": history,
+        "timestamp": int(time.time()),
+        "last_update": config.last_analysis_time.strftime("%H:%M:%S") if config.last_analysis_time else "Няма",
+        "status": config.status,
+        "status_text": "OK" if config.status == "ok" else "Грешка" if config.status == "error" else "Инициализация",
+        "has_api_key": bool(os.getenv("ANTHROPIC_API_KEY")),
+        "image_display_url": "/latest.jpg"
+    })
+
+@router.get("/latest")
+async def latest_analysis():
+    """Връща последния резултат от анализа"""
+    config = get_analysis_config()
+    
+    if not config.last_result:
+        return JSONResponse({
+            "status": "no_analysis",
+            "message": "Все още няма извършен анализ"
+        }, status_code=404)
+    
+    # Форматиране на отговора с по-четима структура
+    return JSONResponse({
+        "status": config.status,
+        "camera_id": config.last_result.camera_id,
+        "timestamp": config.last_result.timestamp.isoformat() if config.last_result.timestamp else None,
+        "cloud_coverage": config.last_result.cloud_coverage,
+        "cloud_type": config.last_result.cloud_type,
+        "weather_conditions": config.last_result.weather_conditions,
+        "confidence": config.last_result.confidence,
+        "analysis_time": config.last_result.analysis_time,
+        "reused_from": config.last_result.reused_from.isoformat() if config.last_result.reused_from else None,
+        "cached": config.last_result.cached,
+        "source": config.last_result.source,
+        "brightness": config.last_result.brightness,
+        "visibility": config.last_result.visibility
+    })
+
+@router.get("/history")
+async def analysis_history(
+    limit: Optional[int] = 10,
+    from_time: Optional[datetime] = Query(None, alias="from"),
+    to_time: Optional[datetime] = Query(None, alias="to"),
+    camera_id: Optional[str] = None,
+    bucket: Optional[str] = None,
+    after: Optional[int] = None
+):
+    """
+    Връща историята на анализите
+    
+    Без параметри - последните limit анализа от паметта. С from/to - записите
+    от постоянната история със страниране: следващата страница се взима със
+    същите from/to и after=next_after. С bucket=hour|day - средна облачност за
+    всеки час/ден в интервала.
+    """
+    limit = max(1, min(limit or 10, 1000))
+    
+    if bucket is not None:
+        if bucket not in BUCKETS:
+            raise HTTPException(status_code=400, detail=f"Невалиден интервал за групиране: {bucket}")
+        
+        aggregates = await asyncio.to_thread(
+            get_history_store().aggregate, bucket, from_time, to_time, camera_id, limit
+        )
+        return JSONResponse({
+            "status": "ok",
+            "bucket": bucket,
+            "count": len(aggregates),
+            "aggregates": aggregates
+        })
+    
+    next_after = None
+    history_list = None
+    if from_time is None and to_time is None and after is None:
+        # Колонният буфер връща готови за JSON редове без междинни модели
+        history_list = get_recent_history().rows(limit, camera_id)
+        
+        # Кръговият буфер не стига - четем от постоянната история
+        if len(history_list) < limit and not camera_id:
+            history = await asyncio.to_thread(get_history_store().latest, limit)
+            if len(history) > len(history_list):
+                history_list = None
+    else:
+        history = await asyncio.to_thread(get_history_store().query, from_time, to_time, camera_id, limit, after)
+        
+        # Следващата страница започва след (време, номер) на последния върнат запис
+        if len(history) == limit:
+            next_after = history[-1].history_id
+    
+    # Форматиране на отговора
+    if history_list is None:
+        history_list = []
+        for item in history:
+            history_list.append({
+                "id": item.history_id,
+                "camera_id": item.camera_id,
+                "timestamp": item.timestamp.isoformat() if item.timestamp else None,
+                "cloud_coverage": item.cloud_coverage,
+                "cloud_type": item.cloud_type,
+                "weather_conditions": item.weather_conditions,
+                "confidence": item.confidence,
+                "analysis_time": item.analysis_time,
+                "source": item.source,
+                "brightness": item.brightness,
+                "visibility": item.visibility,
+                "cached": item.cached,
+                "reused_from": item.reused_from.isoformat() if item.reused_from else None,
+                "error": item.error
+            })
+    
+    if not history_list and from_time is None and to_time is None and after is None:
+        return JSONResponse({
+            "status": "no_history",
+            "message": "Няма налична история на анализите"
+        }, status_code=404)
+    
+    return JSONResponse({
+        "status": "ok",
+        "count": len(history_list),
+        "history": history_list,
+        "next_after": next_after
+    })
+
+@router.get("/history/{history_id}")
+async def analysis_history_item(history_id: int):
+    """Връща един запис от историята заедно с пълния анализ и суровия отговор"""
+    store = get_history_store()
+    result = await asyncio.to_thread(store.get, history_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"Няма анализ с номер {history_id}")
+    
+    # Обемните полета се четат само тук
+    details = await asyncio.to_thread(store.details, history_id) or {}
+    
+    return JSONResponse({
+        "status": "ok",
+        "analysis": {
+            **result.model_dump(mode="json", exclude={"full_analysis", "raw_response"}),
+            "full_analysis": details.get("full_analysis"),
+            "raw_response": details.get("raw_response")
+        }
+    })
+
+@router.get("/trend")
+async def analysis_trend(camera_id: str = "default"):
+    """
+    Тенденции на облачността: плъзгащи се средни (1ч, 6ч, 24ч, 7д), почасови
+    и дневни стойности, точка на промяна и рязко разкъсване/заоблачаване
+    """
+    # Импортира се тук, за да не се зарежда NumPy при стартиране на приложението
+    from .trend import get_trend_tracker
+    
+    tracker = get_trend_tracker()
+    trend = tracker.snapshot(camera_id)
+    
+    if trend is None:
+        return JSONResponse({
+            "status": "no_data",
+            "message": "Няма данни за тенденции",
+            "cameras": tracker.cameras()
+        }, status_code=404)
+    
+    return JSONResponse({
+        "status": "ok",
+        "camera_id": camera_id,
+        **trend
+    })
+
+@router.get("/analyze")
+async def api_analyze(camera_id: str = "default"):
+    """Принудително извършване на нов анализ"""
+    _require_leader()
+    try:
+        result = await analyze_image_now(camera_id)
+        
+        return JSONResponse({
+            "status": "ok",
+            "message": "Анализът е успешно извършен",
+            "camera_id": result.camera_id,
+            "timestamp": result.timestamp.isoformat() if result.timestamp else None,
+            "cloud_coverage": result.cloud_coverage,
+            "cloud_type": result.cloud_type,
+            "weather_conditions": result.weather_conditions,
+            "confidence": result.confidence,
+            "analysis_time": result.analysis_time,
+            "reused_from": result.reused_from.isoformat() if result.reused_from else None,
+            "cached": result.cached,
+            "source": result.source,
+            "brightness": result.brightness,
+            "visibility": result.visibility
+        })
+    except Exception as e:
+        logger.error(f"Грешка при анализ на изображението: {str(e)}")
+        return JSONResponse({
+            "status": "error",
+            "message": f"Не може да се извърши анализ: {str(e)}"
+        }, status_code=500)
+
+@router.get("/analyze-all")
+async def api_analyze_all():
+    """Принудителен анализ на всички източници (групиран при analysis_batch_size > 1)"""
+    _require_leader()
+    try:
+        results = await analyze_sources_now()
+        
+        return JSONResponse({
+            "status": "ok",
+            "message": "Анализът е успешно извършен",
+            "results": [
+                {
+                    "camera_id": result.camera_id,
+                    "timestamp": result.timestamp.isoformat() if result.timestamp else None,
+                    "cloud_coverage": result.cloud_coverage,
+                    "cloud_type": result.cloud_type,
+                    "weather_conditions": result.weather_conditions,
+                    "confidence": result.confidence,
+                    "analysis_time": result.analysis_time,
+                    "source": result.source
+                }
+                for result in results
+            ]
+        })
+    except Exception as e:
+        logger.error(f"Грешка при анализ на източниците: {str(e)}")
+        return JSONResponse({
+            "status": "error",
+            "message": f"Не може да се извърши анализ: {str(e)}"
+        }, status_code=500)
+
+@router.get("/batch")
+async def batch_stats():
+    """Връща настройките и броячите на груповия анализ"""
+    config = get_analysis_config()
+    
+    return JSONResponse({
+        "status": "ok",
+        "batch_size": config.analysis_batch_size,
+        "max_wait": config.analysis_batch_wait,
+        "sources": get_analysis_sources(),
+        "stats": get_batch_stats().snapshot()
+    })
+
+@router.get("/scheduler")
+async def scheduler_stats():
+    """Връща лимитите и броячите на планировчика на заявките към API"""
+    config = get_analysis_config()
+    
+    return JSONResponse({
+        "status": "ok",
+        "limits": {
+            "max_concurrency": config.analysis_max_concurrency,
+            "rate_limit": config.analysis_rate_limit,
+            "rate_burst": config.analysis_rate_burst,
+            "max_retries": config.analysis_max_retries,
+            "backoff_base": config.analysis_backoff_base,
+            "backoff_max": config.analysis_backoff_max
+        },
+        "priorities": config.analysis_priorities,
+        "stats": get_analysis_scheduler().snapshot()
+    })
+
+@router.get("/local")
+async def local_estimate():
+    """Бърза локална оценка на текущия кадър, без заявка към API и без запис в историята"""
+    config = get_analysis_config()
+    image_data = await download_image(config.image_url)
+    
+    if not image_data:
+        return JSONResponse({
+            "status": "error",
+            "message": f"Не може да се прочете изображение от {config.image_url}"
+        }, status_code=404)
+    
+    estimate = await asyncio.to_thread(estimate_sky, image_data, config.local_cloud_ratio)
+    if estimate is None:
+        return JSONResponse({
+            "status": "error",
+            "message": "Изображението не може да бъде декодирано"
+        }, status_code=422)
+    
+    return JSONResponse({
+        "status": "ok",
+        "source": "local",
+        **estimate
+    })
+
+@router.get("/preprocess")
+async def preprocess_stats():
+    """Връща настройките и спестения обем от подготовката на изображенията"""
+    config = get_analysis_config()
+    
+    return JSONResponse({
+        "status": "ok",
+        "enabled": config.preprocess,
+        "max_side": config.preprocess_max_side,
+        "jpeg_quality": config.preprocess_jpeg_quality,
+        "crop": config.preprocess_crop or None,
+        "stats": get_preprocess_stats().snapshot()
+    })
+
+@router.get("/change-detection")
+async def change_detection_stats():
+    """Връща статистика за пропуснатите анализи на непроменени кадри"""
+    config = get_analysis_config()
+    
+    return JSONResponse({
+        "status": "ok",
+        "enabled": config.change_detection,
+        "diff_threshold": config.change_diff_threshold,
+        "max_skip_age": config.change_max_skip_age,
+        "stats": get_change_detection_stats()
+    })
+
+@router.get("/cache")
+async def cache_stats():
+    """Връща броячите на кеша на анализите (попадения, пропуски, изхвърляния)"""
+    config = get_analysis_config()
+    
+    return JSONResponse({
+        "status": "ok",
+        "max_entries": config.analysis_cache_size,
+        "ttl": config.analysis_cache_ttl,
+        "disk_dir": config.analysis_cache_dir or None,
+        "stats": get_analysis_cache().snapshot()
+    })
+
+@router.post("/cache/clear")
+async def clear_cache():
+    """Изчиства кеша на анализите"""
+    get_analysis_cache().clear()
+    
+    return JSONResponse({
+        "status": "ok",
+        "message": "Кешът на анализите е изчистен"
+    })
+
+@router.get("/http")
+async def http_metrics():
+    """Връща метриките на споделения HTTP клиент (преизползване на връзки и латентност)"""
+    config = get_analysis_config()
+    
+    return JSONResponse({
+        "status": "ok",
+        "http2": config.http2 and HTTP2_AVAILABLE,
+        "limits": {
+            "max_connections": config.http_max_connections,
+            "max_keepalive": config.http_max_keepalive,
+            "keepalive_expiry": config.http_keepalive_expiry,
+            "timeout": config.http_timeout,
+            "connect_timeout": config.http_connect_timeout
+        },
+        "metrics": get_http_client().metrics.snapshot()
+    })
+
+@router.post("/config")
+async def update_config(
+    image_url: str = Form(None),
+    analysis_interval: int = Form(None),
+    anthropic_model: str = Form(None),
+    max_tokens: int = Form(None),
+    temperature: float = Form(None),
+    analysis_engine: str = Form(None)
+):
+    """Обновява конфигурацията на Image Analysis модула"""
+    update_params = {}
+    
+    if image_url is not None:
+        update_params["image_url"] = image_url
+    
+    if analysis_interval is not None:
+        update_params["analysis_interval"] = analysis_interval
+    
+    if anthropic_model is not None:
+        update_params["anthropic_model"] = anthropic_model
+    
+    if max_tokens is not None:
+        update_params["max_tokens"] = max_tokens
+    
+    if temperature is not None:
+        update_params["temperature"] = temperature
+    
+    if analysis_engine is not None:
+        if analysis_engine not in ("anthropic", "local", "hybrid"):
+            raise HTTPException(status_code=400, detail=f"Невалиден режим на анализ: {analysis_engine}")
+        update_params["analysis_engine"] = analysis_engine
+    
+    # Обновяваме конфигурацията
+    updated_config = update_analysis_config(**update_params)
+    
+    return JSONResponse({
+        "status": "ok",
+        "message": "Конфигурацията е обновена успешно",
+        "config": {
+            "image_url": updated_config.image_url,
+            "analysis_interval": updated_config.analysis_interval,
+            "anthropic_model": updated_config.anthropic_model,
+            "max_tokens": updated_config.max_tokens,
+            "temperature": updated_config.temperature,
+            "analysis_engine": updated_config.analysis_engine
+        }
+    })
+
+@router.get("/start")
+async def start_analysis():
+    """Стартира процеса за анализ на изображения"""
+    _require_leader()
+    
+    success = start_analysis_thread()
+    
+    if success:
+        return JSONResponse({
+            "status": "ok",
+            "message": "Analysis thread started successfully"
+        })
+    else:
+        return JSONResponse({
+            "status": "warning",
+            "message": "Analysis thread is already running"
+        })
+
+@router.get("/stop")
+async def stop_analysis():
+    """Спира процеса за анализ на изображения"""
+    _require_leader()
+    success = stop_analysis_thread()
+    
+    if success:
+        return JSONResponse({
+            "status": "ok",
+            "message": "Analysis thread stopping"
+        })
+    else:
+        return JSONResponse({
+            "status": "error",
+            "message": "Failed to stop analysis thread"
         }, status_code=500)
\ No newline at end of file
@@ -0,0 +1,265 @@
+"""
+Групов анализ на няколко изображения в една заявка към Anthropic API
+
+При няколко камери всяко изображение иначе става отделна заявка със свое
+копие на дългия prompt. AnalysisBatcher събира изображенията, подадени в
+рамките на analysis_batch_wait секунди (или до analysis_batch_size броя), и
+ги изпраща в едно съобщение; отговорът е JSON масив с по един обект на
+изображение, който се разпределя обратно към чакащите заявки.
+"""
+
+import json
+import time
+import asyncio
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from .config import get_analysis_config
+from .analyzer import (
+    ANALYSIS_PROMPT,
+    API_LATENCY_SECONDS,
+    PARSE_FAILURES_TOTAL,
+    analyze_image_with_anthropic,
+    encode_image_base64,
+    get_anthropic_api_key
+)
+from .http_client import get_http_client, parse_retry_after
+from .preprocess import preprocess_for_api
+from .scheduler import get_analysis_scheduler
+from utils.logger import setup_logger
+
+# Инициализиране на логър
+logger = setup_logger("analysis_batch")
+
+# Горна граница на max_tokens за групова заявка
+_MAX_BATCH_TOKENS = 4096
+
+BATCH_PROMPT = """
+Ще получиш {count} изображения от метеорологични камери, номерирани от 0 до {last}.
+Анализирай ВСЯКО изображение поотделно по инструкциите по-долу.
+Отговори САМО с JSON масив от {count} обекта в реда на изображенията. Всеки обект
+съдържа полето "image" с номера на изображението и полетата от описания формат.
+Указанието за един JSON обект се отнася за всеки елемент на масива.
+"""
+
+AnalysisOutcome = Tuple[bool, Dict[str, Any]]
+
+def parse_batch_response(content: str, count: int) -> List[AnalysisOutcome]:
+    """Разпределя JSON масива от отговора по изображения"""
+    start_idx = content.find('[')
+    end_idx = content.rfind(']') + 1
+    if start_idx < 0 or end_idx <= start_idx:
+        error = {"error": "Не е намерен валиден JSON масив в отговора", "raw_response": content}
+        PARSE_FAILURES_TOTAL.inc(mode="batch")
+        return [(False, error)] * count
+
+    try:
+        items = json.loads(content[start_idx:end_idx])
+    except Exception as e:
+        error = {"error": f"Грешка при обработка на JSON: {e}", "raw_response": content}
+        PARSE_FAILURES_TOTAL.inc(mode="batch")
+        return [(False, error)] * count
+
+    outcomes: List[AnalysisOutcome] = [(False, {"error": "Липсва резултат за изображението"})] * count
+    for position, item in enumerate(items):
+        if not isinstance(item, dict):
+            continue
+        index = item.get("image", position)
+        if isinstance(index, int) and 0 <= index < count:
+            outcomes[index] = (True, item)
+    return outcomes
+
+async def analyze_images_with_anthropic(images: List[bytes]) -> List[AnalysisOutcome]:
+    """
+    Анализира няколко изображения с една заявка към Anthropic API
+
+    Returns:
+        Списък от (успех, резултат) в реда на изображенията
+    """
+    config = get_analysis_config()
+    api_key = get_anthropic_api_key()
+
+    if not api_key:
+        return [(False, {"error": "Липсва Anthropic API ключ"})] * len(images)
+
+    try:
+        prepared = await asyncio.gather(*(asyncio.to_thread(preprocess_for_api, image) for image in images))
+
+        content: List[Dict[str, Any]] = [{
+            "type": "text",
+            "text": BATCH_PROMPT.format(count=len(images), last=len(images) - 1) + ANALYSIS_PROMPT
+        }]
+        for index, image_data in enumerate(prepared):
+            content.append({"type": "text", "text": f"Изображение {index}:"})
+            content.append({
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": "image/jpeg",
+                    "data": encode_image_base64(image_data)
+                }
+            })
+
+        payload = {
+            "model": config.anthropic_model,
+            "messages": [{"role": "user", "content": content}],
+            "max_tokens": min(config.max_tokens * len(images), _MAX_BATCH_TOKENS),
+            "temperature": config.temperature
+        }
+
+        logger.info(f"Изпращане на групова заявка към Anthropic API с {len(images)} изображения")
+        start_time = time.time()
+
+        response = await get_http_client().request(
+            "POST",
+            config.anthropic_api_url,
+            json=payload,
+            headers={
+                "x-api-key": api_key,
+                "anthropic-version": "2023-06-01",
+                "content-type": "application/json"
+            },
+            timeout=config.http_timeout
+        )
+
+        elapsed_time = time.time() - start_time
+        logger.info(f"Получен групов отговор от Anthropic API за {elapsed_time:.2f} секунди")
+        API_LATENCY_SECONDS.observe(elapsed_time, mode="batch", status=response.status_code)
+
+        if response.status_code != 200:
+            logger.error(f"Грешка от Anthropic API: {response.status_code} - {response.text}")
+            error = {
+                "error": f"Грешка от Anthropic API: {response.status_code}",
+                "details": response.text,
+                "status_code": response.status_code,
+                "retry_after": parse_retry_after(response.headers.get("retry-after"))
+            }
+            return [(False, error)] * len(images)
+
+        result = response.json()
+        if not result.get("content"):
+            return [(False, {"error": "Празен отговор от Anthropic API", "raw_response": result})] * len(images)
+
+        text = result["content"][0].get("text", "")
+        outcomes = parse_batch_response(text, len(images))
+        for success, analysis in outcomes:
+            if success:
+                analysis["full_analysis"] = json.dumps(analysis, ensure_ascii=False)
+                analysis["analysis_time"] = elapsed_time
+                analysis["batch_size"] = len(images)
+        return outcomes
+
+    except Exception as e:
+        logger.error(f"Неочаквана грешка при групов анализ: {e}")
+        error = {"error": f"Неочаквана грешка: {e}", "retryable": isinstance(e, httpx.TransportError)}
+        return [(False, error)] * len(images)
+
+class BatchStats:
+    """Броячи за груповите заявки"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.images = 0
+        self.largest = 0
+
+    def record(self, size: int):
+        """Записва една изпратена група"""
+        with self._lock:
+            self.batches += 1
+            self.images += size
+            self.largest = max(self.largest, size)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Връща текущите броячи"""
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "images": self.images,
+                "largest": self.largest,
+                "requests_saved": self.images - self.batches,
+                "avg_batch_size": self.images / self.batches if self.batches else 0.0
+            }
+
+class AnalysisBatcher:
+    """Събира изображения от един event loop и ги изпраща на групи"""
+
+    def __init__(self, stats: BatchStats):
+        self._stats = stats
+        self._pending: List[Tuple[bytes, asyncio.Future, int]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()  # Пазим референции към изпращащите задачи до приключването им
+
+    async def submit(self, image_data: bytes, priority: int = 10) -> AnalysisOutcome:
+        """Добавя изображение в текущата група и чака неговия резултат"""
+        loop = asyncio.get_running_loop()
+        config = get_analysis_config()
+        future = loop.create_future()
+        self._pending.append((image_data, future, priority))
+
+        if len(self._pending) >= config.analysis_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(config.analysis_batch_wait, self._flush)
+
+        return await future
+
+    def _flush(self):
+        """Изпраща събраните изображения"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: List[Tuple[bytes, asyncio.Future, int]]):
+        """Изпълнява заявката през планировчика и разпределя резултатите"""
+        images = [image_data for image_data, _, _ in batch]
+        priority = min(item_priority for _, _, item_priority in batch)
+        self._stats.record(len(images))
+
+        error = {"error": "Липсва резултат за изображението"}
+        try:
+            if len(images) == 1:
+                outcomes = [await get_analysis_scheduler().run(priority, lambda: analyze_image_with_anthropic(images[0]))]
+            else:
+                outcomes = await get_analysis_scheduler().run(priority, lambda: analyze_images_with_anthropic(images))
+
+            for (_, future, _), outcome in zip(batch, outcomes):
+                if not future.done():
+                    future.set_result(outcome)
+        except Exception as e:
+            logger.error(f"Грешка при изпращане на групата: {e}")
+            error = {"error": f"Неочаквана грешка: {e}", "retryable": isinstance(e, httpx.TransportError)}
+        finally:
+            # Никой от чакащите в submit() не трябва да остане без резултат
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_result((False, error))
+
+# Групиращи обекти по event loop и общи броячи
+_stats = BatchStats()
+_batchers: Dict[asyncio.AbstractEventLoop, AnalysisBatcher] = {}
+_batchers_lock = threading.Lock()
+
+def get_analysis_batcher() -> AnalysisBatcher:
+    """Връща групиращия обект за текущия event loop"""
+    loop = asyncio.get_running_loop()
+
+    with _batchers_lock:
+        batcher = _batchers.get(loop)
+        if batcher is None:
+            batcher = _batchers[loop] = AnalysisBatcher(_stats)
+            for other_loop in [other for other in _batchers if other.is_closed()]:
+                _batchers.pop(other_loop, None)
+        return batcher
+
+def get_batch_stats() -> BatchStats:
+    """Връща броячите на груповите заявки"""
+    return _stats
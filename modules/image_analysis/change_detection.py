@@ -0,0 +1,121 @@
+"""
+Откриване на промяна между кадрите преди платения анализ
+
+Кадърът се декодира в намален grayscale вариант (1/8 от размера директно от
+JPEG декодера), свива се до 32x32 и се сравнява с последния анализиран кадър
+по средна абсолютна разлика. Перцептивни хешове (dHash) не се използват, защото
+при гладко небе са чувствителни към шум, а сравнението на намалените кадри - не.
+Ако сцената на практика не се е променила (нощ, мъгла, застинала камера),
+предишният резултат се преизползва вместо нова заявка към API.
+"""
+
+import hashlib
+import threading
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from pydantic import BaseModel
+
+from .config import get_analysis_config, AnalysisResult
+from utils.logger import setup_logger
+
+# Инициализиране на логър
+logger = setup_logger("change_detection")
+
+# Размер на намаленото изображение за сравнение
+_SIGNATURE_SIZE = 32
+
+class FrameSignature(BaseModel):
+    """Отпечатък на кадър за бързо сравнение"""
+    digest: str  # Хеш на байтовете (идентичен файл)
+    thumbnail: bytes  # 32x32 grayscale пиксели
+
+def compute_signature(image_data: bytes) -> Optional[FrameSignature]:
+    """Изчислява отпечатъка на JPEG изображение или връща None при невалидни данни"""
+    import cv2
+    import numpy as np
+
+    buffer = np.frombuffer(image_data, dtype=np.uint8)
+    image = cv2.imdecode(buffer, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if image is None:
+        return None
+
+    thumbnail = cv2.resize(image, (_SIGNATURE_SIZE, _SIGNATURE_SIZE), interpolation=cv2.INTER_AREA)
+
+    return FrameSignature(
+        digest=hashlib.blake2b(image_data, digest_size=16).hexdigest(),
+        thumbnail=thumbnail.tobytes()
+    )
+
+def compare_signatures(a: FrameSignature, b: FrameSignature) -> float:
+    """Връща средната абсолютна разлика (0-255) между два отпечатъка"""
+    import numpy as np
+
+    if a.digest == b.digest:
+        return 0.0
+
+    thumb_a = np.frombuffer(a.thumbnail, dtype=np.uint8).astype(np.int16)
+    thumb_b = np.frombuffer(b.thumbnail, dtype=np.uint8).astype(np.int16)
+    return float(np.abs(thumb_a - thumb_b).mean())
+
+class ChangeDetector:
+    """Пази отпечатъка на последния анализиран кадър и решава дали е нужен нов анализ"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._signature: Optional[FrameSignature] = None
+        self._result: Optional[AnalysisResult] = None
+        self.stats: Dict[str, Any] = {"checked": 0, "skipped": 0, "analyzed": 0, "last_score": None}
+
+    def find_reusable(self, signature: Optional[FrameSignature]) -> Optional[AnalysisResult]:
+        """
+        Връща предишния резултат, ако кадърът на практика е същият като последния анализиран
+
+        Резултатът не се преизползва, ако е по-стар от change_max_skip_age секунди,
+        за да не губим актуалност при продължително еднаква сцена.
+        """
+        config = get_analysis_config()
+
+        with self._lock:
+            self.stats["checked"] += 1
+            if not config.change_detection or signature is None or self._signature is None or self._result is None:
+                return None
+
+            score = compare_signatures(signature, self._signature)
+            self.stats["last_score"] = score
+
+            age = (datetime.now() - self._result.timestamp).total_seconds()
+            if age > config.change_max_skip_age:
+                return None
+
+            if score <= config.change_diff_threshold:
+                self.stats["skipped"] += 1
+                logger.info(f"Кадърът не е променен (разлика {score:.2f}) - преизползваме предишния анализ")
+                return self._result
+
+        return None
+
+    def remember(self, signature: Optional[FrameSignature], result: AnalysisResult):
+        """Запомня отпечатъка и резултата от успешен анализ"""
+        with self._lock:
+            self.stats["analyzed"] += 1
+            if signature is not None:
+                self._signature = signature
+                self._result = result
+
+# Детектори по камера - всяка камера се сравнява само със своите кадри
+_detectors: Dict[str, ChangeDetector] = {}
+_detectors_lock = threading.Lock()
+
+def get_change_detector(camera_id: str = "default") -> ChangeDetector:
+    """Връща детектора на промени за камерата"""
+    with _detectors_lock:
+        detector = _detectors.get(camera_id)
+        if detector is None:
+            detector = _detectors[camera_id] = ChangeDetector()
+        return detector
+
+def get_change_detection_stats() -> Dict[str, Dict[str, Any]]:
+    """Връща статистиката на всички детектори по камера"""
+    with _detectors_lock:
+        return {camera_id: dict(detector.stats) for camera_id, detector in _detectors.items()}
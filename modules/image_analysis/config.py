@@ -1,89 +1,270 @@
-"""
-Конфигурация на Image Analysis модул
-"""
-
-import os
-from pydantic import BaseModel
-from datetime import datetime
-from typing import Optional, List, Dict, Any
-
-class AnalysisResult(BaseModel):
-    """Модел за резултата от анализа"""
-    timestamp: datetime
-    cloud_coverage: float = 0.0  # Процент облачност (0-100)
-    cloud_type: str = ""  # Тип облаци
-    weather_conditions: str = ""  # Описание на метеорологичните условия
-    confidence: float = 0.0  # Увереност в анализа (0-100)
-    analysis_time: float = 0.0  # Време за анализ в секунди
-    full_analysis: Optional[str] = None  # Пълен анализ
-    raw_response: Optional[Dict[str, Any]] = None  # Оригинален отговор от API
-
-class ImageAnalysisConfig(BaseModel):
-    """Конфигурационен модел за Image Analysis"""
-    image_url: str = "frames/latest.jpg"  # Локален път по подразбиране
-    anthropic_api_url: str = "https://api.anthropic.com/v1/messages"
-    anthropic_model: str = "claude-3-haiku-20240307"  # По-малък модел за по-бързи отговори
-    max_tokens: int = 1000
-    temperature: float = 0.2
-    analysis_interval: int = 300  # Интервал между анализите в секунди
-    last_analysis_time: Optional[datetime] = None
-    last_result: Optional[AnalysisResult] = None
-    analysis_history: List[AnalysisResult] = []
-    status: str = "initializing"
-    running: bool = True
-    max_history_items: int = 20  # Максимален брой запазени анализи
-
-# Определяме правилния път до файловете на базата на средата
-def get_image_path():
-    # Проверка дали сме в Docker среда (Hugging Face)
-    if os.path.exists("/app"):
-        base_path = "/app/frames/latest.jpg"
-    else:
-        base_path = "frames/latest.jpg"
-    
-    # Ако е зададен като environment променлива, използваме нея
-    return os.getenv("IMAGE_URL", base_path)
-
-# Глобална конфигурация на модула
-_config = ImageAnalysisConfig(
-    image_url=get_image_path(),
-    anthropic_model=os.getenv("ANTHROPIC_MODEL", "claude-3-haiku-20240307"), 
-    analysis_interval=int(os.getenv("ANALYSIS_INTERVAL", "300"))
-)
-
-def get_analysis_config() -> ImageAnalysisConfig:
-    """Връща текущата конфигурация на модула"""
-    return _config
-
-def update_analysis_config(**kwargs) -> ImageAnalysisConfig:
-    """Обновява конфигурацията с нови стойности"""
-    global _config
-    
-    # Обновяваме само валидните полета
-    for key, value in kwargs.items():
-        if hasattr(_config, key):
-            setattr(_config, key, value)
-    
-    return _config
-
-def add_analysis_result(result: AnalysisResult):
-    """Добавя нов резултат от анализ и поддържа историята"""
-    global _config
-    
-    # Обновяваме последния резултат
-    _config.last_result = result
-    _config.last_analysis_time = result.timestamp
-    
-    # Добавяме в историята
-    _config.analysis_history.append(result)
-    
-    # Ограничаваме размера на историята
-    if len(_config.analysis_history) > _config.max_history_items:
-        _config.analysis_history = _config.analysis_history[-_config.max_history_items:]
-
-def get_analysis_history(limit: int = None) -> List[AnalysisResult]:
-    """Връща историята на анализите с ограничение"""
-    if limit is None or limit <= 0:
-        return _config.analysis_history
-    
-    return _config.analysis_history[-limit:]
\ No newline at end of file
+"""
+Конфигурация на Image Analysis модул
+"""
+
+import os
+from pydantic import BaseModel
+from datetime import datetime
+from typing import Optional, List, Dict, Any
+
+from utils.state import on_refresh, publish_state, read_state
+from utils.logger import setup_logger
+
+# Инициализиране на логър
+logger = setup_logger("analysis_config")
+
+class AnalysisResult(BaseModel):
+    """Модел за резултата от анализа"""
+    timestamp: datetime
+    camera_id: str = "default"  # Източник на изображението (вж. analysis_sources)
+    cloud_coverage: float = 0.0  # Процент облачност (0-100)
+    cloud_type: str = ""  # Тип облаци
+    weather_conditions: str = ""  # Описание на метеорологичните условия
+    confidence: float = 0.0  # Увереност в анализа (0-100)
+    analysis_time: float = 0.0  # Време за анализ в секунди
+    full_analysis: Optional[str] = None  # Пълен анализ
+    raw_response: Optional[Dict[str, Any]] = None  # Оригинален отговор от API
+    reused_from: Optional[datetime] = None  # Време на преизползвания анализ, ако кадърът не е променен
+    cached: bool = False  # Резултатът е взет от кеша на анализите
+    source: str = "anthropic"  # Източник на анализа: "anthropic" или "local"
+    brightness: Optional[float] = None  # Средна яркост на кадъра (0-100)
+    visibility: Optional[str] = None  # Видимост (отлична, добра, умерена, лоша)
+    error: Optional[str] = None  # Описание на грешката, ако анализът е неуспешен
+    history_id: Optional[int] = None  # Номер на записа в постоянната история
+
+class ImageAnalysisConfig(BaseModel):
+    """Конфигурационен модел за Image Analysis"""
+    image_url: str = "frames/latest.jpg"  # Локален път по подразбиране
+    anthropic_api_url: str = "https://api.anthropic.com/v1/messages"
+    anthropic_model: str = "claude-3-haiku-20240307"  # По-малък модел за по-бързи отговори
+    max_tokens: int = 1000
+    temperature: float = 0.2
+    analysis_interval: int = 300  # Интервал между анализите в секунди
+    last_analysis_time: Optional[datetime] = None
+    last_result: Optional[AnalysisResult] = None
+    status: str = "initializing"
+    running: bool = True
+    max_history_items: int = 10000  # Брой последни анализи в паметта (пълната история е в SQLite)
+    http_max_connections: int = 10  # Максимален брой HTTP връзки в пула
+    http_max_keepalive: int = 5  # Максимален брой поддържани (keep-alive) връзки
+    http_keepalive_expiry: float = 120.0  # Секунди, за които неизползвана връзка остава отворена
+    http_timeout: float = 60.0  # Общ таймаут на заявка в секунди
+    http_connect_timeout: float = 10.0  # Таймаут за свързване в секунди
+    http2: bool = True  # HTTP/2, ако пакетът h2 е наличен
+    change_detection: bool = True  # Пропускане на анализа при непроменен кадър
+    change_diff_threshold: float = 3.0  # Максимална средна разлика (0-255) за "непроменен" кадър
+    change_max_skip_age: int = 3600  # След толкова секунди се прави нов анализ въпреки всичко
+    analysis_cache_size: int = 256  # Максимален брой резултати в кеша в паметта
+    analysis_cache_ttl: int = 86400  # Валидност на кеширан резултат в секунди (0 = без изтичане)
+    analysis_cache_dir: str = ""  # Директория за кеша на диска (празно = изключен)
+    analysis_engine: str = "anthropic"  # "anthropic", "local" или "hybrid" (локално, а API само при нужда)
+    local_confidence_threshold: float = 60.0  # Под тази увереност hybrid режимът пита API
+    local_cloud_ratio: float = 0.72  # Праг на съотношението R/B за облачен пиксел
+    preprocess: bool = True  # Намаляване и прекодиране на изображението преди API
+    preprocess_max_side: int = 1024  # Максимална дължина на по-дългата страна в пиксели
+    preprocess_jpeg_quality: int = 85  # JPEG качество на изпратеното изображение
+    preprocess_crop: str = ""  # Област на небето "ляво,горе,дясно,долу" (0-1), празно = целия кадър
+    analysis_sources: Dict[str, str] = {}  # camera_id -> път/URL на изображение; празно = само image_url
+    analysis_batch_size: int = 1  # Брой изображения в една заявка към API (1 = без групиране)
+    analysis_batch_wait: float = 2.0  # Максимално чакане за събиране на група в секунди
+    analysis_max_concurrency: int = 2  # Максимален брой едновременни заявки към API
+    analysis_rate_limit: float = 50.0  # Максимален брой заявки в минута (0 = без ограничение)
+    analysis_rate_burst: int = 5  # Брой заявки, които могат да тръгнат наведнъж
+    analysis_max_retries: int = 4  # Повторни опити при 429/5xx и мрежови грешки
+    analysis_backoff_base: float = 1.0  # Начално изчакване между опитите в секунди
+    analysis_backoff_max: float = 60.0  # Максимално изчакване между опитите в секунди
+    analysis_priorities: Dict[str, int] = {}  # camera_id -> приоритет (по-малко = по-важно, по подразбиране 10)
+    trend_change_threshold: float = 30.0  # Промяна в средната облачност (процентни пункта), която е "рязка"
+    trend_change_window: int = 1800  # Интервал в секунди за сравнение на последните стойности с предходните
+    analysis_trigger: str = "frame"  # "frame" - анализ при нов кадър от capture, "interval" - само по таймер
+    analysis_frame_wait: float = 120.0  # Секунди чакане на нов кадър, преди да се прочете източникът
+    analysis_queue_size: int = 8  # Дължина на опашката с кадри за анализ
+
+# Определяме правилния път до файловете на базата на средата
+def get_image_path():
+    # Проверка дали сме в Docker среда (Hugging Face)
+    if os.path.exists("/app"):
+        base_path = "/app/frames/latest.jpg"
+    else:
+        base_path = "frames/latest.jpg"
+    
+    # Ако е зададен като environment променлива, използваме нея
+    return os.getenv("IMAGE_URL", base_path)
+
+def get_default_engine() -> str:
+    """
+    Режим на анализ по подразбиране: ANALYSIS_ENGINE, ако е зададен, иначе
+    "anthropic" при наличен API ключ и "local" без него. hybrid се включва
+    изрично, защото заменя част от отговорите на модела с локалната оценка.
+    """
+    return os.getenv("ANALYSIS_ENGINE") or ("anthropic" if os.getenv("ANTHROPIC_API_KEY") else "local")
+
+def parse_analysis_priorities(value: str) -> Dict[str, int]:
+    """Разчита "камера=приоритет,камера=приоритет" в речник"""
+    return {camera_id: int(priority) for camera_id, priority in parse_analysis_sources(value).items()}
+
+def parse_analysis_sources(value: str) -> Dict[str, str]:
+    """Разчита "камера=път,камера=URL" в речник"""
+    sources = {}
+    for item in value.split(","):
+        if "=" in item:
+            camera_id, url = item.split("=", 1)
+            sources[camera_id.strip()] = url.strip()
+    return sources
+
+# Глобална конфигурация на модула
+_config = ImageAnalysisConfig(
+    image_url=get_image_path(),
+    anthropic_model=os.getenv("ANTHROPIC_MODEL", "claude-3-haiku-20240307"), 
+    analysis_interval=int(os.getenv("ANALYSIS_INTERVAL", "300")),
+    max_history_items=int(os.getenv("ANALYSIS_HISTORY_ITEMS", "10000")),
+    http_max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "10")),
+    http_max_keepalive=int(os.getenv("HTTP_MAX_KEEPALIVE", "5")),
+    http_keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "120")),
+    http_timeout=float(os.getenv("HTTP_TIMEOUT", "60")),
+    http_connect_timeout=float(os.getenv("HTTP_CONNECT_TIMEOUT", "10")),
+    http2=os.getenv("HTTP2", "1") not in ("0", "false", "False"),
+    change_detection=os.getenv("CHANGE_DETECTION", "1") not in ("0", "false", "False"),
+    change_diff_threshold=float(os.getenv("CHANGE_DIFF_THRESHOLD", "3.0")),
+    change_max_skip_age=int(os.getenv("CHANGE_MAX_SKIP_AGE", "3600")),
+    analysis_cache_size=int(os.getenv("ANALYSIS_CACHE_SIZE", "256")),
+    analysis_cache_ttl=int(os.getenv("ANALYSIS_CACHE_TTL", "86400")),
+    analysis_cache_dir=os.getenv("ANALYSIS_CACHE_DIR", ""),
+    analysis_engine=get_default_engine(),
+    local_confidence_threshold=float(os.getenv("LOCAL_CONFIDENCE_THRESHOLD", "60")),
+    local_cloud_ratio=float(os.getenv("LOCAL_CLOUD_RATIO", "0.72")),
+    preprocess=os.getenv("PREPROCESS", "1") not in ("0", "false", "False"),
+    preprocess_max_side=int(os.getenv("PREPROCESS_MAX_SIDE", "1024")),
+    preprocess_jpeg_quality=int(os.getenv("PREPROCESS_JPEG_QUALITY", "85")),
+    preprocess_crop=os.getenv("PREPROCESS_CROP", ""),
+    analysis_sources=parse_analysis_sources(os.getenv("ANALYSIS_SOURCES", "")),
+    analysis_batch_size=int(os.getenv("ANALYSIS_BATCH_SIZE", "1")),
+    analysis_batch_wait=float(os.getenv("ANALYSIS_BATCH_WAIT", "2.0")),
+    analysis_max_concurrency=int(os.getenv("ANALYSIS_MAX_CONCURRENCY", "2")),
+    analysis_rate_limit=float(os.getenv("ANALYSIS_RATE_LIMIT", "50")),
+    analysis_rate_burst=int(os.getenv("ANALYSIS_RATE_BURST", "5")),
+    analysis_max_retries=int(os.getenv("ANALYSIS_MAX_RETRIES", "4")),
+    analysis_backoff_base=float(os.getenv("ANALYSIS_BACKOFF_BASE", "1.0")),
+    analysis_backoff_max=float(os.getenv("ANALYSIS_BACKOFF_MAX", "60")),
+    analysis_priorities=parse_analysis_priorities(os.getenv("ANALYSIS_PRIORITIES", "")),
+    trend_change_threshold=float(os.getenv("TREND_CHANGE_THRESHOLD", "30")),
+    trend_change_window=int(os.getenv("TREND_CHANGE_WINDOW", "1800")),
+    analysis_trigger=os.getenv("ANALYSIS_TRIGGER", "frame"),
+    analysis_frame_wait=float(os.getenv("ANALYSIS_FRAME_WAIT", "120")),
+    analysis_queue_size=int(os.getenv("ANALYSIS_QUEUE_SIZE", "8"))
+)
+
+# Полета с текущото състояние, които лидерът споделя с останалите процеси
+RUNTIME_FIELDS = ("status", "last_analysis_time", "last_result")
+
+# Номер на последния запис от историята, който е в паметта на процеса
+_replicated_id = 0
+
+def _publish_runtime_state():
+    """Записва текущото състояние на анализа за останалите процеси"""
+    last_result = _config.last_result
+    publish_state("analysis", {
+        "status": _config.status,
+        "last_analysis_time": _config.last_analysis_time.isoformat() if _config.last_analysis_time else None,
+        "last_result": last_result.model_dump(mode="json", exclude={"full_analysis", "raw_response"}) if last_result else None
+    })
+
+def _sync_runtime_state():
+    """
+    В процес, който не анализира, взима състоянието, записано от лидера
+
+    При нов резултат новите записи се четат от общата история и се добавят в
+    паметта и в тенденциите, така че всички процеси връщат едни и същи данни.
+    Извиква се от фоновата нишка на StateRefresher, а не при всяка заявка.
+    """
+    global _replicated_id
+    
+    state = read_state("analysis")
+    if state is None:
+        return
+    
+    _config.status = state["status"]
+    last_result = state["last_result"]
+    if last_result is None or (_config.last_result is not None and _config.last_result.history_id == last_result.get("history_id")):
+        return
+    
+    _config.last_result = AnalysisResult.model_validate(last_result)
+    _config.last_analysis_time = datetime.fromisoformat(state["last_analysis_time"]) if state["last_analysis_time"] else None
+    
+    from .history import get_history_store, get_recent_history
+    from .trend import get_trend_tracker
+    
+    try:
+        for result in get_history_store().after(_replicated_id):
+            get_recent_history().append(result)
+            get_trend_tracker().add(result)
+            _replicated_id = max(_replicated_id, result.history_id)
+    except Exception as e:
+        logger.error(f"Грешка при четене на новите анализи: {e}")
+
+on_refresh(_sync_runtime_state)
+
+def get_analysis_config() -> ImageAnalysisConfig:
+    """Връща текущата конфигурация на модула"""
+    return _config
+
+def get_analysis_sources() -> Dict[str, str]:
+    """Връща изображенията за анализ по камера"""
+    if _config.analysis_sources:
+        return dict(_config.analysis_sources)
+    return {"default": _config.image_url}
+
+def update_analysis_config(**kwargs) -> ImageAnalysisConfig:
+    """Обновява конфигурацията с нови стойности"""
+    global _config
+    
+    # Обновяваме само валидните полета
+    for key, value in kwargs.items():
+        if hasattr(_config, key):
+            setattr(_config, key, value)
+    
+    if any(key in RUNTIME_FIELDS for key in kwargs):
+        _publish_runtime_state()
+    
+    return _config
+
+def add_analysis_result(result: AnalysisResult):
+    """Добавя нов резултат от анализ в паметта и в постоянната история"""
+    global _replicated_id
+    
+    # Импортират се тук, защото модулите използват AnalysisResult от този модул
+    from .history import get_recent_history, persist_result
+    from .trend import get_trend_tracker
+    
+    # Обновяваме последния резултат
+    _config.last_result = result
+    _config.last_analysis_time = result.timestamp
+    
+    # Първо в базата, за да получи номер, после в кръговия буфер
+    persist_result(result)
+    get_recent_history().append(result)
+    get_trend_tracker().add(result)
+    
+    _replicated_id = max(_replicated_id, result.history_id or 0)
+    _publish_runtime_state()
+
+def load_recent_history():
+    """Зарежда последните анализи от постоянната история (след рестарт)"""
+    global _replicated_id
+    
+    from .history import get_history_store, get_recent_history
+    
+    recent = get_recent_history()
+    results = get_history_store().latest(recent.capacity)
+    recent.clear()
+    recent.extend(results)
+    _replicated_id = max((result.history_id or 0 for result in results), default=0)
+    if len(recent):
+        _config.last_result = recent.results(limit=1)[0]
+        _config.last_analysis_time = _config.last_result.timestamp
+
+def get_analysis_history(limit: int = None) -> List[AnalysisResult]:
+    """Връща последните анализи от паметта с ограничение"""
+    from .history import get_recent_history
+    
+    return get_recent_history().results(limit=limit)
\ No newline at end of file
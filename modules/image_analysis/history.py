@@ -0,0 +1,555 @@
+"""
+История на анализите
+
+Постоянната история е в SQLite: всеки резултат се добавя (append-only) в
+таблица с индекси по време и по (камера, време), а обемните полета
+(full_analysis, raw_response) са в отделна таблица и се четат само при нужда.
+Заявките по интервал се страницират по (време, номер) на последния върнат
+запис, така че записи с еднакво време не се губят между страниците, а
+средните стойности по час/ден се изчисляват от SQLite с GROUP BY.
+
+Последните анализи се пазят и в паметта в компактен колонен кръгов буфер
+(CompactHistory): числата са в типизирани масиви, повтарящите се низове
+(включително описанието на условията) са кодирани като индекси в ограничени
+речници, редките и дългите стойности са извън колоните, а суровият текст на
+модела не се пази.
+"""
+
+import os
+import json
+import math
+import sqlite3
+import threading
+from array import array
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from .config import get_analysis_config, AnalysisResult
+from utils.logger import setup_logger
+
+# Инициализиране на логър
+logger = setup_logger("analysis_history")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analyses (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    camera_id TEXT NOT NULL,
+    source TEXT NOT NULL,
+    cloud_coverage REAL NOT NULL,
+    cloud_type TEXT,
+    weather_conditions TEXT,
+    confidence REAL NOT NULL,
+    analysis_time REAL NOT NULL,
+    brightness REAL,
+    visibility TEXT,
+    cached INTEGER NOT NULL DEFAULT 0,
+    reused_from REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_analyses_ts ON analyses (ts);
+CREATE INDEX IF NOT EXISTS idx_analyses_camera_ts ON analyses (camera_id, ts);
+CREATE TABLE IF NOT EXISTS analysis_details (
+    id INTEGER PRIMARY KEY,
+    full_analysis TEXT,
+    raw_response TEXT
+);
+"""
+
+_COLUMNS = (
+    "ts, camera_id, source, cloud_coverage, cloud_type, weather_conditions, confidence, "
+    "analysis_time, brightness, visibility, cached, reused_from, error"
+)
+_SELECT = "id, " + _COLUMNS
+
+# Формати за групиране по местно време
+BUCKETS = {
+    "hour": "%Y-%m-%dT%H:00:00",
+    "day": "%Y-%m-%d"
+}
+
+class AnalysisHistoryStore:
+    """SQLite хранилище на всички резултати от анализа"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    def _to_result(self, row) -> AnalysisResult:
+        """Превръща ред от базата в AnalysisResult (без обемните полета)"""
+        (history_id, ts, camera_id, source, cloud_coverage, cloud_type, weather_conditions, confidence,
+         analysis_time, brightness, visibility, cached, reused_from, error) = row
+        return AnalysisResult(
+            history_id=history_id,
+            timestamp=datetime.fromtimestamp(ts),
+            camera_id=camera_id,
+            source=source,
+            cloud_coverage=cloud_coverage,
+            cloud_type=cloud_type or "",
+            weather_conditions=weather_conditions or "",
+            confidence=confidence,
+            analysis_time=analysis_time,
+            brightness=brightness,
+            visibility=visibility,
+            cached=bool(cached),
+            reused_from=datetime.fromtimestamp(reused_from) if reused_from else None,
+            error=error
+        )
+
+    def append(self, result: AnalysisResult) -> int:
+        """Добавя резултат в историята и връща номера на записа"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                history_id = self._insert(result)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        result.history_id = history_id
+        return history_id
+
+    def _insert(self, result: AnalysisResult) -> int:
+        """Записва реда и обемните полета (извиква се в транзакция)"""
+        cursor = self._conn.execute(
+            f"INSERT INTO analyses ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                result.timestamp.timestamp(),
+                result.camera_id,
+                result.source,
+                result.cloud_coverage,
+                result.cloud_type,
+                result.weather_conditions,
+                result.confidence,
+                result.analysis_time,
+                result.brightness,
+                result.visibility,
+                int(result.cached),
+                result.reused_from.timestamp() if result.reused_from else None,
+                result.error
+            )
+        )
+        history_id = cursor.lastrowid
+
+        if result.full_analysis or result.raw_response:
+            self._conn.execute(
+                "INSERT INTO analysis_details (id, full_analysis, raw_response) VALUES (?, ?, ?)",
+                (
+                    history_id,
+                    result.full_analysis,
+                    json.dumps(result.raw_response, ensure_ascii=False) if result.raw_response else None
+                )
+            )
+        return history_id
+
+    def details(self, history_id: int) -> Optional[Dict[str, Any]]:
+        """Зарежда обемните полета на един запис"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT full_analysis, raw_response FROM analysis_details WHERE id = ?", (history_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"full_analysis": row[0], "raw_response": json.loads(row[1]) if row[1] else None}
+
+    def get(self, history_id: int) -> Optional[AnalysisResult]:
+        """Връща един запис по номер"""
+        with self._lock:
+            row = self._conn.execute(f"SELECT {_SELECT} FROM analyses WHERE id = ?", (history_id,)).fetchone()
+        return self._to_result(row) if row else None
+
+    def count(self) -> int:
+        """Връща броя на записите"""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM analyses").fetchone()[0]
+
+    def latest(self, limit: int = 20) -> List[AnalysisResult]:
+        """Връща последните limit резултата, подредени по време"""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {_SELECT} FROM analyses ORDER BY ts DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [self._to_result(row) for row in reversed(rows)]
+
+    def after(self, history_id: int, limit: int = 1000) -> List[AnalysisResult]:
+        """Връща записите с номер след history_id (добавените от друг процес)"""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {_SELECT} FROM analyses WHERE id > ? ORDER BY id LIMIT ?", (history_id, limit)
+            ).fetchall()
+        return [self._to_result(row) for row in rows]
+
+    def query(
+        self,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        camera_id: Optional[str] = None,
+        limit: int = 100,
+        after_id: Optional[int] = None
+    ) -> List[AnalysisResult]:
+        """
+        Връща резултатите в интервала [start, end), подредени по време и номер
+
+        За следващата страница се подава after_id - номерът на последния
+        резултат; връщат се записите след неговите (време, номер).
+        """
+        sql = f"SELECT {_SELECT} FROM analyses WHERE ts >= ? AND ts < ?"
+        params: List[Any] = [start.timestamp() if start else float("-inf"), end.timestamp() if end else float("inf")]
+        if camera_id:
+            sql += " AND camera_id = ?"
+            params.append(camera_id)
+        if after_id is not None:
+            sql += " AND (ts, id) > (SELECT ts, id FROM analyses WHERE id = ?)"
+            params.append(after_id)
+        sql += " ORDER BY ts, id LIMIT ?"
+        params.append(limit)
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [self._to_result(row) for row in rows]
+
+    def aggregate(
+        self,
+        bucket: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        camera_id: Optional[str] = None,
+        limit: int = 1000
+    ) -> List[Dict[str, Any]]:
+        """
+        Средна облачност по час или ден (местно време), изчислена в SQLite
+
+        Неуспешните анализи не участват в средните стойности.
+        """
+        sql = (
+            "SELECT strftime(?, ts, 'unixepoch', 'localtime') AS period, COUNT(*), "
+            "AVG(cloud_coverage), MIN(cloud_coverage), MAX(cloud_coverage), AVG(confidence), AVG(brightness) "
+            "FROM analyses WHERE ts >= ? AND ts < ? AND error IS NULL"
+        )
+        params: List[Any] = [
+            BUCKETS[bucket],
+            start.timestamp() if start else float("-inf"),
+            end.timestamp() if end else float("inf")
+        ]
+        if camera_id:
+            sql += " AND camera_id = ?"
+            params.append(camera_id)
+        sql += " GROUP BY period ORDER BY period LIMIT ?"
+        params.append(limit)
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+
+        return [
+            {
+                "period": period,
+                "count": count,
+                "cloud_coverage_avg": round(avg_coverage, 1),
+                "cloud_coverage_min": min_coverage,
+                "cloud_coverage_max": max_coverage,
+                "confidence_avg": round(avg_confidence, 1),
+                "brightness_avg": round(avg_brightness, 1) if avg_brightness is not None else None
+            }
+            for period, count, avg_coverage, min_coverage, max_coverage, avg_confidence, avg_brightness in rows
+        ]
+
+# Най-много различни стойности в речника на една колона
+CATEGORY_LIMIT = 1024
+# Най-дълга стойност в речниците (по-дългите се пазят извън колоните)
+CATEGORY_MAX_LENGTH = 64
+CONDITIONS_MAX_LENGTH = 160
+# Код за стойност извън речника - тя е в _spill на слота
+_SPILLED = 0xFFFF
+
+def _normalize(value: Optional[str]) -> Optional[str]:
+    """Премахва излишните интервали, за да не се пазят почти еднакви стойности поотделно"""
+    return " ".join(value.split()) if value is not None else None
+
+class _Categories:
+    """
+    Речник на повтарящи се низове -> малки цели числа (0 = None)
+
+    Речникът е ограничен до limit стойности с дължина до max_length. За
+    стойност, която не се побира, encode връща None.
+    """
+
+    def __init__(self, name: str, limit: int = CATEGORY_LIMIT, max_length: int = CATEGORY_MAX_LENGTH):
+        self.name = name
+        self.limit = min(limit, _SPILLED)
+        self.max_length = max_length
+        self.overflowed = False  # Вече е логнато, че речникът е пълен
+        self._values: List[Optional[str]] = [None]
+        self._codes: Dict[Optional[str], int] = {None: 0}
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    @property
+    def full(self) -> bool:
+        return len(self._values) >= self.limit
+
+    def code(self, value: Optional[str]) -> Optional[int]:
+        """Кодът на вече добавена стойност или None"""
+        return self._codes.get(value)
+
+    def encode(self, value: Optional[str]) -> Optional[int]:
+        code = self._codes.get(value)
+        if code is None:
+            if len(value) > self.max_length or self.full:
+                return None
+            code = self._codes[value] = len(self._values)
+            self._values.append(value)
+        return code
+
+    def decode(self, code: int) -> Optional[str]:
+        return self._values[code]
+
+    def rebuild(self, used: set) -> Dict[int, int]:
+        """Оставя само използваните кодове и връща преномерирането стар -> нов"""
+        mapping = {0: 0}
+        values: List[Optional[str]] = [None]
+        for code in sorted(used - {0, _SPILLED}):
+            mapping[code] = len(values)
+            values.append(self._values[code])
+        self._values = values
+        self._codes = {value: code for code, value in enumerate(values)}
+        return mapping
+
+class CompactHistory:
+    """
+    Кръгов буфер на последните анализи в колонен вид
+
+    Числовите полета са в array масиви, а камерата, източникът, типът облаци,
+    видимостта и описанието на условията са кодирани чрез ограничени речници
+    (_Categories). Речниците не растат безкрайно: при пълен речник се
+    преномерира само с използваните стойности, а ако и това не стига, новата
+    стойност (или твърде дългата) се пази в _spill на слота и се изтрива при
+    презаписването му. full_analysis и raw_response не се пазят - четат се от
+    SQLite по history_id при нужда.
+    """
+
+    # Колона -> поле на AnalysisResult
+    _TEXT_FIELDS = {
+        "camera": "camera_id",
+        "source": "source",
+        "cloud_type": "cloud_type",
+        "visibility": "visibility",
+        "conditions": "weather_conditions"
+    }
+
+    def __init__(self, capacity: int):
+        self.capacity = max(capacity, 1)
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Изчиства буфера"""
+        capacity = self.capacity
+        with self._lock:
+            self._head = 0  # Позиция за следващия запис
+            self._size = 0
+            self._ts = array("d", bytes(8 * capacity))
+            self._history_id = array("q", bytes(8 * capacity))
+            self._coverage = array("f", bytes(4 * capacity))
+            self._confidence = array("f", bytes(4 * capacity))
+            self._analysis_time = array("f", bytes(4 * capacity))
+            self._brightness = array("f", bytes(4 * capacity))  # NaN = няма стойност
+            self._reused_from = array("d", bytes(8 * capacity))  # NaN = няма стойност
+            self._cached = array("b", bytes(capacity))
+            self._text = {column: array("H", bytes(2 * capacity)) for column in self._TEXT_FIELDS}
+            self._categories = {
+                column: _Categories(column, max_length=CONDITIONS_MAX_LENGTH if column == "conditions" else CATEGORY_MAX_LENGTH)
+                for column in self._TEXT_FIELDS
+            }
+            self._spill: Dict[int, Dict[str, str]] = {}  # Позиция -> стойности извън речниците
+            self._error: List[Optional[str]] = [None] * capacity
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _live_positions(self) -> List[int]:
+        """Позициите на записите в буфера (по-старите първи)"""
+        start = (self._head - self._size) % self.capacity
+        return [(start + offset) % self.capacity for offset in range(self._size)]
+
+    def _compact(self, column: str, overwritten: int):
+        """Преномерира речника на колоната само с използваните стойности"""
+        codes = self._text[column]
+        live = [i for i in self._live_positions() if i != overwritten]
+        mapping = self._categories[column].rebuild({codes[i] for i in live})
+        for i in live:
+            if codes[i] != _SPILLED:
+                codes[i] = mapping[codes[i]]
+
+    def _encode(self, column: str, i: int, value: Optional[str]) -> int:
+        """Кодира стойността за позиция i; непобралите се в речника отиват в _spill"""
+        categories = self._categories[column]
+        value = _normalize(value)
+        code = categories.encode(value)
+        if code is None and categories.full:
+            self._compact(column, i)
+            code = categories.encode(value)
+            if code is not None:
+                categories.overflowed = False
+
+        if code is None:
+            if categories.full and not categories.overflowed:
+                categories.overflowed = True
+                logger.warning(
+                    f"Речникът {column} в историята е пълен ({categories.limit} стойности) - "
+                    f"новите стойности се пазят извън колоните"
+                )
+            self._spill.setdefault(i, {})[column] = value
+            return _SPILLED
+        return code
+
+    def _decode(self, column: str, i: int) -> Optional[str]:
+        code = self._text[column][i]
+        if code == _SPILLED:
+            return self._spill[i][column]
+        return self._categories[column].decode(code)
+
+    def append(self, result: AnalysisResult):
+        """Добавя резултат; при пълен буфер най-старият се презаписва"""
+        with self._lock:
+            i = self._head
+            self._spill.pop(i, None)
+            self._ts[i] = result.timestamp.timestamp()
+            self._history_id[i] = result.history_id if result.history_id is not None else -1
+            self._coverage[i] = result.cloud_coverage
+            self._confidence[i] = result.confidence
+            self._analysis_time[i] = result.analysis_time
+            self._brightness[i] = result.brightness if result.brightness is not None else math.nan
+            self._reused_from[i] = result.reused_from.timestamp() if result.reused_from else math.nan
+            self._cached[i] = int(result.cached)
+            for column, field in self._TEXT_FIELDS.items():
+                self._text[column][i] = self._encode(column, i, getattr(result, field))
+            self._error[i] = result.error
+
+            self._head = (i + 1) % self.capacity
+            self._size = min(self._size + 1, self.capacity)
+
+    def extend(self, results: List[AnalysisResult]):
+        """Добавя няколко резултата (подредени по време)"""
+        for result in results:
+            self.append(result)
+
+    def _positions(self, limit: Optional[int], camera_id: Optional[str]) -> List[int]:
+        """Позициите на последните limit записа (по-старите първи)"""
+        positions = self._live_positions()
+
+        if camera_id is not None:
+            camera_id = _normalize(camera_id)
+            code = self._categories["camera"].code(camera_id)
+            camera = self._text["camera"]
+            positions = [
+                i for i in positions
+                if camera[i] == code or (camera[i] == _SPILLED and self._spill[i]["camera"] == camera_id)
+            ]
+
+        if limit is not None and limit > 0:
+            positions = positions[-limit:]
+        return positions
+
+    def rows(self, limit: Optional[int] = None, camera_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Връща записите като речници, готови за JSON (без обемните полета)"""
+        decode = self._decode
+        with self._lock:
+            return [
+                {
+                    "id": self._history_id[i] if self._history_id[i] >= 0 else None,
+                    "camera_id": decode("camera", i),
+                    "timestamp": datetime.fromtimestamp(self._ts[i]).isoformat(),
+                    "cloud_coverage": round(self._coverage[i], 2),
+                    "cloud_type": decode("cloud_type", i),
+                    "weather_conditions": decode("conditions", i),
+                    "confidence": round(self._confidence[i], 2),
+                    "analysis_time": round(self._analysis_time[i], 4),
+                    "source": decode("source", i),
+                    "brightness": None if math.isnan(self._brightness[i]) else round(self._brightness[i], 2),
+                    "visibility": decode("visibility", i),
+                    "cached": bool(self._cached[i]),
+                    "reused_from": None if math.isnan(self._reused_from[i]) else datetime.fromtimestamp(self._reused_from[i]).isoformat(),
+                    "error": self._error[i]
+                }
+                for i in self._positions(limit, camera_id)
+            ]
+
+    def results(self, limit: Optional[int] = None, camera_id: Optional[str] = None) -> List[AnalysisResult]:
+        """Възстановява записите като AnalysisResult (без обемните полета)"""
+        decode = self._decode
+        with self._lock:
+            return [
+                AnalysisResult(
+                    history_id=self._history_id[i] if self._history_id[i] >= 0 else None,
+                    timestamp=datetime.fromtimestamp(self._ts[i]),
+                    camera_id=decode("camera", i),
+                    source=decode("source", i),
+                    cloud_coverage=self._coverage[i],
+                    cloud_type=decode("cloud_type", i) or "",
+                    weather_conditions=decode("conditions", i) or "",
+                    confidence=self._confidence[i],
+                    analysis_time=self._analysis_time[i],
+                    brightness=None if math.isnan(self._brightness[i]) else self._brightness[i],
+                    visibility=decode("visibility", i),
+                    cached=bool(self._cached[i]),
+                    reused_from=None if math.isnan(self._reused_from[i]) else datetime.fromtimestamp(self._reused_from[i]),
+                    error=self._error[i]
+                )
+                for i in self._positions(limit, camera_id)
+            ]
+
+    def memory_bytes(self) -> int:
+        """Приблизителен размер на буфера в паметта"""
+        columns = (
+            self._ts, self._history_id, self._coverage, self._confidence, self._analysis_time,
+            self._brightness, self._reused_from, self._cached, *self._text.values()
+        )
+        arrays = sum(column.itemsize * len(column) for column in columns)
+        categories = sum(
+            len(value) for table in self._categories.values() for value in table._values if value
+        )
+        spilled = sum(len(value) for values in self._spill.values() for value in values.values() if value)
+        errors = sum(len(text) for text in self._error if text)
+        return arrays + categories + spilled + errors + 8 * self.capacity
+
+def persist_result(result: AnalysisResult):
+    """Записва резултата в постоянната история; грешките само се логват"""
+    try:
+        get_history_store().append(result)
+    except Exception as e:
+        logger.error(f"Грешка при запис в историята на анализите: {str(e)}")
+
+def get_history_db_path() -> str:
+    """Път до базата с историята (в Docker средата - под /app)"""
+    base_dir = "/app/data" if os.path.exists("/app") else "data"
+    return os.getenv("ANALYSIS_HISTORY_DB", os.path.join(base_dir, "analysis_history.db"))
+
+def get_recent_history() -> CompactHistory:
+    """Връща кръговия буфер с последните анализи"""
+    return _recent_history
+
+# Последните анализи в паметта
+_recent_history = CompactHistory(get_analysis_config().max_history_items)
+
+# Глобално хранилище на модула (създава се при първо използване)
+_store: Optional[AnalysisHistoryStore] = None
+_store_lock = threading.Lock()
+
+def get_history_store() -> AnalysisHistoryStore:
+    """Връща глобалното хранилище на историята"""
+    global _store
+
+    with _store_lock:
+        if _store is None:
+            db_path = get_history_db_path()
+            _store = AnalysisHistoryStore(db_path)
+            logger.info(f"История на анализите: {db_path}")
+        return _store
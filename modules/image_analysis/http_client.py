@@ -0,0 +1,174 @@
+"""
+Споделен HTTP клиент с пул от връзки за Anthropic API и изтегляне на изображения
+
+httpx.AsyncClient е обвързан с event loop-а, в който е създаден, затова се
+поддържа по един дълготраен клиент за всеки loop (loop-а на uvicorn и
+постоянния loop на фоновия анализатор). Връзките се преизползват между
+заявките (keep-alive, HTTP/2 при наличен h2), а метриките показват колко
+заявки са минали по нова и колко по вече отворена връзка.
+"""
+
+import time
+import asyncio
+import threading
+import importlib.util
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional
+
+import httpx
+
+from .config import get_analysis_config
+from utils.logger import setup_logger
+
+# Инициализиране на логър
+logger = setup_logger("analysis_http")
+
+# HTTP/2 изисква допълнителния пакет h2
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Разчита заглавката Retry-After (секунди или HTTP дата) в секунди"""
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+class HTTPMetrics:
+    """Броячи за преизползване на връзки и латентност"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Нулира метриките"""
+        with self._lock:
+            self.requests = 0
+            self.errors = 0
+            self.new_connections = 0
+            self.latency_total = 0.0
+            self.latency_max = 0.0
+            self.by_host: Dict[str, Dict[str, float]] = {}
+
+    def record(self, host: str, latency: float, new_connection: bool, error: bool = False):
+        """Записва една завършена заявка"""
+        with self._lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.new_connections += int(new_connection)
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+            host_stats = self.by_host.setdefault(host, {"requests": 0, "new_connections": 0, "latency_total": 0.0})
+            host_stats["requests"] += 1
+            host_stats["new_connections"] += int(new_connection)
+            host_stats["latency_total"] += latency
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Връща текущите метрики"""
+        with self._lock:
+            reused = self.requests - self.new_connections
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "new_connections": self.new_connections,
+                "reused_connections": reused,
+                "reuse_ratio": reused / self.requests if self.requests else 0.0,
+                "latency_avg": self.latency_total / self.requests if self.requests else 0.0,
+                "latency_max": self.latency_max,
+                "by_host": {
+                    host: {
+                        "requests": stats["requests"],
+                        "new_connections": stats["new_connections"],
+                        "latency_avg": stats["latency_total"] / stats["requests"]
+                    }
+                    for host, stats in self.by_host.items()
+                }
+            }
+
+class SharedHTTPClient:
+    """Дълготрайни httpx.AsyncClient инстанции - по една на event loop"""
+
+    def __init__(self):
+        self.metrics = HTTPMetrics()
+        self._clients: Dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+        self._lock = threading.Lock()
+
+    def _create_client(self) -> httpx.AsyncClient:
+        """Създава клиент според текущата конфигурация"""
+        config = get_analysis_config()
+        http2 = config.http2 and HTTP2_AVAILABLE
+
+        logger.info(
+            f"Нов HTTP клиент (http2={http2}, max_connections={config.http_max_connections}, "
+            f"keepalive={config.http_max_keepalive})"
+        )
+        return httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=config.http_max_connections,
+                max_keepalive_connections=config.http_max_keepalive,
+                keepalive_expiry=config.http_keepalive_expiry
+            ),
+            timeout=httpx.Timeout(config.http_timeout, connect=config.http_connect_timeout),
+            follow_redirects=True
+        )
+
+    def get_client(self) -> httpx.AsyncClient:
+        """Връща клиента за текущия event loop"""
+        loop = asyncio.get_running_loop()
+
+        with self._lock:
+            client = self._clients.get(loop)
+            if client is None or client.is_closed:
+                client = self._create_client()
+                self._clients[loop] = client
+
+                # Почистваме клиентите на затворени loop-ове
+                for other_loop in [other for other in self._clients if other.is_closed()]:
+                    self._clients.pop(other_loop, None)
+
+            return client
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Изпълнява заявка през споделения клиент и записва метрики"""
+        client = self.get_client()
+        connection = {"new": False}
+
+        async def trace(event_name: str, info: Dict[str, Any]):
+            # httpcore изпраща това събитие само при отваряне на нова TCP връзка
+            if event_name == "connection.connect_tcp.complete":
+                connection["new"] = True
+
+        start_time = time.perf_counter()
+        try:
+            response = await client.request(method, url, extensions={"trace": trace}, **kwargs)
+        except Exception:
+            self.metrics.record(httpx.URL(url).host, time.perf_counter() - start_time, connection["new"], error=True)
+            raise
+
+        self.metrics.record(httpx.URL(url).host, time.perf_counter() - start_time, connection["new"])
+        return response
+
+    async def aclose(self):
+        """Затваря клиента за текущия event loop"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._clients.pop(loop, None)
+        if client is not None:
+            await client.aclose()
+
+# Глобален клиент на модула
+_http_client = SharedHTTPClient()
+
+def get_http_client() -> SharedHTTPClient:
+    """Връща споделения HTTP клиент"""
+    return _http_client
@@ -0,0 +1,117 @@
+"""
+Локална (офлайн) оценка на облачността
+
+Кадърът се декодира в намален размер (1/4 директно от JPEG декодера), след
+което с векторни NumPy/OpenCV операции се отделя небето (ниска текстура,
+достатъчна яркост, без зелена растителност) и всеки пиксел от него се
+класифицира като облак или чисто небе по съотношението червено/синьо: чистото
+небе е силно синьо, а облаците са бели или сиви (R/B близо до 1).
+Оценката отнема няколко милисекунди на CPU и не изисква мрежа.
+"""
+
+import time
+from typing import Any, Dict, Optional
+
+from utils.logger import setup_logger
+
+# Инициализиране на логър
+logger = setup_logger("local_estimator")
+
+# Максимална локална текстура (средна абсолютна Лапласиана) за пиксел от небето
+_SKY_TEXTURE_MAX = 6.0
+# Минимална яркост (0-255) за пиксел от небето
+_SKY_MIN_LEVEL = 40
+# Текстура на земята, която приемаме за "отлична" видимост
+_SHARPNESS_CLEAR = 12.0
+# Около прага на R/B класификацията е несигурна
+_RATIO_MARGIN = 0.08
+# Под тази яркост (0-100) оценката е ненадеждна
+_DARK_LEVEL = 15.0
+
+def _describe(coverage: float) -> str:
+    """Текстово описание на облачността"""
+    if coverage < 10:
+        return "Ясно"
+    if coverage < 40:
+        return "Предимно ясно"
+    if coverage < 70:
+        return "Частична облачност"
+    if coverage < 90:
+        return "Предимно облачно"
+    return "Облачно"
+
+def _visibility_label(index: float) -> str:
+    """Категория на видимостта по индекса 0-100"""
+    if index >= 70:
+        return "отлична"
+    if index >= 45:
+        return "добра"
+    if index >= 20:
+        return "умерена"
+    return "лоша"
+
+def estimate_sky(image_data: bytes, cloud_ratio: float = 0.72) -> Optional[Dict[str, Any]]:
+    """
+    Оценява облачността, яркостта и видимостта на JPEG изображение
+
+    Args:
+        image_data: Байтове на изображението
+        cloud_ratio: Праг на съотношението R/B, над който пикселът е облак
+
+    Returns:
+        Речник с оценката или None при невалидно изображение
+    """
+    import cv2
+    import numpy as np
+
+    start_time = time.perf_counter()
+
+    image = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv2.IMREAD_REDUCED_COLOR_4)
+    if image is None:
+        return None
+
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    blue, green, red = cv2.split(image.astype(np.float32))
+
+    # Локална текстура - небето и облаците са гладки, сградите и дърветата не
+    texture = cv2.blur(np.abs(cv2.Laplacian(gray, cv2.CV_32F, ksize=3)), (5, 5))
+    vegetation = (green > blue * 1.05) & (green > red)
+    sky = (texture < _SKY_TEXTURE_MAX) & (gray > _SKY_MIN_LEVEL) & ~vegetation
+
+    sky_pixels = int(sky.sum())
+    sky_fraction = sky_pixels / sky.size
+    brightness = float(gray.mean()) / 255 * 100
+
+    # Класификация облак / чисто небе по съотношението R/B
+    ratio = red / (blue + 1.0)
+    cloud_pixels = int((sky & (ratio > cloud_ratio)).sum())
+    coverage = cloud_pixels / sky_pixels * 100 if sky_pixels else 0.0
+    ambiguous = float((sky & (np.abs(ratio - cloud_ratio) < _RATIO_MARGIN)).sum()) / sky_pixels if sky_pixels else 1.0
+
+    # Видимост - мъглата и мараня размиват детайлите извън небето
+    ground = ~sky
+    sharpness = float(texture[ground].mean()) if ground.any() else 0.0
+    visibility_index = min(sharpness / _SHARPNESS_CLEAR, 1.0) * 100
+
+    # Увереност - намалява при тъмно, малко небе и много пиксели около прага
+    confidence = 100.0 * (1.0 - ambiguous)
+    confidence *= min(sky_fraction / 0.2, 1.0)
+    confidence *= min(brightness / (_DARK_LEVEL * 2), 1.0)
+
+    if brightness < _DARK_LEVEL:
+        conditions = "Твърде тъмно за надеждна локална оценка"
+    elif sky_pixels == 0:
+        conditions = "Небето не се вижда"
+    else:
+        conditions = f"{_describe(coverage)}, видимост {_visibility_label(visibility_index)}"
+
+    return {
+        "cloud_coverage": round(coverage, 1),
+        "brightness": round(brightness, 1),
+        "visibility": _visibility_label(visibility_index),
+        "visibility_index": round(visibility_index, 1),
+        "sky_fraction": round(sky_fraction, 3),
+        "confidence": round(confidence, 1),
+        "weather_conditions": conditions,
+        "analysis_time": time.perf_counter() - start_time
+    }
@@ -0,0 +1,192 @@
+"""
+Подготовка на изображението преди изпращане към vision API
+
+Вместо оригиналния кадър в пълна резолюция се изпраща по-малко изображение:
+незадължително изрязване до областта на небето, намаляване до зададена дължина
+на по-дългата страна и прекодиране като JPEG с настроено качество. По-малкият
+payload означава по-бърза заявка и по-малко входни токени за анализ.
+
+Проверката за валидност чете само заглавката на файла (размерите и маркера
+за край на JPEG), без да декодира пикселите.
+"""
+
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from .config import get_analysis_config
+from utils.logger import setup_logger
+
+# Инициализиране на логър
+logger = setup_logger("image_preprocess")
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# SOF маркери, които носят размерите на JPEG изображението
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def read_image_size(image_data: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Връща (ширина, височина) от заглавката на JPEG или PNG изображение
+
+    Пикселите не се декодират. За JPEG се проверява и маркерът за край (EOI)
+    след началото на данните (SOS), за да се хванат недописани файлове; той
+    може да е последван от произволни байтове. Връща None при невалидни данни.
+    """
+    if image_data[:8] == _PNG_SIGNATURE and image_data[12:16] == b"IHDR":
+        width = int.from_bytes(image_data[16:20], "big")
+        height = int.from_bytes(image_data[20:24], "big")
+        return (width, height) if width and height else None
+
+    if image_data[:2] != b"\xff\xd8":
+        return None
+
+    size = None
+    index = 2
+    while index + 4 <= len(image_data):
+        if image_data[index] != 0xFF:
+            return None
+
+        marker = image_data[index + 1]
+        if marker == 0xFF:
+            index += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            index += 2
+            continue
+
+        if marker in _JPEG_SOF_MARKERS and index + 9 <= len(image_data):
+            height = int.from_bytes(image_data[index + 5:index + 7], "big")
+            width = int.from_bytes(image_data[index + 7:index + 9], "big")
+            size = (width, height) if width and height else None
+            if size is None:
+                return None
+
+        length = int.from_bytes(image_data[index + 2:index + 4], "big")
+        if marker == 0xDA:
+            # В кодираните данни 0xFF винаги е последван от 0x00 или RST, така че
+            # първият EOI след SOS е краят на изображението (миниатюрите в EXIF са преди SOS)
+            if size is None or image_data.find(b"\xff\xd9", index + 2 + length) < 0:
+                return None
+            return size
+        index += 2 + length
+
+    return None
+
+def parse_crop(crop: str) -> Optional[Tuple[float, float, float, float]]:
+    """Разчита "ляво,горе,дясно,долу" като дробни части (0-1) от размерите"""
+    if not crop:
+        return None
+
+    try:
+        left, top, right, bottom = (float(value) for value in crop.split(","))
+    except ValueError:
+        logger.error(f"Невалидна стойност за изрязване: {crop}")
+        return None
+
+    if not (0 <= left < right <= 1 and 0 <= top < bottom <= 1):
+        logger.error(f"Областта за изрязване е извън изображението: {crop}")
+        return None
+    return left, top, right, bottom
+
+class PreprocessStats:
+    """Броячи за спестения обем на изпратените изображения"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.images = 0
+        self.original_bytes = 0
+        self.sent_bytes = 0
+
+    def record(self, original_bytes: int, sent_bytes: int):
+        """Записва едно подготвено изображение"""
+        with self._lock:
+            self.images += 1
+            self.original_bytes += original_bytes
+            self.sent_bytes += sent_bytes
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Връща текущите броячи"""
+        with self._lock:
+            return {
+                "images": self.images,
+                "original_bytes": self.original_bytes,
+                "sent_bytes": self.sent_bytes,
+                "ratio": self.sent_bytes / self.original_bytes if self.original_bytes else 1.0
+            }
+
+# Глобални броячи на модула
+_stats = PreprocessStats()
+
+def get_preprocess_stats() -> PreprocessStats:
+    """Връща броячите за подготовката на изображения"""
+    return _stats
+
+def preprocessing_signature() -> str:
+    """Описание на текущите настройки (участва в ключа на кеша на анализите)"""
+    config = get_analysis_config()
+    if not config.preprocess:
+        return "original"
+    return f"{config.preprocess_crop}|{config.preprocess_max_side}|{config.preprocess_jpeg_quality}"
+
+def preprocess_for_api(image_data: bytes) -> bytes:
+    """
+    Подготвя изображението за изпращане към API
+
+    Returns:
+        JPEG байтове; оригиналът, ако подготовката е изключена, не успее
+        или не намали размера
+    """
+    import cv2
+    import numpy as np
+
+    config = get_analysis_config()
+    if not config.preprocess:
+        return image_data
+
+    size = read_image_size(image_data)
+    if size is None:
+        return image_data
+
+    crop = parse_crop(config.preprocess_crop)
+    width, height = size
+    crop_width = width * (crop[2] - crop[0]) if crop else width
+    crop_height = height * (crop[3] - crop[1]) if crop else height
+    scale = min(config.preprocess_max_side / max(crop_width, crop_height), 1.0)
+
+    # JPEG декодерът може директно да намали 2, 4 или 8 пъти - много по-бързо от пълно декодиране
+    flags = cv2.IMREAD_COLOR
+    for factor, reduced in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if scale * factor <= 1.0:
+            flags = reduced
+            break
+
+    image = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), flags)
+    if image is None:
+        return image_data
+
+    if crop:
+        image_height, image_width = image.shape[:2]
+        image = image[
+            int(crop[1] * image_height):int(crop[3] * image_height),
+            int(crop[0] * image_width):int(crop[2] * image_width)
+        ]
+
+    long_side = max(image.shape[:2])
+    if long_side > config.preprocess_max_side:
+        factor = config.preprocess_max_side / long_side
+        image = cv2.resize(image, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+
+    success, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, config.preprocess_jpeg_quality])
+    if not success:
+        return image_data
+
+    processed = buffer.tobytes()
+    # Без изрязване не изпращаме прекодиран файл, който е по-голям от оригинала
+    if not crop and len(processed) >= len(image_data):
+        processed = image_data
+
+    _stats.record(len(image_data), len(processed))
+    logger.info(
+        f"Подготвено изображение: {width}x{height} -> {image.shape[1]}x{image.shape[0]}, "
+        f"{len(image_data)} -> {len(processed)} bytes"
+    )
+    return processed
@@ -0,0 +1,212 @@
+"""
+Кеш на резултатите от анализа, адресиран по съдържание
+
+Ключът е хеш на байтовете на изображението заедно с модела, prompt-а и
+параметрите на заявката, така че същият кадър, анализиран със същите
+настройки, не изпраща втора заявка към API. Кешът има LRU слой в паметта и
+незадължителен слой на диска (JSON файлове), който оцелява след рестарт.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from .config import get_analysis_config
+from utils.helpers import atomic_write
+from utils.logger import setup_logger
+
+# Инициализиране на логър
+logger = setup_logger("analysis_cache")
+
+# На колко записа на диска се почистват изтеклите файлове
+_DISK_PRUNE_EVERY = 100
+
+def make_cache_key(
+    image_data: bytes, model: str, prompt: str, temperature: float, max_tokens: int, variant: str = ""
+) -> str:
+    """
+    Изчислява ключа за кеша от съдържанието на изображението и параметрите на заявката
+
+    variant описва обработката на изображението преди изпращане (изрязване,
+    намаляване), за да не се смесват резултати от различно подготвени кадри.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(image_data)
+    digest.update(json.dumps([model, prompt, temperature, max_tokens, variant]).encode("utf-8"))
+    return digest.hexdigest()
+
+class AnalysisCache:
+    """LRU кеш в паметта с TTL и незадължителен слой на диска"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._disk_writes = 0
+        self.stats: Dict[str, int] = {
+            "hits": 0,
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "evictions": 0,
+            "stores": 0
+        }
+
+    def _disk_path(self, key: str) -> Optional[str]:
+        """Връща пътя до файла на записа или None, ако слоят на диска е изключен"""
+        cache_dir = get_analysis_config().analysis_cache_dir
+        if not cache_dir:
+            return None
+        return os.path.join(cache_dir, key[:2], f"{key}.json")
+
+    def _read_disk(self, key: str) -> Optional[Dict[str, Any]]:
+        """Чете запис от диска"""
+        path = self._disk_path(key)
+        if path is None or not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"Повреден запис в кеша на диска {path}: {str(e)}")
+            self._remove_disk(key)
+            return None
+
+    def _write_disk(self, key: str, entry: Dict[str, Any]):
+        """Записва запис на диска атомарно"""
+        path = self._disk_path(key)
+        if path is None:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomic_write(path, json.dumps(entry, ensure_ascii=False).encode("utf-8"))
+        except Exception as e:
+            logger.error(f"Грешка при запис в кеша на диска: {str(e)}")
+            return
+
+        self._disk_writes += 1
+        if self._disk_writes % _DISK_PRUNE_EVERY == 0:
+            self.prune_disk()
+
+    def _remove_disk(self, key: str):
+        """Изтрива запис от диска"""
+        path = self._disk_path(key)
+        if path is not None and os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _store_memory(self, key: str, entry: Dict[str, Any]):
+        """Добавя запис в LRU слоя и изхвърля най-стария при препълване"""
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+
+        max_entries = get_analysis_config().analysis_cache_size
+        while len(self._entries) > max(max_entries, 0):
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Връща кеширания анализ или None
+
+        Файлът от диска се чете извън ключалката, така че бавен диск не
+        блокира останалите обръщения; от async код се извиква през
+        asyncio.to_thread.
+        """
+        ttl = get_analysis_config().analysis_cache_ttl
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+        source = "memory_hits"
+        if entry is None:
+            entry = self._read_disk(key)
+            source = "disk_hits"
+
+        expired = entry is not None and ttl > 0 and now - entry["created"] > ttl
+        if expired:
+            self._remove_disk(key)
+
+        with self._lock:
+            if expired:
+                self._entries.pop(key, None)
+                self.stats["expired"] += 1
+                entry = None
+
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+
+            if source == "disk_hits":
+                self._store_memory(key, entry)
+            elif key in self._entries:
+                self._entries.move_to_end(key)
+
+            self.stats["hits"] += 1
+            self.stats[source] += 1
+            return entry["analysis"]
+
+    def put(self, key: str, analysis: Dict[str, Any]):
+        """Запазва успешен анализ в паметта и на диска (записът на диска е извън ключалката)"""
+        entry = {"created": time.time(), "analysis": analysis}
+
+        with self._lock:
+            self._store_memory(key, entry)
+            self.stats["stores"] += 1
+
+        self._write_disk(key, entry)
+
+    def prune_disk(self, everything: bool = False) -> int:
+        """Изтрива изтеклите (или всички) записи от диска и връща броя им"""
+        cache_dir = get_analysis_config().analysis_cache_dir
+        ttl = get_analysis_config().analysis_cache_ttl
+        if not cache_dir or not os.path.isdir(cache_dir) or (ttl <= 0 and not everything):
+            return 0
+
+        removed = 0
+        cutoff = float("inf") if everything else time.time() - ttl
+        for root, _dirs, files in os.walk(cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if name.endswith(".json") and os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    continue
+
+        if removed:
+            logger.info(f"Изтрити {removed} записа от кеша на диска")
+        return removed
+
+    def clear(self):
+        """Изчиства кеша в паметта и на диска"""
+        with self._lock:
+            self._entries.clear()
+        self.prune_disk(everything=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Връща броячите и размера на кеша"""
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "entries": len(self._entries),
+                "hit_ratio": self.stats["hits"] / lookups if lookups else 0.0
+            }
+
+# Глобален кеш на модула
+_cache = AnalysisCache()
+
+def get_analysis_cache() -> AnalysisCache:
+    """Връща глобалния кеш на резултатите"""
+    return _cache
@@ -0,0 +1,282 @@
+"""
+Планировчик на заявките към vision API
+
+Всички отдалечени анализи (от фоновия цикъл и от /analysis/analyze) минават
+оттук:
+- общ лимит на едновременните заявки, като чакащите се обслужват по
+  приоритета на камерата (по-малко число = по-висок приоритет);
+- token bucket ограничение на честотата на заявките;
+- повторение при 429/5xx и мрежови грешки - спазва се Retry-After, иначе
+  експоненциално изчакване с jitter;
+- едновременни заявки за едно и също изображение споделят един анализ.
+
+Лимитите са общи за всички event loop-ове в процеса, защото ограниченията
+на доставчика са за целия API ключ.
+"""
+
+import time
+import heapq
+import random
+import asyncio
+import hashlib
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from .config import get_analysis_config
+from .analyzer import analyze_image_with_anthropic
+from utils.logger import setup_logger
+from utils.metrics import Gauge
+
+# Инициализиране на логър
+logger = setup_logger("analysis_scheduler")
+
+# HTTP статуси, при които заявката се повтаря
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+def retry_hint(outcome: Any) -> Tuple[bool, Optional[float]]:
+    """
+    Решава дали резултатът е временна грешка
+
+    outcome е (успех, резултат) или списък от такива (групов анализ) - групата
+    се повтаря само ако всички изображения в нея са неуспешни.
+
+    Returns:
+        (да се повтори ли, препоръчано изчакване от Retry-After)
+    """
+    outcomes = outcome if isinstance(outcome, list) else [outcome]
+    failures = [analysis for success, analysis in outcomes if not success]
+    if not failures or len(failures) < len(outcomes):
+        return False, None
+
+    error = failures[0]
+    if error.get("status_code") in RETRYABLE_STATUS or error.get("retryable"):
+        return True, error.get("retry_after")
+    return False, None
+
+class TokenBucket:
+    """Ограничение на честотата: rate заявки в минута, до burst наведнъж"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens: Optional[float] = None
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _reserve(self) -> float:
+        """Запазва един токен и връща колко секунди трябва да се изчака за него"""
+        config = get_analysis_config()
+        rate = config.analysis_rate_limit / 60.0
+        burst = max(config.analysis_rate_burst, 1)
+
+        with self._lock:
+            now = time.monotonic()
+            if self._tokens is None:
+                self._tokens = float(burst)
+            if rate > 0:
+                self._tokens = min(self._tokens + (now - self._updated) * rate, burst)
+            self._updated = now
+
+            # Токенът се взима веднага, а при недостиг балансът става отрицателен
+            # и следващите заявки изчакват пропорционално по-дълго
+            self._tokens -= 1
+            wait = -self._tokens / rate if self._tokens < 0 and rate > 0 else 0.0
+            return max(wait, self._paused_until - now)
+
+    def pause(self, seconds: float):
+        """Спира всички заявки за зададеното време (след 429 с Retry-After)"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> float:
+        """Изчаква свободен токен и връща времето на изчакване"""
+        if get_analysis_config().analysis_rate_limit <= 0:
+            return 0.0
+
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+class PrioritySlots:
+    """
+    Брояч на свободните места за едновременни заявки (като семафор),
+    при който чакащите получават място по приоритет, а не по ред на пристигане
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = 0
+        self._sequence = 0
+        self._waiters: List[Tuple[int, int, asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, priority: int):
+        """Заема място; при липса чака, докато не бъде освободено за него"""
+        loop = asyncio.get_running_loop()
+
+        with self._lock:
+            if self._active < max(get_analysis_config().analysis_max_concurrency, 1) and not self._waiters:
+                self._active += 1
+                return
+
+            future = loop.create_future()
+            self._sequence += 1
+            heapq.heappush(self._waiters, (priority, self._sequence, loop, future))
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Ако мястото вече е предадено на прекъснатия чакащ, го освобождаваме
+            with self._lock:
+                self._waiters = [waiter for waiter in self._waiters if waiter[3] is not future]
+                heapq.heapify(self._waiters)
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        """Освобождава място и го предава на чакащия с най-висок приоритет"""
+        with self._lock:
+            while self._waiters:
+                _, _, loop, future = heapq.heappop(self._waiters)
+                if loop.is_closed():
+                    continue
+                # Мястото остава заето - директно се предава на чакащия
+                loop.call_soon_threadsafe(self._grant, future)
+                return
+            self._active -= 1
+
+    def _grant(self, future: asyncio.Future):
+        """Събужда чакащия в неговия event loop"""
+        if future.done():
+            # Чакащият е прекъснат междувременно - мястото отива при следващия
+            self.release()
+        else:
+            future.set_result(True)
+
+class AnalysisScheduler:
+    """Изпълнява отдалечените анализи в рамките на лимитите на API"""
+
+    def __init__(self):
+        self.bucket = TokenBucket()
+        self.slots = PrioritySlots()
+        self._in_flight: Dict[Tuple[asyncio.AbstractEventLoop, str], asyncio.Future] = {}
+        self._lock = threading.Lock()
+        self.stats: Dict[str, Any] = {
+            "submitted": 0,
+            "deduplicated": 0,
+            "requests": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "failed": 0,
+            "throttle_wait": 0.0
+        }
+
+    def priority_for(self, camera_id: str) -> int:
+        """Приоритет на камерата (по-малко число = по-висок приоритет)"""
+        return get_analysis_config().analysis_priorities.get(camera_id, 10)
+
+    async def submit(self, image_data: bytes, camera_id: str = "default") -> Tuple[bool, Dict[str, Any]]:
+        """Анализира изображението; едновременните заявки за същото изображение чакат общ резултат"""
+        loop = asyncio.get_running_loop()
+        key = (loop, hashlib.blake2b(image_data, digest_size=16).hexdigest())
+
+        with self._lock:
+            self.stats["submitted"] += 1
+            future = self._in_flight.get(key)
+            if future is None:
+                future = asyncio.ensure_future(self._execute(image_data, camera_id))
+                self._in_flight[key] = future
+                future.add_done_callback(lambda _future: self._in_flight.pop(key, None))
+            else:
+                self.stats["deduplicated"] += 1
+                logger.info(f"[{camera_id}] Присъединяване към анализа на същото изображение")
+
+        # shield - прекъсната заявка не отменя анализа за останалите
+        return await asyncio.shield(future)
+
+    async def _execute(self, image_data: bytes, camera_id: str) -> Tuple[bool, Dict[str, Any]]:
+        """Изпраща изображението самостоятелно или чрез групиращия обект"""
+        priority = self.priority_for(camera_id)
+
+        if get_analysis_config().analysis_batch_size > 1:
+            # Импортира се тук, защото batch модулът използва този планировчик
+            from .batch import get_analysis_batcher
+            return await get_analysis_batcher().submit(image_data, priority)
+
+        return await self.run(priority, lambda: analyze_image_with_anthropic(image_data))
+
+    async def run(self, priority: int, request: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Изпълнява заявка с ограниченията и повторенията на планировчика
+
+        Args:
+            priority: Приоритет за опашката на свободните места
+            request: Функция, която създава нова заявка при всеки опит
+        """
+        config = get_analysis_config()
+        outcome = None
+
+        for attempt in range(config.analysis_max_retries + 1):
+            # Токенът се чака преди мястото - ограничена заявка не заема място,
+            # което иначе би получила заявка с по-висок приоритет
+            wait = await self.bucket.acquire()
+            self.stats["throttle_wait"] += wait
+
+            await self.slots.acquire(priority)
+            try:
+                self.stats["requests"] += 1
+                outcome = await request()
+            finally:
+                self.slots.release()
+
+            retry, retry_after = retry_hint(outcome)
+            if not retry:
+                return outcome
+
+            if attempt == config.analysis_max_retries:
+                break
+
+            if retry_after is not None:
+                # Доставчикът е казал колко да чакаме - спираме всички заявки
+                self.stats["rate_limited"] += 1
+                self.bucket.pause(retry_after)
+                delay = retry_after
+            else:
+                # Експоненциално изчакване с пълен jitter
+                delay = random.uniform(0, min(config.analysis_backoff_max, config.analysis_backoff_base * 2 ** attempt))
+
+            self.stats["retries"] += 1
+            logger.warning(f"Временна грешка от API, повторен опит {attempt + 1} след {delay:.1f} секунди")
+            await asyncio.sleep(delay)
+
+        self.stats["failed"] += 1
+        return outcome
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Връща броячите и текущото натоварване"""
+        return {
+            **self.stats,
+            "active": self.slots.active,
+            "waiting": self.slots.waiting,
+            "in_flight": len(self._in_flight)
+        }
+
+# Глобален планировчик на модула
+_scheduler = AnalysisScheduler()
+
+def get_analysis_scheduler() -> AnalysisScheduler:
+    """Връща глобалния планировчик на анализите"""
+    return _scheduler
+
+SCHEDULER_REQUESTS = Gauge(
+    "analysis_scheduler_requests", "Заявки към API в планировчика по състояние", ["state"],
+    callback=lambda: [(("active",), _scheduler.slots.active), (("waiting",), _scheduler.slots.waiting)]
+)
@@ -0,0 +1,283 @@
+"""
+Тенденции на облачността
+
+За всяка камера стойностите се пазят в NumPy масиви (време, облачност) и
+се поддържат инкрементално при всеки нов резултат:
+- плъзгащи се прозорци (1ч, 6ч, 24ч, 7д) със сума, брой и монотонни опашки
+  за минимум/максимум - отговорът за тях е O(1);
+- почасови/дневни средни и откриване на рязка промяна (CUSUM точка на
+  промяна и сравнение на последния интервал с предходния) се изчисляват
+  векторно и се кешират до следващия резултат.
+"""
+
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from .config import get_analysis_config, AnalysisResult
+from utils.logger import setup_logger
+
+# Инициализиране на логър
+logger = setup_logger("analysis_trend")
+
+# Поддържани плъзгащи се прозорци в секунди
+WINDOWS = {
+    "1h": 3600,
+    "6h": 6 * 3600,
+    "24h": 24 * 3600,
+    "7d": 7 * 24 * 3600
+}
+
+# Минимален брой точки за търсене на точка на промяна
+_MIN_CHANGE_POINTS = 8
+
+class _WindowState:
+    """Състояние на един плъзгащ се прозорец"""
+    __slots__ = ("seconds", "lo", "total", "min_queue", "max_queue")
+
+    def __init__(self, seconds: int, lo: int):
+        self.seconds = seconds
+        self.lo = lo  # Абсолютен индекс на първата точка в прозореца
+        self.total = 0.0
+        self.min_queue: deque = deque()  # Индекси с нарастващи стойности
+        self.max_queue: deque = deque()  # Индекси с намаляващи стойности
+
+class TrendSeries:
+    """Времеви ред на облачността за една камера"""
+
+    def __init__(self, capacity: int = 1024):
+        self._ts = np.empty(capacity, dtype=np.float64)
+        self._values = np.empty(capacity, dtype=np.float64)
+        self._base = 0  # Абсолютен индекс на първия елемент в масивите
+        self._end = 0  # Абсолютен индекс след последния елемент
+        self._windows = {name: _WindowState(seconds, 0) for name, seconds in WINDOWS.items()}
+        self._derived: Dict[str, Any] = {}
+        self._derived_at = 0.0
+        self.version = 0
+
+    def __len__(self) -> int:
+        return self._end - self._base
+
+    def _ensure_capacity(self):
+        """Освобождава място, като изхвърля точките извън най-големия прозорец или разширява масивите"""
+        if self._end - self._base < len(self._ts):
+            return
+
+        new_base = min(window.lo for window in self._windows.values())
+        keep = self._end - new_base
+        offset = new_base - self._base
+
+        if keep >= len(self._ts) // 2:
+            ts = np.empty(len(self._ts) * 2, dtype=np.float64)
+            values = np.empty(len(self._values) * 2, dtype=np.float64)
+        else:
+            ts, values = self._ts, self._values
+
+        ts[:keep] = self._ts[offset:offset + keep]
+        values[:keep] = self._values[offset:offset + keep]
+        self._ts, self._values, self._base = ts, values, new_base
+
+    def _evict(self, now: float):
+        """Премахва от прозорците точките, по-стари от прозореца спрямо now"""
+        for window in self._windows.values():
+            cutoff = now - window.seconds
+            while window.lo < self._end and self._ts[window.lo - self._base] < cutoff:
+                window.total -= self._values[window.lo - self._base]
+                if window.min_queue and window.min_queue[0] == window.lo:
+                    window.min_queue.popleft()
+                if window.max_queue and window.max_queue[0] == window.lo:
+                    window.max_queue.popleft()
+                window.lo += 1
+
+    def add(self, ts: float, value: float):
+        """Добавя точка; точки, по-стари от последната, се пренебрегват"""
+        if self._end > self._base and ts < self._ts[self._end - 1 - self._base]:
+            return
+
+        self._ensure_capacity()
+        index = self._end
+        self._ts[index - self._base] = ts
+        self._values[index - self._base] = value
+        self._end += 1
+
+        for window in self._windows.values():
+            window.total += value
+            while window.min_queue and self._values[window.min_queue[-1] - self._base] >= value:
+                window.min_queue.pop()
+            window.min_queue.append(index)
+            while window.max_queue and self._values[window.max_queue[-1] - self._base] <= value:
+                window.max_queue.pop()
+            window.max_queue.append(index)
+
+        self._evict(ts)
+        self.version += 1
+        self._derived = {}
+
+    def window_stats(self, now: float) -> Dict[str, Dict[str, Any]]:
+        """Средна, минимална и максимална облачност за всеки прозорец (O(1) на прозорец)"""
+        self._evict(now)
+        stats = {}
+        for name, window in self._windows.items():
+            count = self._end - window.lo
+            stats[name] = {
+                "count": count,
+                "mean": round(window.total / count, 1) if count else None,
+                "min": float(self._values[window.min_queue[0] - self._base]) if count else None,
+                "max": float(self._values[window.max_queue[0] - self._base]) if count else None
+            }
+        return stats
+
+    def _since(self, start: float):
+        """Връща масивите (изгледи) с точките от start нататък"""
+        ts = self._ts[:self._end - self._base]
+        first = int(np.searchsorted(ts, start, side="left"))
+        return ts[first:], self._values[first:self._end - self._base]
+
+    def buckets(self, bucket_seconds: int, span: int, now: float) -> List[Dict[str, Any]]:
+        """Средни стойности по интервали от bucket_seconds (местно време) за последните span секунди"""
+        ts, values = self._since(now - span)
+        if not len(ts):
+            return []
+
+        # Отместване на местното време спрямо UTC, за да съвпадат границите на часа/деня
+        utc_offset = datetime.now().astimezone().utcoffset().total_seconds()
+        bucket_ids = np.floor((ts + utc_offset) / bucket_seconds).astype(np.int64)
+        unique_ids, inverse = np.unique(bucket_ids, return_inverse=True)
+
+        counts = np.bincount(inverse)
+        means = np.bincount(inverse, weights=values) / counts
+        minimums = np.full(len(unique_ids), np.inf)
+        maximums = np.full(len(unique_ids), -np.inf)
+        np.minimum.at(minimums, inverse, values)
+        np.maximum.at(maximums, inverse, values)
+
+        return [
+            {
+                "start": datetime.fromtimestamp(bucket_id * bucket_seconds - utc_offset).isoformat(),
+                "count": int(count),
+                "mean": round(float(mean), 1),
+                "min": float(minimum),
+                "max": float(maximum)
+            }
+            for bucket_id, count, mean, minimum, maximum in zip(unique_ids, counts, means, minimums, maximums)
+        ]
+
+    def change_point(self, span: int, threshold: float, now: float) -> Optional[Dict[str, Any]]:
+        """
+        Най-вероятната точка на промяна в средното ниво (CUSUM) за последните span секунди
+
+        Връща None, ако разликата между средните преди и след нея е под прага.
+        """
+        ts, values = self._since(now - span)
+        if len(values) < _MIN_CHANGE_POINTS:
+            return None
+
+        cusum = np.cumsum(values - values.mean())
+        split = int(np.argmax(np.abs(cusum[:-1]))) + 1
+        before = float(values[:split].mean())
+        after = float(values[split:].mean())
+
+        if abs(after - before) < threshold:
+            return None
+        return {
+            "timestamp": datetime.fromtimestamp(ts[split]).isoformat(),
+            "mean_before": round(before, 1),
+            "mean_after": round(after, 1),
+            "shift": round(after - before, 1)
+        }
+
+    def sudden_change(self, window: int, threshold: float, now: float) -> Optional[Dict[str, Any]]:
+        """Сравнява последните window секунди с предходните window секунди"""
+        ts, values = self._since(now - 2 * window)
+        recent = ts >= now - window
+        if not recent.any() or recent.all():
+            return None
+
+        previous_mean = float(values[~recent].mean())
+        recent_mean = float(values[recent].mean())
+        shift = recent_mean - previous_mean
+        if abs(shift) < threshold:
+            return None
+        return {
+            "event": "sudden_clearing" if shift < 0 else "sudden_clouding",
+            "previous_mean": round(previous_mean, 1),
+            "recent_mean": round(recent_mean, 1),
+            "shift": round(shift, 1)
+        }
+
+    def derived(self, now: float) -> Dict[str, Any]:
+        """Групираните стойности и промените - кеширани до следващата точка (най-много минута)"""
+        if not self._derived or now - self._derived_at > 60:
+            self._derived_at = now
+            config = get_analysis_config()
+            self._derived = {
+                "hourly": self.buckets(3600, WINDOWS["24h"], now),
+                "daily": self.buckets(86400, WINDOWS["7d"], now),
+                "change_point": self.change_point(WINDOWS["24h"], config.trend_change_threshold, now),
+                "sudden_change": self.sudden_change(config.trend_change_window, config.trend_change_threshold, now)
+            }
+        return self._derived
+
+class TrendTracker:
+    """Времеви редове по камера, обновявани при всеки нов резултат"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series: Dict[str, TrendSeries] = {}
+
+    def add(self, result: AnalysisResult):
+        """Добавя успешен резултат към реда на камерата"""
+        if result.error:
+            return
+
+        with self._lock:
+            series = self._series.get(result.camera_id)
+            if series is None:
+                series = self._series[result.camera_id] = TrendSeries()
+            series.add(result.timestamp.timestamp(), result.cloud_coverage)
+
+    def load(self, results: List[AnalysisResult]):
+        """Зарежда наново редовете от историята (подредени по време)"""
+        with self._lock:
+            self._series = {}
+        for result in results:
+            self.add(result)
+
+    def snapshot(self, camera_id: str = "default") -> Optional[Dict[str, Any]]:
+        """Връща тенденциите за камерата или None, ако няма данни"""
+        now = datetime.now().timestamp()
+
+        with self._lock:
+            series = self._series.get(camera_id)
+            if series is None:
+                return None
+            return {
+                "samples": len(series),
+                "version": series.version,
+                "windows": series.window_stats(now),
+                **series.derived(now)
+            }
+
+    def cameras(self) -> List[str]:
+        """Връща камерите с данни"""
+        with self._lock:
+            return list(self._series)
+
+# Глобален tracker на модула
+_tracker = TrendTracker()
+
+def get_trend_tracker() -> TrendTracker:
+    """Връща глобалния tracker на тенденциите"""
+    return _tracker
+
+def warm_from_history():
+    """Зарежда последните 7 дни от постоянната история"""
+    from .history import get_history_store
+
+    start = datetime.now() - timedelta(seconds=WINDOWS["7d"])
+    results = get_history_store().query(start=start, limit=1_000_000)
+    _tracker.load(results)
+    logger.info(f"Тенденции: заредени {len(results)} анализа от историята")
@@ -1,165 +1,465 @@
-"""
-API маршрути за RTSP capture модул
-"""
-
-import os
-import time
-from fastapi import APIRouter, HTTPException, Request, Form
-from fastapi.responses import HTMLResponse, Response, JSONResponse, FileResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
-
-from .config import get_capture_config, update_capture_config
-from .capture import capture_frame, get_placeholder_image, start_capture_thread, stop_capture_thread
-from utils.logger import setup_logger
-
-# Инициализиране на логър
-logger = setup_logger("rtsp_api")
-
-# Регистриране на API router
-router = APIRouter()
-
-# Настройване на шаблони (ако има нужда)
-templates_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "templates")
-templates = Jinja2Templates(directory=templates_dir)
-
-@router.get("/", response_class=HTMLResponse)
-async def rtsp_index(request: Request):
-    """Страница за RTSP модула"""
-    config = get_capture_config()
-    
-    return templates.TemplateResponse("rtsp_index.html", {
-        "request": request,
-        "config": config,
-        "timestamp": int(time.time()),
-        "last_update": config.last_frame_time.strftime("%H:%M:%S") if config.last_frame_time else "Няма",
-        "status": config.status,
-        "status_text": "OK" if config.status == "ok" else "Грешка" if config.status == "error" else "Инициализация"
-    })
-
-@router.get("/latest.jpg")
-async def latest_jpg():
-    """Връща последния запазен JPEG файл"""
-    try:
-        config = get_capture_config()
-        latest_path = os.path.join(config.save_dir, "latest.jpg")
-        
-        if not os.path.exists(latest_path):
-            # Връщаме placeholder изображение
-            return Response(content=get_placeholder_image(), media_type="image/jpeg")
-        
-        return FileResponse(latest_path, media_type="image/jpeg")
-    except Exception as e:
-        logger.error(f"Грешка при достъпване на последния кадър: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
-
-@router.get("/info")
-async def rtsp_info():
-    """Връща информация за последния запазен кадър"""
-    config = get_capture_config()
-    
-    if config.last_frame_time is None:
-        return JSONResponse({
-            "status": "no_frame",
-            "message": "Все още няма запазен кадър"
-        }, status_code=404)
-    
-    return JSONResponse({
-        "status": config.status,
-        "last_frame_time": config.last_frame_time.isoformat() if config.last_frame_time else None,
-        "last_frame_path": config.last_frame_path,
-        "rtsp_url": config.rtsp_url,
-        "interval": config.interval,
-        "latest_url": "/rtsp/latest.jpg"
-    })
-
-@router.get("/capture")
-async def api_capture():
-    """Принудително извличане на нов кадър"""
-    success = capture_frame()
-    
-    if success:
-        return JSONResponse({
-            "status": "ok",
-            "message": "Кадърът е успешно извлечен",
-            "last_frame_time": get_capture_config().last_frame_time.isoformat() 
-                if get_capture_config().last_frame_time else None,
-            "latest_url": "/rtsp/latest.jpg"
-        })
-    else:
-        return JSONResponse({
-            "status": "error",
-            "message": "Не може да се извлече кадър от RTSP потока"
-        }, status_code=500)
-
-@router.post("/config")
-async def update_config(
-    rtsp_url: str = Form(None),
-    interval: int = Form(None),
-    width: int = Form(None),
-    height: int = Form(None),
-    quality: int = Form(None)
-):
-    """Обновява конфигурацията на RTSP модула"""
-    update_params = {}
-    
-    if rtsp_url is not None:
-        update_params["rtsp_url"] = rtsp_url
-    
-    if interval is not None:
-        update_params["interval"] = interval
-    
-    if width is not None:
-        update_params["width"] = width
-    
-    if height is not None:
-        update_params["height"] = height
-    
-    if quality is not None:
-        update_params["quality"] = quality
-    
-    # Обновяваме конфигурацията
-    updated_config = update_capture_config(**update_params)
-    
-    return JSONResponse({
-        "status": "ok",
-        "message": "Конфигурацията е обновена успешно",
-        "config": {
-            "rtsp_url": updated_config.rtsp_url,
-            "interval": updated_config.interval,
-            "width": updated_config.width,
-            "height": updated_config.height,
-            "quality": updated_config.quality
-        }
-    })
-
-@router.get("/start")
-async def start_capture():
-    """Стартира процеса за извличане на кадри"""
-    success = start_capture_thread()
-    
-    if success:
-        return JSONResponse({
-            "status": "ok",
-            "message": "Capture thread started successfully"
-        })
-    else:
-        return JSONResponse({
-            "status": "warning",
-            "message": "Capture thread is already running"
-        })
-
-@router.get("/stop")
-async def stop_capture():
-    """Спира процеса за извличане на кадри"""
-    success = stop_capture_thread()
-    
-    if success:
-        return JSONResponse({
-            "status": "ok",
-            "message": "Capture thread stopping"
-        })
-    else:
-        return JSONResponse({
-            "status": "error",
-            "message": "Failed to stop capture thread"
-        }, status_code=500)
\ No newline at end of file
+"""
+API маршрути за RTSP capture модул
+"""
+
+import os
+import time
+from datetime import date, datetime
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Request, Form, Query
+from fastapi.responses import HTMLResponse, Response, JSONResponse, StreamingResponse, FileResponse
+from fastapi.templating import Jinja2Templates
+
+from .config import get_capture_config, update_capture_config, get_camera_config, list_cameras
+from .frame_cache import get_frame_cache, is_not_modified
+from .stream import mjpeg_generator, BOUNDARY
+from .archive import get_archive_retention, get_archive_writer, parse_frame_time, frame_dir
+from .catalog import get_frame_catalog
+from .timelapse import get_timelapse_builder, FORMATS, MAX_FPS, MIN_SIZE, MAX_WIDTH, MAX_HEIGHT
+from .service import get_capture_service
+from .capture import get_placeholder_image, start_capture_thread, stop_capture_thread
+from utils.logger import setup_logger
+from utils.state import is_leader
+
+# Инициализиране на логър
+logger = setup_logger("rtsp_api")
+
+# Регистриране на API router
+router = APIRouter()
+
+# Настройване на шаблони (ако има нужда)
+templates_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "templates")
+templates = Jinja2Templates(directory=templates_dir)
+
+@router.get("/", response_class=HTMLResponse)
+async def rtsp_index(request: Request):
+    """Страница за RTSP модула"""
+    config = get_capture_config()
+    
+    return templates.TemplateResponse("rtsp_index.html", {
+        "request": request,
+        "config": config,
+        "timestamp": int(time.time()),
+        "last_update": config.last_frame_time.strftime("%H:%M:%S") if config.last_frame_time else "Няма",
+        "status": config.status,
+        "status_text": "OK" if config.status == "ok" else "Грешка" if config.status == "error" else "Инициализация"
+    })
+
+def _get_camera_or_404(camera_id: str):
+    """Връща конфигурацията на камерата или хвърля 404"""
+    config = get_camera_config(camera_id)
+    if config is None:
+        raise HTTPException(status_code=404, detail=f"Непозната камера: {camera_id}")
+    return config
+
+def _require_leader():
+    """Извличането на кадри е позволено само в процеса лидер"""
+    if not is_leader():
+        raise HTTPException(status_code=409, detail="Кадрите се извличат от друг процес (лидер)")
+
+def _latest_url(camera_id: str) -> str:
+    """Връща URL адреса на последния кадър за камерата"""
+    if camera_id == get_capture_config().camera_id:
+        return "/rtsp/latest.jpg"
+    return f"/rtsp/{camera_id}/latest.jpg"
+
+def _latest_jpg(request: Request, camera_id: str):
+    """Връща последния кадър на камерата от кеша в паметта"""
+    _get_camera_or_404(camera_id)
+    
+    try:
+        frame = get_frame_cache().get(camera_id)
+        
+        if frame is None:
+            # Връщаме placeholder изображение
+            return Response(
+                content=get_placeholder_image(camera_id),
+                media_type="image/jpeg",
+                headers={"Cache-Control": "no-store"}
+            )
+        
+        headers = {
+            "ETag": frame.etag,
+            "Last-Modified": frame.last_modified,
+            "Cache-Control": "no-cache"
+        }
+        
+        # Непроменен кадър - не изпращаме тялото отново
+        if is_not_modified(frame, request.headers.get("if-none-match"), request.headers.get("if-modified-since")):
+            return Response(status_code=304, headers=headers)
+        
+        return Response(content=frame.data, media_type="image/jpeg", headers=headers)
+    except Exception as e:
+        logger.error(f"Грешка при достъпване на последния кадър: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def _camera_info(camera_id: str):
+    """Връща информация за последния запазен кадър на камерата"""
+    config = _get_camera_or_404(camera_id)
+    
+    if config.last_frame_time is None:
+        return JSONResponse({
+            "status": "no_frame",
+            "message": "Все още няма запазен кадър"
+        }, status_code=404)
+    
+    return JSONResponse({
+        "camera_id": camera_id,
+        "status": config.status,
+        "last_frame_time": config.last_frame_time.isoformat() if config.last_frame_time else None,
+        "last_frame_path": config.last_frame_path,
+        "rtsp_url": config.rtsp_url,
+        "interval": config.interval,
+        "latest_url": _latest_url(camera_id)
+    })
+
+async def _camera_capture(camera_id: str):
+    """Принудително извличане на нов кадър от камерата"""
+    config = _get_camera_or_404(camera_id)
+    _require_leader()
+    success = await get_capture_service().capture(camera_id)
+    
+    if success:
+        return JSONResponse({
+            "status": "ok",
+            "message": "Кадърът е успешно извлечен",
+            "last_frame_time": config.last_frame_time.isoformat() 
+                if config.last_frame_time else None,
+            "latest_url": _latest_url(camera_id)
+        })
+    else:
+        return JSONResponse({
+            "status": "error",
+            "message": "Не може да се извлече кадър от RTSP потока"
+        }, status_code=500)
+
+def _frame_item(camera_id: str, item: dict) -> dict:
+    """Форматира запис от каталога за API отговор"""
+    return {
+        "timestamp": item["timestamp"],
+        "size": item["size"],
+        "width": item["width"],
+        "height": item["height"],
+        "url": f"/rtsp/{camera_id}/archive/{item['filename']}"
+    }
+
+async def _frames(
+    camera_id: str, from_time: Optional[datetime], to_time: Optional[datetime], step: int, limit: int,
+    after: Optional[float] = None
+):
+    """
+    Връща кадрите от каталога в даден интервал със страниране
+
+    Следващата страница се взима със същите параметри и after=next_after
+    (строго след последния върнат кадър) или с from=next_from.
+    """
+    _get_camera_or_404(camera_id)
+    limit = max(1, min(limit, 1000))
+    items = await get_capture_service().run(
+        get_frame_catalog().query, camera_id, from_time, to_time, step=max(step, 0), limit=limit, after=after
+    )
+    
+    # Следващата страница започва след последния върнат кадър (или интервал при step);
+    # кадрите са с точност до микросекунда и времето им е уникално за камерата
+    next_from = None
+    next_after = None
+    if len(items) == limit:
+        last_ts = items[-1]["ts"]
+        next_ts = (int(last_ts // step) + 1) * step if step > 0 else last_ts + 0.000001
+        next_from = datetime.fromtimestamp(next_ts).isoformat()
+        next_after = last_ts if step <= 0 else None
+    
+    return JSONResponse({
+        "status": "ok",
+        "camera_id": camera_id,
+        "count": len(items),
+        "frames": [_frame_item(camera_id, item) for item in items],
+        "next_from": next_from,
+        "next_after": next_after
+    })
+
+async def _nearest_frame(camera_id: str, when: datetime):
+    """Връща най-близкия до даден момент кадър"""
+    _get_camera_or_404(camera_id)
+    item = await get_capture_service().run(get_frame_catalog().nearest, camera_id, when)
+    
+    if item is None:
+        return JSONResponse({
+            "status": "no_frame",
+            "message": "Няма кадри в каталога"
+        }, status_code=404)
+    
+    return JSONResponse({"status": "ok", "camera_id": camera_id, "frame": _frame_item(camera_id, item)})
+
+async def _timelapse(camera_id: str, day: Optional[date], fps: int, width: Optional[int], height: Optional[int], fmt: str):
+    """Връща кеширано timelapse видео или насрочва генерирането му"""
+    config = _get_camera_or_404(camera_id)
+    
+    if fmt not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"Неподдържан формат: {fmt}")
+    
+    width = width or config.width
+    height = height or config.height
+    if not (MIN_SIZE <= width <= MAX_WIDTH and MIN_SIZE <= height <= MAX_HEIGHT):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Размерът трябва да е между {MIN_SIZE}x{MIN_SIZE} и {MAX_WIDTH}x{MAX_HEIGHT}"
+        )
+    
+    key = (
+        camera_id,
+        day or date.today(),
+        max(1, min(fps, MAX_FPS)),
+        width,
+        height,
+        fmt
+    )
+    builder = get_timelapse_builder()
+    output_path = builder.output_path(key)
+    
+    if await get_capture_service().run(builder.is_fresh, key):
+        return FileResponse(output_path, media_type=FORMATS[fmt][1])
+    
+    job = builder.request(key)
+    
+    # Докато се обновява, сервираме предишната версия, ако има такава
+    if os.path.exists(output_path):
+        return FileResponse(output_path, media_type=FORMATS[fmt][1])
+    
+    return JSONResponse({
+        "status": job["status"],
+        "message": "Видеото се генерира, опитайте отново след малко",
+        "frames": job["frames"],
+        "error": job["error"]
+    }, status_code=202)
+
+@router.get("/latest.jpg")
+async def latest_jpg(request: Request):
+    """Връща последния запазен JPEG кадър"""
+    return _latest_jpg(request, get_capture_config().camera_id)
+
+def _stream(camera_id: str):
+    """Връща MJPEG поток на живо за камерата"""
+    _get_camera_or_404(camera_id)
+    
+    return StreamingResponse(
+        mjpeg_generator(camera_id),
+        media_type=f"multipart/x-mixed-replace; boundary={BOUNDARY}",
+        headers={"Cache-Control": "no-store"}
+    )
+
+@router.get("/stream.mjpg")
+async def stream_mjpg():
+    """MJPEG поток на живо от камерата по подразбиране"""
+    return _stream(get_capture_config().camera_id)
+
+@router.get("/frames")
+async def frames(
+    from_time: Optional[datetime] = Query(None, alias="from"),
+    to_time: Optional[datetime] = Query(None, alias="to"),
+    step: int = 0,
+    limit: int = 100,
+    after: Optional[float] = None
+):
+    """Връща архивираните кадри в даден интервал (step - един кадър на step секунди)"""
+    return await _frames(get_capture_config().camera_id, from_time, to_time, step, limit, after)
+
+@router.get("/frames/nearest")
+async def nearest_frame(t: datetime):
+    """Връща най-близкия до момента t архивиран кадър"""
+    return await _nearest_frame(get_capture_config().camera_id, t)
+
+@router.get("/timelapse")
+async def timelapse(
+    day: Optional[date] = None,
+    fps: int = 24,
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+    format: str = "mp4"
+):
+    """Timelapse видео за даден ден (по подразбиране днес)"""
+    return await _timelapse(get_capture_config().camera_id, day, fps, width, height, format)
+
+@router.get("/info")
+async def rtsp_info():
+    """Връща информация за последния запазен кадър"""
+    return _camera_info(get_capture_config().camera_id)
+
+@router.get("/capture")
+async def api_capture():
+    """Принудително извличане на нов кадър"""
+    return await _camera_capture(get_capture_config().camera_id)
+
+@router.get("/cameras")
+async def cameras():
+    """Връща списък с всички регистрирани камери и състоянието на планирането"""
+    from .manager import get_capture_manager
+    
+    return JSONResponse({
+        "status": "ok",
+        "cameras": [
+            {
+                "camera_id": config.camera_id,
+                "status": config.status,
+                "rtsp_url": config.rtsp_url,
+                "interval": config.interval,
+                "width": config.width,
+                "height": config.height,
+                "quality": config.quality,
+                "save_dir": config.save_dir,
+                "running": config.running,
+                "last_frame_time": config.last_frame_time.isoformat() if config.last_frame_time else None,
+                "latest_url": _latest_url(config.camera_id)
+            }
+            for config in list_cameras()
+        ],
+        "manager": get_capture_manager().get_status()
+    })
+
+@router.get("/archive")
+async def archive_status():
+    """Връща състоянието на записа и на политиката за съхранение на архива"""
+    return JSONResponse({
+        "status": "ok",
+        "writer": get_archive_writer().get_status(),
+        "retention": get_archive_retention().get_status()
+    })
+
+@router.post("/config")
+async def update_config(
+    rtsp_url: str = Form(None),
+    interval: int = Form(None),
+    width: int = Form(None),
+    height: int = Form(None),
+    quality: int = Form(None)
+):
+    """Обновява конфигурацията на RTSP модула"""
+    update_params = {}
+    
+    if rtsp_url is not None:
+        update_params["rtsp_url"] = rtsp_url
+    
+    if interval is not None:
+        update_params["interval"] = interval
+    
+    if width is not None:
+        update_params["width"] = width
+    
+    if height is not None:
+        update_params["height"] = height
+    
+    if quality is not None:
+        update_params["quality"] = quality
+    
+    # Обновяваме конфигурацията
+    updated_config = update_capture_config(**update_params)
+    
+    return JSONResponse({
+        "status": "ok",
+        "message": "Конфигурацията е обновена успешно",
+        "config": {
+            "rtsp_url": updated_config.rtsp_url,
+            "interval": updated_config.interval,
+            "width": updated_config.width,
+            "height": updated_config.height,
+            "quality": updated_config.quality
+        }
+    })
+
+@router.get("/start")
+async def start_capture():
+    """Стартира процеса за извличане на кадри"""
+    _require_leader()
+    success = await get_capture_service().run(start_capture_thread)
+    
+    if success:
+        return JSONResponse({
+            "status": "ok",
+            "message": "Capture thread started successfully"
+        })
+    else:
+        return JSONResponse({
+            "status": "warning",
+            "message": "Capture thread is already running"
+        })
+
+@router.get("/stop")
+async def stop_capture():
+    """Спира процеса за извличане на кадри"""
+    _require_leader()
+    success = await get_capture_service().run(stop_capture_thread)
+    
+    if success:
+        return JSONResponse({
+            "status": "ok",
+            "message": "Capture thread stopping"
+        })
+    else:
+        return JSONResponse({
+            "status": "error",
+            "message": "Failed to stop capture thread"
+        }, status_code=500)
+
+@router.get("/{camera_id}/latest.jpg")
+async def camera_latest_jpg(request: Request, camera_id: str):
+    """Връща последния запазен JPEG кадър за дадена камера"""
+    return _latest_jpg(request, camera_id)
+
+@router.get("/{camera_id}/info")
+async def camera_info(camera_id: str):
+    """Връща информация за последния кадър на дадена камера"""
+    return _camera_info(camera_id)
+
+@router.get("/{camera_id}/capture")
+async def camera_capture(camera_id: str):
+    """Принудително извличане на нов кадър от дадена камера"""
+    return await _camera_capture(camera_id)
+
+@router.get("/{camera_id}/stream.mjpg")
+async def camera_stream_mjpg(camera_id: str):
+    """MJPEG поток на живо от дадена камера"""
+    return _stream(camera_id)
+
+@router.get("/{camera_id}/frames")
+async def camera_frames(
+    camera_id: str,
+    from_time: Optional[datetime] = Query(None, alias="from"),
+    to_time: Optional[datetime] = Query(None, alias="to"),
+    step: int = 0,
+    limit: int = 100,
+    after: Optional[float] = None
+):
+    """Връща архивираните кадри на дадена камера в даден интервал"""
+    return await _frames(camera_id, from_time, to_time, step, limit, after)
+
+@router.get("/{camera_id}/frames/nearest")
+async def camera_nearest_frame(camera_id: str, t: datetime):
+    """Връща най-близкия до момента t архивиран кадър на дадена камера"""
+    return await _nearest_frame(camera_id, t)
+
+@router.get("/{camera_id}/timelapse")
+async def camera_timelapse(
+    camera_id: str,
+    day: Optional[date] = None,
+    fps: int = 24,
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+    format: str = "mp4"
+):
+    """Timelapse видео за дадена камера и ден"""
+    return await _timelapse(camera_id, day, fps, width, height, format)
+
+@router.get("/{camera_id}/archive/{filename}")
+async def camera_archive_frame(camera_id: str, filename: str):
+    """Връща архивиран кадър по име на файла"""
+    config = _get_camera_or_404(camera_id)
+    when = parse_frame_time(filename)
+    
+    if when is None:
+        raise HTTPException(status_code=400, detail="Невалидно име на кадър")
+    
+    path = os.path.join(frame_dir(config.save_dir, when, create=False), filename)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Кадърът не е намерен")
+    
+    return FileResponse(path, media_type="image/jpeg")
\ No newline at end of file
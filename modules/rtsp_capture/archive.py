@@ -0,0 +1,496 @@
+"""
+Архив на кадрите: разделяне по дати, ротация и компактиране
+
+Кадрите се записват в поддиректории save_dir/YYYY/MM/DD. Фонов процес
+прилага политиката за съхранение инкрементално, директория по директория:
+- разреждане на старите кадри по нива (например всички за 24 часа, един на
+  10 минути до 30 дни, един на час след това)
+- изтриване на дните, по-стари от максималната възраст
+- изтриване на най-старите дни, когато архивът надхвърли зададения размер
+
+Записът на новите кадри е етап "archive" от шината за събития: ArchiveWriter
+получава кадрите от capture_frame() през собствена опашка и ги записва на
+диска във фонов thread, така че извличането не чака файловата система.
+Ако дискът забави и опашката се напълни, новият кадър се записва веднага в
+thread-а на извличането, вместо да се загуби.
+"""
+
+import os
+import time
+import shutil
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple, Any
+
+from pydantic import BaseModel
+
+from .config import list_cameras, get_camera_config, update_camera_config
+from .catalog import get_frame_catalog
+from utils.logger import setup_logger
+from utils.helpers import atomic_write, atomic_link
+from utils.events import FrameEvent, get_event_bus, DROP_NEWEST
+from utils.metrics import Histogram
+
+# Инициализиране на логър
+logger = setup_logger("rtsp_archive")
+
+# Формат на имената на кадрите (с микросекунди, за да не се презаписват кадри от една секунда)
+FRAME_PREFIX = "frame_"
+FRAME_TIME_FORMAT = "%Y%m%d_%H%M%S_%f"
+# Стар формат със секунди, който още се среща в архива
+LEGACY_FRAME_TIME_FORMAT = "%Y%m%d_%H%M%S"
+
+# Маркер за вече компактирана дневна директория
+RETENTION_MARKER = ".retention"
+
+# Име на етапа за запис в шината за събития
+ARCHIVE_STAGE = "archive"
+
+FRAME_WRITE_SECONDS = Histogram(
+    "frame_write_seconds", "Време за запис на кадъра на диска", ["camera"]
+)
+
+class RetentionTier(BaseModel):
+    """Ниво на разреждане: кадри по-стари от min_age се пазят по един на step секунди"""
+    min_age: int  # Секунди
+    step: int  # Секунди (0 - пазим всички)
+
+class RetentionPolicy(BaseModel):
+    """Политика за съхранение на архива"""
+    tiers: List[RetentionTier]
+    max_age_days: int = 0  # 0 - без ограничение
+    max_bytes: int = 0  # 0 - без ограничение
+    interval: int = 600  # Интервал между проходите в секунди
+    migrate_batch: int = 1000  # Брой стари (плоски) файлове, преместени на проход
+
+def parse_tiers(value: str) -> List[RetentionTier]:
+    """
+    Разчита нивата от низ във формат "min_age:step,..." в секунди,
+    например "86400:600,2592000:3600"
+    """
+    tiers = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        min_age, step = item.split(":")
+        tiers.append(RetentionTier(min_age=int(min_age), step=int(step)))
+    return sorted(tiers, key=lambda tier: tier.min_age)
+
+# Глобална политика на модула
+_policy = RetentionPolicy(
+    tiers=parse_tiers(os.getenv("RETENTION_TIERS", "86400:600,2592000:3600")),
+    max_age_days=int(os.getenv("RETENTION_MAX_AGE_DAYS", "0")),
+    max_bytes=int(os.getenv("RETENTION_MAX_BYTES", "0")),
+    interval=int(os.getenv("RETENTION_INTERVAL", "600"))
+)
+
+def get_retention_policy() -> RetentionPolicy:
+    """Връща текущата политика за съхранение"""
+    return _policy
+
+def frame_filename(when: datetime) -> str:
+    """Връща името на файла за кадър, заснет в дадения момент"""
+    return f"{FRAME_PREFIX}{when.strftime(FRAME_TIME_FORMAT)}.jpg"
+
+def frame_dir(save_dir: str, when: datetime, create: bool = True) -> str:
+    """Връща дневната директория за дадения момент и я създава при нужда"""
+    day_dir = os.path.join(save_dir, when.strftime("%Y"), when.strftime("%m"), when.strftime("%d"))
+    if create:
+        os.makedirs(day_dir, exist_ok=True)
+    return day_dir
+
+def frame_path(save_dir: str, when: datetime, create: bool = True) -> str:
+    """Връща пътя до кадъра в дневната директория и я създава при нужда"""
+    return os.path.join(frame_dir(save_dir, when, create), frame_filename(when))
+
+def parse_frame_time(filename: str) -> Optional[datetime]:
+    """Извлича момента на заснемане от името на файла (нов или стар формат) или връща None"""
+    if not filename.startswith(FRAME_PREFIX) or not filename.endswith(".jpg"):
+        return None
+    value = filename[len(FRAME_PREFIX):-4]
+    for time_format in (FRAME_TIME_FORMAT, LEGACY_FRAME_TIME_FORMAT):
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            continue
+    return None
+
+def list_day_dirs(save_dir: str) -> List[Tuple[datetime, str]]:
+    """Връща дневните директории на архива, сортирани от най-старата"""
+    days = []
+    for year in _sorted_digits(save_dir):
+        year_dir = os.path.join(save_dir, year)
+        for month in _sorted_digits(year_dir):
+            month_dir = os.path.join(year_dir, month)
+            for day in _sorted_digits(month_dir):
+                try:
+                    days.append((datetime(int(year), int(month), int(day)), os.path.join(month_dir, day)))
+                except ValueError:
+                    continue
+    return days
+
+def _sorted_digits(path: str) -> List[str]:
+    """Връща сортираните числови поддиректории"""
+    try:
+        return sorted(
+            entry.name for entry in os.scandir(path)
+            if entry.is_dir() and entry.name.isdigit()
+        )
+    except FileNotFoundError:
+        return []
+
+def catalog_row(camera_id: str, when: datetime, path: str) -> tuple:
+    """Подготвя ред за каталога; размерите се четат само от заглавката на JPEG"""
+    from PIL import Image
+    
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+    except Exception:
+        width, height = 0, 0
+    return (camera_id, when, path, os.path.getsize(path), width, height)
+
+# Момент на най-новия записан кадър по камера (за latest.jpg)
+_latest_written: Dict[str, datetime] = {}
+_latest_lock = threading.Lock()
+
+def write_frame(event: FrameEvent) -> Optional[str]:
+    """Записва кадъра в архива, добавя го в каталога и обновява latest.jpg"""
+    config = get_camera_config(event.camera_id)
+    if config is None:
+        return None
+
+    # Записваме кадъра като JPEG файл (атомарно, за да не се виждат непълни файлове)
+    filepath = frame_path(config.save_dir, event.timestamp)
+    with FRAME_WRITE_SECONDS.timer(camera=event.camera_id):
+        atomic_write(filepath, event.data)
+
+    # Добавяме кадъра в каталога на архива
+    try:
+        get_frame_catalog().add_frame(event.camera_id, event.timestamp, filepath, len(event.data), event.width, event.height)
+    except Exception as e:
+        logger.error(f"Грешка при добавяне на кадъра в каталога: {str(e)}")
+
+    # Публикуваме същия файл като latest.jpg чрез hardlink и атомарно преименуване;
+    # кадър, записан извън опашката, може да изпревари по-стари чакащи кадри
+    with _latest_lock:
+        newest = _latest_written.get(event.camera_id)
+        if newest is None or event.timestamp >= newest:
+            _latest_written[event.camera_id] = event.timestamp
+            latest_path = os.path.join(config.save_dir, "latest.jpg")
+            atomic_link(filepath, latest_path, event.data)
+            update_camera_config(event.camera_id, last_frame_path=filepath)
+    logger.info(f"[{event.camera_id}] Успешно запазен кадър в: {filepath}")
+    return filepath
+
+class ArchiveWriter:
+    """Етап на шината, който записва новите кадри на диска във фонов thread"""
+
+    def __init__(self, queue_size: int = 32):
+        self.queue_size = queue_size
+        self._queue = None
+        self._thread: Optional[threading.Thread] = None
+        self.stats: Dict[str, int] = {"written": 0, "failed": 0, "inline": 0}
+
+    def start(self) -> bool:
+        """Абонира етапа за кадрите и стартира thread-а за запис"""
+        if self._thread is not None and self._thread.is_alive():
+            return False
+
+        # При пълна опашка новият кадър не влиза в нея, а се записва веднага
+        self._queue = get_event_bus().subscribe(ARCHIVE_STAGE, self.queue_size, DROP_NEWEST, on_drop=self._write_inline)
+        self._thread = threading.Thread(target=self._loop, args=(self._queue,), name="rtsp-archive-writer")
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def stop(self):
+        """Спира приемането на кадри; чакащите в опашката се записват преди спиране"""
+        if self._queue is not None:
+            get_event_bus().unsubscribe(ARCHIVE_STAGE, self._queue)
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=10)
+        self._thread = None
+
+    def _loop(self, queue):
+        """Записва кадрите от опашката, докато тя не бъде затворена и изпразнена"""
+        while True:
+            event = queue.get()
+            if event is None:
+                break
+            try:
+                write_frame(event)
+                self.stats["written"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error(f"[{event.camera_id}] Грешка при запис на кадъра: {str(e)}")
+
+    def _write_inline(self, event: FrameEvent):
+        """Записва кадъра, който не се е побрал в опашката, в thread-а на извличането"""
+        self.stats["inline"] += 1
+        logger.warning(f"[{event.camera_id}] Опашката за запис е пълна, кадърът се записва веднага")
+        try:
+            write_frame(event)
+            self.stats["written"] += 1
+        except Exception as e:
+            self.stats["failed"] += 1
+            logger.error(f"[{event.camera_id}] Грешка при запис на кадъра: {str(e)}")
+
+    def get_status(self) -> Dict[str, Any]:
+        """Връща броячите и опашката на етапа"""
+        return {
+            "running": self._thread is not None and self._thread.is_alive(),
+            "queue": self._queue.snapshot() if self._queue is not None else None,
+            "stats": dict(self.stats)
+        }
+
+class ArchiveRetention:
+    """Фонов процес, който прилага политиката за съхранение на всички камери"""
+
+    def __init__(self, policy: RetentionPolicy):
+        self.policy = policy
+        self._thread: Optional[threading.Thread] = None
+        self._wakeup = threading.Event()
+        self._running = False
+        self._day_sizes: Dict[str, int] = {}
+        self.last_run: Optional[datetime] = None
+        self.stats: Dict[str, int] = {"deleted_files": 0, "deleted_days": 0, "migrated_files": 0, "indexed_files": 0}
+        self._indexed = set()
+
+    def start(self) -> bool:
+        """Стартира фоновия процес"""
+        if self._thread is not None and self._thread.is_alive():
+            return False
+
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name="rtsp-retention")
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info("Retention thread started")
+        return True
+
+    def stop(self):
+        """Спира фоновия процес"""
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+
+    def trigger(self):
+        """Стартира незабавен проход"""
+        self._wakeup.set()
+
+    def _loop(self):
+        """Основен цикъл: проход за всяка камера на всеки policy.interval секунди"""
+        while self._running:
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Неочаквана грешка в retention цикъла: {str(e)}")
+
+            self._wakeup.wait(self.policy.interval)
+            self._wakeup.clear()
+
+    def run_once(self):
+        """Изпълнява един проход на политиката за всички камери"""
+        for config in list_cameras():
+            if not self._running:
+                break
+            self._migrate_flat_frames(config.camera_id, config.save_dir)
+            self._index_if_empty(config.camera_id, config.save_dir)
+            self._apply(config.camera_id, config.save_dir)
+        self.last_run = datetime.now()
+
+    def _required_step(self, age: float) -> int:
+        """Връща стъпката на разреждане за кадър на дадена възраст"""
+        step = 0
+        for tier in self.policy.tiers:
+            if age >= tier.min_age:
+                step = tier.step
+        return step
+
+    def _index_if_empty(self, camera_id: str, save_dir: str):
+        """Индексира съществуващия архив, ако каталогът още няма кадри за камерата"""
+        if camera_id in self._indexed:
+            return
+        self._indexed.add(camera_id)
+
+        catalog = get_frame_catalog()
+        if catalog.count(camera_id) > 0:
+            return
+
+        indexed = 0
+        for _, day_dir in list_day_dirs(save_dir):
+            if not self._running:
+                return
+            rows = []
+            for entry in os.scandir(day_dir):
+                when = parse_frame_time(entry.name)
+                if when is not None:
+                    rows.append(catalog_row(camera_id, when, entry.path))
+            catalog.add_frames(rows)
+            indexed += len(rows)
+
+        if indexed:
+            self.stats["indexed_files"] += indexed
+            logger.info(f"[{camera_id}] Индексирани {indexed} съществуващи кадъра в каталога")
+
+    def _migrate_flat_frames(self, camera_id: str, save_dir: str):
+        """Премества кадрите от стария плосък формат в дневни директории"""
+        moved = 0
+        rows = []
+        try:
+            entries = list(os.scandir(save_dir))
+        except FileNotFoundError:
+            return
+
+        for entry in entries:
+            if moved >= self.policy.migrate_batch:
+                break
+            when = parse_frame_time(entry.name)
+            if when is None or not entry.is_file():
+                continue
+            new_path = os.path.join(frame_dir(save_dir, when), entry.name)
+            os.replace(entry.path, new_path)
+            rows.append(catalog_row(camera_id, when, new_path))
+            moved += 1
+
+        if moved:
+            get_frame_catalog().add_frames(rows)
+            self.stats["migrated_files"] += moved
+            logger.info(f"Преместени {moved} кадъра в дневни директории ({save_dir})")
+
+    def _apply(self, camera_id: str, save_dir: str):
+        """Прилага политиката върху архива на една камера"""
+        now = datetime.now()
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        days = list_day_dirs(save_dir)
+
+        for day, day_dir in days:
+            if not self._running:
+                return
+
+            # Изтриваме целите дни, по-стари от максималната възраст
+            if self.policy.max_age_days > 0 and day + timedelta(days=1) < now - timedelta(days=self.policy.max_age_days):
+                self._delete_day(camera_id, day, day_dir)
+                continue
+
+            # Най-старият възможен кадър в деня определя най-голямата стъпка
+            step_oldest = self._required_step((now - day).total_seconds())
+            step_newest = self._required_step((now - day - timedelta(days=1)).total_seconds())
+            if step_oldest == 0:
+                continue
+
+            if self._read_marker(day_dir) == step_oldest == step_newest:
+                continue
+
+            self._compact_day(camera_id, day_dir, now)
+            if step_oldest == step_newest:
+                self._write_marker(day_dir, step_oldest)
+
+            # Не натоварваме диска - кратка пауза между директориите
+            time.sleep(0.05)
+
+        self._enforce_size(camera_id, [(day, day_dir) for day, day_dir in list_day_dirs(save_dir) if day < today])
+
+    def _compact_day(self, camera_id: str, day_dir: str, now: datetime):
+        """Разрежда кадрите в дневна директория според нивата"""
+        frames = []
+        for entry in os.scandir(day_dir):
+            when = parse_frame_time(entry.name)
+            if when is not None:
+                frames.append((when, entry.path))
+        frames.sort()
+
+        kept_buckets = set()
+        removed = []
+        for when, path in frames:
+            step = self._required_step((now - when).total_seconds())
+            if step <= 0:
+                continue
+            bucket = (step, int(when.timestamp()) // step)
+            if bucket in kept_buckets:
+                removed.append(path)
+            else:
+                kept_buckets.add(bucket)
+
+        for path in removed:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        if removed:
+            self._day_sizes.pop(day_dir, None)
+            self.stats["deleted_files"] += len(removed)
+            get_frame_catalog().remove_paths(removed)
+            logger.info(f"[{camera_id}] Разредени {len(removed)} кадъра в {day_dir}")
+
+    def _enforce_size(self, camera_id: str, days: List[Tuple[datetime, str]]):
+        """Изтрива най-старите дни, докато архивът не влезе в лимита (текущият ден се пази)"""
+        if self.policy.max_bytes <= 0:
+            return
+
+        sizes = [(day, day_dir, self._day_size(day_dir)) for day, day_dir in days]
+        total = sum(size for _, _, size in sizes)
+
+        for day, day_dir, size in sizes:
+            if total <= self.policy.max_bytes:
+                break
+            self._delete_day(camera_id, day, day_dir)
+            total -= size
+
+    def _day_size(self, day_dir: str) -> int:
+        """Връща размера на дневна директория (кеширан за непроменени дни)"""
+        if day_dir not in self._day_sizes:
+            self._day_sizes[day_dir] = sum(
+                entry.stat().st_size for entry in os.scandir(day_dir) if entry.is_file()
+            )
+        return self._day_sizes[day_dir]
+
+    def _delete_day(self, camera_id: str, day: datetime, day_dir: str):
+        """Изтрива цяла дневна директория"""
+        removed = sum(1 for entry in os.scandir(day_dir) if parse_frame_time(entry.name))
+        shutil.rmtree(day_dir, ignore_errors=True)
+        self._day_sizes.pop(day_dir, None)
+        self.stats["deleted_days"] += 1
+        self.stats["deleted_files"] += removed
+        get_frame_catalog().remove_range(camera_id, day, day + timedelta(days=1))
+        logger.info(f"[{camera_id}] Изтрита дневна директория {day_dir}")
+
+    def _read_marker(self, day_dir: str) -> Optional[int]:
+        """Чете стъпката, с която денят вече е компактиран"""
+        try:
+            with open(os.path.join(day_dir, RETENTION_MARKER), "r") as f:
+                return int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_marker(self, day_dir: str, step: int):
+        """Записва стъпката, с която денят е компактиран"""
+        with open(os.path.join(day_dir, RETENTION_MARKER), "w") as f:
+            f.write(str(step))
+
+    def get_status(self) -> Dict[str, Any]:
+        """Връща състоянието на процеса"""
+        return {
+            "running": self._running,
+            "last_run": self.last_run.isoformat() if self.last_run else None,
+            "policy": self.policy.model_dump(),
+            "stats": dict(self.stats)
+        }
+
+# Глобален процес на модула
+_retention = ArchiveRetention(_policy)
+
+def get_archive_retention() -> ArchiveRetention:
+    """Връща глобалния процес за съхранение"""
+    return _retention
+
+# Глобален етап за запис на кадрите
+_writer = ArchiveWriter(queue_size=int(os.getenv("ARCHIVE_QUEUE_SIZE", "32")))
+
+def get_archive_writer() -> ArchiveWriter:
+    """Връща етапа за запис на новите кадри"""
+    return _writer
@@ -1,198 +1,241 @@
-"""
-Основна логика за захващане на кадри от RTSP поток
-"""
-
-import os
-import cv2
-import time
-import threading
-from datetime import datetime
-import numpy as np
-from PIL import Image
-from io import BytesIO
-
-from .config import get_capture_config, update_capture_config
-from utils.logger import setup_logger
-
-# Инициализиране на логър
-logger = setup_logger("rtsp_capture")
-
-def capture_frame() -> bool:
-    """Извлича един кадър от RTSP потока и го записва като JPEG файл"""
-    config = get_capture_config()
-    
-    try:
-        logger.info(f"Опит за свързване с RTSP поток: {config.rtsp_url}")
-        
-        # Създаваме VideoCapture обект директно с FFMPEG backend
-        cap = cv2.VideoCapture(config.rtsp_url, cv2.CAP_FFMPEG)
-        
-        # Проверяваме дали потокът е отворен
-        if not cap.isOpened():
-            logger.error(f"Не може да се отвори RTSP потока: {config.rtsp_url}")
-            update_capture_config(status="error")
-            return False
-        
-        logger.info("RTSP потокът е отворен успешно")
-        
-        # Конфигурация за по-добра работа
-        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-        
-        # Четем кадъра със 5-секунден таймаут
-        has_frame = False
-        start_time = time.time()
-        frame = None
-        
-        while not has_frame and time.time() - start_time < 5:
-            ret, frame = cap.read()
-            if ret and frame is not None:
-                has_frame = True
-                break
-            time.sleep(0.1)
-        
-        # Освобождаваме ресурсите
-        cap.release()
-        
-        if not has_frame or frame is None:
-            logger.error("Не може да се прочете кадър от RTSP потока")
-            update_capture_config(status="error")
-            return False
-        
-        # Преоразмеряваме кадъра, ако е нужно
-        if config.width > 0 and config.height > 0:
-            frame = cv2.resize(frame, (config.width, config.height))
-        
-        # Генерираме име на файла с текущата дата и час
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"frame_{timestamp}.jpg"
-        filepath = os.path.join(config.save_dir, filename)
-        
-        # Записваме кадъра като JPEG файл
-        encode_params = [cv2.IMWRITE_JPEG_QUALITY, config.quality]
-        cv2.imwrite(filepath, frame, encode_params)
-        
-        # Също така записваме кадъра като latest.jpg за лесен достъп
-        latest_path = os.path.join(config.save_dir, "latest.jpg")
-        cv2.imwrite(latest_path, frame, encode_params)
-        
-        # Обновяваме конфигурацията
-        update_capture_config(
-            last_frame_path=filepath,
-            last_frame_time=datetime.now(),
-            status="ok"
-        )
-        
-        logger.info(f"Успешно запазен кадър в: {filepath}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"Грешка при извличане на кадър: {str(e)}")
-        update_capture_config(status="error")
-        return False
-
-def get_placeholder_image() -> bytes:
-    """Създава placeholder изображение, когато няма наличен кадър"""
-    config = get_capture_config()
-    
-    # Създаване на празно изображение с текст
-    placeholder = np.zeros((config.height, config.width, 3), dtype=np.uint8)
-    
-    # Добавяне на текст в зависимост от статуса
-    if config.status == "initializing":
-        message = "Waiting for first frame..."
-    elif config.status == "error":
-        message = "Error: Could not capture frame"
-    else:
-        message = "No image available"
-    
-    # Добавяне на текст към изображението
-    cv2.putText(
-        placeholder, 
-        message, 
-        (50, config.height // 2),
-        cv2.FONT_HERSHEY_SIMPLEX, 
-        1, 
-        (255, 255, 255), 
-        2
-    )
-    
-    # Конвертиране към bytes
-    is_success, buffer = cv2.imencode(".jpg", placeholder)
-    if is_success:
-        return BytesIO(buffer).getvalue()
-    else:
-        # Връщаме празен BytesIO, ако не успеем да кодираме
-        return BytesIO().getvalue()
-
-def capture_loop():
-    """Основен цикъл за периодично извличане на кадри"""
-    config = get_capture_config()
-    
-    while config.running:
-        try:
-            capture_frame()
-        except Exception as e:
-            logger.error(f"Неочаквана грешка в capture_loop: {str(e)}")
-        
-        # Обновяваме конфигурацията (за случай, че е променена)
-        config = get_capture_config()
-        
-        # Спим до следващото извличане
-        time.sleep(config.interval)
-
-# Инициализиране на capture_thread
-capture_thread = None
-
-def start_capture_thread():
-    """Стартира фонов процес за извличане на кадри"""
-    global capture_thread
-    
-    if capture_thread is None or not capture_thread.is_alive():
-        capture_thread = threading.Thread(target=capture_loop)
-        capture_thread.daemon = True
-        capture_thread.start()
-        logger.info("Capture thread started")
-        return True
-    
-    return False
-
-def stop_capture_thread():
-    """Спира фоновия процес за извличане на кадри"""
-    update_capture_config(running=False)
-    logger.info("Capture thread stopping")
-    return True
-
-# Създаваме placeholder image file при стартиране
-def initialize():
-    """Инициализира модула"""
-    config = get_capture_config()
-    
-    # Създаваме директорията ако не съществува
-    os.makedirs(config.save_dir, exist_ok=True)
-    
-    # Създаваме placeholder за latest.jpg ако не съществува
-    latest_path = os.path.join(config.save_dir, "latest.jpg")
-    if not os.path.exists(latest_path):
-        placeholder = np.zeros((config.height, config.width, 3), dtype=np.uint8)
-        cv2.putText(
-            placeholder, 
-            "Waiting for first frame...", 
-            (50, config.height // 2),
-            cv2.FONT_HERSHEY_SIMPLEX, 
-            1, 
-            (255, 255, 255), 
-            2
-        )
-        cv2.imwrite(latest_path, placeholder)
-    
-    # Опитваме се да извлечем първия кадър
-    initial_result = capture_frame()
-    logger.info(f"Резултат от първото извличане: {'успешно' if initial_result else 'неуспешно'}")
-    
-    # Стартиране на capture thread
-    start_capture_thread()
-    
-    return True
-
-# Автоматично инициализиране при import
-initialize()
\ No newline at end of file
+"""
+Основна логика за захващане на кадри от RTSP поток
+"""
+
+import os
+import time
+import threading
+from datetime import datetime
+from io import BytesIO
+from typing import Dict
+
+from .config import (
+    get_capture_config, update_capture_config, get_camera_config, update_camera_config,
+    list_cameras
+)
+from .session import get_session, stop_session
+from .frame_cache import get_frame_cache
+from .archive import get_archive_retention, get_archive_writer, write_frame, parse_frame_time, ARCHIVE_STAGE
+from utils.logger import setup_logger
+from utils.helpers import atomic_write
+from utils.events import FrameEvent, get_event_bus
+from utils.shared_frames import publish_shared_frame, close_rings
+from utils.metrics import Counter, Histogram
+from utils.state import on_refresh
+
+# Инициализиране на логър
+logger = setup_logger("rtsp_capture")
+
+# Метрики на извличането
+FRAME_READ_SECONDS = Histogram("frame_read_seconds", "Време за взимане на кадър от RTSP сесията", ["camera"])
+FRAME_RESIZE_SECONDS = Histogram("frame_resize_seconds", "Време за преоразмеряване на кадъра", ["camera"])
+FRAME_ENCODE_SECONDS = Histogram("frame_encode_seconds", "Време за JPEG кодиране на кадъра", ["camera"])
+CAPTURES_TOTAL = Counter("captures_total", "Извличания на кадри по резултат", ["camera", "outcome"])
+
+def capture_frame(camera_id: str = "default") -> bool:
+    """Извлича един кадър от RTSP потока на камерата и го записва като JPEG файл"""
+    import cv2
+    
+    config = get_camera_config(camera_id)
+    
+    if config is None:
+        logger.error(f"Непозната камера: {camera_id}")
+        return False
+    
+    try:
+        # Взимаме последния кадър от дълготрайната сесия вместо да отваряме потока наново
+        session = get_session(config.rtsp_url, camera_id)
+        with FRAME_READ_SECONDS.timer(camera=camera_id):
+            # Затворен между извличанията поток се нуждае от време за отваряне и ключов кадър
+            frame, frame_time = session.get_frame(timeout=5 if session.connected else 15, max_age=10)
+        
+        if frame is None:
+            logger.error("Не може да се прочете кадър от RTSP потока")
+            update_camera_config(camera_id, status="error")
+            CAPTURES_TOTAL.inc(camera=camera_id, outcome="no_frame")
+            return False
+        
+        # Преоразмеряваме кадъра, ако е нужно
+        if config.width > 0 and config.height > 0:
+            with FRAME_RESIZE_SECONDS.timer(camera=camera_id):
+                frame = cv2.resize(frame, (config.width, config.height))
+        
+        now = datetime.now()
+        
+        # Кодираме кадъра като JPEG веднъж и използваме байтовете навсякъде
+        encode_params = [cv2.IMWRITE_JPEG_QUALITY, config.quality]
+        with FRAME_ENCODE_SECONDS.timer(camera=camera_id):
+            is_success, buffer = cv2.imencode(".jpg", frame, encode_params)
+        if not is_success:
+            logger.error("Не може да се кодира кадърът като JPEG")
+            update_camera_config(camera_id, status="error")
+            CAPTURES_TOTAL.inc(camera=camera_id, outcome="encode_error")
+            return False
+        jpeg_data = buffer.tobytes()
+        
+        # Публикуваме кадъра в кеша в паметта за бързо сервиране
+        get_frame_cache().publish(camera_id, jpeg_data, now)
+        
+        # И в споделената памет за останалите процеси (при SHARED_FRAMES=1)
+        try:
+            publish_shared_frame(camera_id, frame, jpeg_data, now.timestamp())
+        except Exception as e:
+            logger.error(f"Грешка при запис на кадъра в споделената памет: {str(e)}")
+        
+        event = FrameEvent(
+            camera_id=camera_id,
+            data=jpeg_data,
+            timestamp=now,
+            width=frame.shape[1],
+            height=frame.shape[0]
+        )
+        
+        # Без абониран етап за архива (например при самостоятелно извикване) записваме веднага
+        bus = get_event_bus()
+        if not bus.has_stage(ARCHIVE_STAGE):
+            write_frame(event)
+        
+        # Кадърът отива към архива и анализа през техните опашки
+        bus.publish(event)
+        
+        # Обновяваме конфигурацията
+        update_camera_config(
+            camera_id,
+            last_frame_time=now,
+            status="ok"
+        )
+        
+        CAPTURES_TOTAL.inc(camera=camera_id, outcome="ok")
+        return True
+        
+    except Exception as e:
+        logger.error(f"Грешка при извличане на кадър: {str(e)}")
+        update_camera_config(camera_id, status="error")
+        CAPTURES_TOTAL.inc(camera=camera_id, outcome="error")
+        return False
+
+def get_placeholder_image(camera_id: str = "default") -> bytes:
+    """Създава placeholder изображение, когато няма наличен кадър"""
+    import cv2
+    import numpy as np
+    
+    config = get_camera_config(camera_id) or get_capture_config()
+    
+    # Създаване на празно изображение с текст
+    placeholder = np.zeros((config.height, config.width, 3), dtype=np.uint8)
+    
+    # Добавяне на текст в зависимост от статуса
+    if config.status == "initializing":
+        message = "Waiting for first frame..."
+    elif config.status == "error":
+        message = "Error: Could not capture frame"
+    else:
+        message = "No image available"
+    
+    # Добавяне на текст към изображението
+    cv2.putText(
+        placeholder, 
+        message, 
+        (50, config.height // 2),
+        cv2.FONT_HERSHEY_SIMPLEX, 
+        1, 
+        (255, 255, 255), 
+        2
+    )
+    
+    # Конвертиране към bytes
+    is_success, buffer = cv2.imencode(".jpg", placeholder)
+    if is_success:
+        return BytesIO(buffer).getvalue()
+    else:
+        # Връщаме празен BytesIO, ако не успеем да кодираме
+        return BytesIO().getvalue()
+
+def start_capture_thread():
+    """Стартира фоновото извличане на кадри за всички камери"""
+    # Импортираме тук, за да избегнем цикличен import с manager модула
+    from .manager import get_capture_manager
+    
+    for config in list_cameras():
+        config.running = True
+    
+    # Записът и политиката за съхранение на архива работят в собствени фонови thread-ове
+    get_archive_writer().start()
+    get_archive_retention().start()
+    
+    return get_capture_manager().start()
+
+def stop_capture_thread():
+    """Спира фоновото извличане на кадри"""
+    from .manager import get_capture_manager
+    
+    for config in list_cameras():
+        config.running = False
+    
+    get_capture_manager().stop()
+    get_archive_writer().stop()
+    get_archive_retention().stop()
+    stop_session()
+    close_rings()
+    logger.info("Capture thread stopping")
+    return True
+
+# Последният зареден от диска кадър по камера в процесите-последователи
+_loaded_frame_paths: Dict[str, str] = {}
+
+def _load_leader_frames():
+    """
+    В процес, който не извлича кадри, зарежда в кеша последния кадър на лидера
+
+    Извиква се от StateRefresher след обновяването на конфигурацията: при нов
+    last_frame_path файлът се прочита веднъж и се сервира от паметта. Без
+    SHARED_FRAMES=1 това е единственият източник на нови кадри за процеса.
+    """
+    cache = get_frame_cache()
+    for config in list_cameras():
+        path = config.last_frame_path
+        if not path or _loaded_frame_paths.get(config.camera_id) == path:
+            continue
+
+        when = parse_frame_time(os.path.basename(path)) or config.last_frame_time
+        cached = cache.peek(config.camera_id)
+        if cached is not None and when is not None and cached.timestamp >= when:
+            # Кешът вече има същия или по-нов кадър (например от споделената памет)
+            _loaded_frame_paths[config.camera_id] = path
+            continue
+
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            logger.warning(f"[{config.camera_id}] Кадърът на лидера не може да се прочете: {str(e)}")
+            continue
+
+        cache.publish(config.camera_id, data, when)
+        _loaded_frame_paths[config.camera_id] = path
+
+on_refresh(_load_leader_frames)
+
+# Създаваме placeholder image file при стартиране
+def initialize():
+    """Инициализира модула (извиква се от lifespan на приложението, не при import)"""
+    for config in list_cameras():
+        # Създаваме директорията ако не съществува
+        os.makedirs(config.save_dir, exist_ok=True)
+        
+        # Създаваме placeholder за latest.jpg ако не съществува
+        latest_path = os.path.join(config.save_dir, "latest.jpg")
+        if not os.path.exists(latest_path):
+            atomic_write(latest_path, get_placeholder_image(config.camera_id))
+        elif config.last_frame_time is None:
+            # Зареждаме последния кадър от предишното стартиране в кеша
+            with open(latest_path, "rb") as f:
+                get_frame_cache().publish(
+                    config.camera_id,
+                    f.read(),
+                    datetime.fromtimestamp(os.path.getmtime(latest_path))
+                )
+    
+    # Извличането се стартира от приложението само в процеса лидер
+    # (start_capture_thread); първото извличане се изпълнява от пула веднага
+    return True
\ No newline at end of file
@@ -0,0 +1,193 @@
+"""
+Индексиран каталог на архивираните кадри (SQLite)
+
+capture_frame() добавя всеки записан кадър, а retention процесът премахва
+изтритите. Заявките по времеви интервал и търсенето на най-близкия кадър
+използват индекса (camera_id, ts) вместо обхождане на директориите.
+"""
+
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from .config import get_capture_config
+from utils.logger import setup_logger
+
+# Инициализиране на логър
+logger = setup_logger("rtsp_catalog")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS frames (
+    camera_id TEXT NOT NULL,
+    ts REAL NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    PRIMARY KEY (camera_id, ts)
+) WITHOUT ROWID;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_frames_path ON frames (path);
+"""
+
+class FrameCatalog:
+    """SQLite индекс на кадрите по камера и време"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    def _row(self, row) -> Dict[str, Any]:
+        """Превръща ред от базата в речник"""
+        camera_id, ts, path, size, width, height = row
+        return {
+            "camera_id": camera_id,
+            "timestamp": datetime.fromtimestamp(ts).isoformat(),
+            "ts": ts,
+            "path": path,
+            "filename": os.path.basename(path),
+            "size": size,
+            "width": width,
+            "height": height
+        }
+
+    def add_frame(self, camera_id: str, when: datetime, path: str, size: int, width: int, height: int):
+        """Добавя (или заменя) кадър в каталога"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO frames (camera_id, ts, path, size, width, height) VALUES (?, ?, ?, ?, ?, ?)",
+                (camera_id, when.timestamp(), path, size, width, height)
+            )
+
+    def add_frames(self, rows: List[tuple]):
+        """Добавя много кадри в една транзакция: (camera_id, datetime, path, size, width, height)"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO frames (camera_id, ts, path, size, width, height) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(camera_id, when.timestamp(), path, size, width, height)
+                     for camera_id, when, path, size, width, height in rows]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def remove_paths(self, paths: List[str]):
+        """Премахва изтрити кадри по път"""
+        if not paths:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("DELETE FROM frames WHERE path = ?", [(path,) for path in paths])
+            self._conn.execute("COMMIT")
+
+    def remove_range(self, camera_id: str, start: datetime, end: datetime):
+        """Премахва кадрите на камерата в интервала [start, end)"""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM frames WHERE camera_id = ? AND ts >= ? AND ts < ?",
+                (camera_id, start.timestamp(), end.timestamp())
+            )
+
+    def count(self, camera_id: str) -> int:
+        """Връща броя на кадрите на камерата"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM frames WHERE camera_id = ?", (camera_id,)
+            ).fetchone()[0]
+
+    def query(
+        self,
+        camera_id: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        step: int = 0,
+        limit: int = 100,
+        after: Optional[float] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Връща кадрите в интервала [start, end), подредени по време
+
+        Args:
+            step: Ако е > 0, връща най-ранния кадър от всеки интервал от step секунди
+            limit: Максимален брой кадри
+            after: Само кадри със ts, строго по-голямо от after - за следващата
+                страница се подава ts на последния върнат кадър
+        """
+        start_ts = start.timestamp() if start else float("-inf")
+        end_ts = end.timestamp() if end else float("inf")
+        after_ts = after if after is not None else float("-inf")
+
+        if step > 0:
+            # SQLite връща останалите колони от реда с MIN(ts) в групата
+            sql = (
+                "SELECT camera_id, MIN(ts), path, size, width, height FROM frames "
+                "WHERE camera_id = ? AND ts >= ? AND ts < ? AND ts > ? "
+                "GROUP BY CAST(ts / ? AS INTEGER) ORDER BY 2 LIMIT ?"
+            )
+            params = (camera_id, start_ts, end_ts, after_ts, step, limit)
+        else:
+            sql = (
+                "SELECT camera_id, ts, path, size, width, height FROM frames "
+                "WHERE camera_id = ? AND ts >= ? AND ts < ? AND ts > ? ORDER BY ts LIMIT ?"
+            )
+            params = (camera_id, start_ts, end_ts, after_ts, limit)
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+
+        return [self._row(row) for row in rows]
+
+    def latest(self, camera_id: str, start: datetime, end: datetime) -> Optional[Dict[str, Any]]:
+        """Връща най-новия кадър в интервала [start, end) или None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT camera_id, ts, path, size, width, height FROM frames "
+                "WHERE camera_id = ? AND ts >= ? AND ts < ? ORDER BY ts DESC LIMIT 1",
+                (camera_id, start.timestamp(), end.timestamp())
+            ).fetchone()
+        return self._row(row) if row is not None else None
+
+    def nearest(self, camera_id: str, when: datetime) -> Optional[Dict[str, Any]]:
+        """Връща най-близкия по време кадър (две търсения по индекса)"""
+        ts = when.timestamp()
+        with self._lock:
+            before = self._conn.execute(
+                "SELECT camera_id, ts, path, size, width, height FROM frames "
+                "WHERE camera_id = ? AND ts <= ? ORDER BY ts DESC LIMIT 1",
+                (camera_id, ts)
+            ).fetchone()
+            after = self._conn.execute(
+                "SELECT camera_id, ts, path, size, width, height FROM frames "
+                "WHERE camera_id = ? AND ts >= ? ORDER BY ts LIMIT 1",
+                (camera_id, ts)
+            ).fetchone()
+
+        candidates = [row for row in (before, after) if row is not None]
+        if not candidates:
+            return None
+        return self._row(min(candidates, key=lambda row: abs(row[1] - ts)))
+
+# Глобален каталог на модула (създава се при първо използване)
+_catalog: Optional[FrameCatalog] = None
+_catalog_lock = threading.Lock()
+
+def get_frame_catalog() -> FrameCatalog:
+    """Връща глобалния каталог на кадрите"""
+    global _catalog
+
+    with _catalog_lock:
+        if _catalog is None:
+            db_path = os.getenv("FRAME_CATALOG", os.path.join(get_capture_config().save_dir, "catalog.db"))
+            _catalog = FrameCatalog(db_path)
+            logger.info(f"Каталог на кадрите: {db_path}")
+        return _catalog
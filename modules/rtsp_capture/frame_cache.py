@@ -0,0 +1,111 @@
+"""
+Кеш в паметта за последния кодиран кадър на всяка камера
+
+Capture процесът публикува готовите JPEG байтове тук, а API маршрутите ги
+сервират директно от RAM с ETag/Last-Modified, без да докосват файловата система.
+В процесите без собствено извличане (SHARED_FRAMES=1) новите кадри се взимат
+от споделената памет - по едно копие на кадър, след което се сервират оттук.
+"""
+
+import hashlib
+import threading
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+
+from pydantic import BaseModel
+
+from utils.shared_frames import open_ring
+
+class CachedFrame(BaseModel):
+    """Версия на кадър, съхранена в кеша"""
+    camera_id: str
+    data: bytes
+    version: int
+    timestamp: datetime
+    etag: str
+    last_modified: str
+
+class FrameCache:
+    """Версиониран кеш на последните JPEG кадри по камери"""
+
+    def __init__(self):
+        self._frames: Dict[str, CachedFrame] = {}
+        self._versions: Dict[str, int] = {}
+        # Последният взет кадър от споделената памет: (identity на буфера, пореден номер)
+        self._shared_seq: Dict[str, Tuple[Tuple[str, int], int]] = {}
+        self._lock = threading.Lock()
+
+    def publish(self, camera_id: str, data: bytes, timestamp: datetime = None) -> CachedFrame:
+        """Публикува нов кадър за камерата и връща новата версия"""
+        timestamp = timestamp or datetime.now()
+
+        # ETag по съдържание, за да остава валиден и след рестарт
+        etag = '"' + hashlib.blake2b(data, digest_size=12).hexdigest() + '"'
+        last_modified = format_datetime(timestamp.astimezone(timezone.utc), usegmt=True)
+
+        with self._lock:
+            version = self._versions.get(camera_id, 0) + 1
+            self._versions[camera_id] = version
+            frame = CachedFrame(
+                camera_id=camera_id,
+                data=data,
+                version=version,
+                timestamp=timestamp,
+                etag=etag,
+                last_modified=last_modified
+            )
+            self._frames[camera_id] = frame
+
+        return frame
+
+    def get(self, camera_id: str) -> Optional[CachedFrame]:
+        """Връща последния кадър за камерата или None"""
+        ring = open_ring(camera_id)
+        if ring is not None and not ring.owner:
+            # Номерата в пресъздаден буфер започват отначало
+            seen = self._shared_seq.get(camera_id)
+            seen_seq = seen[1] if seen is not None and seen[0] == ring.identity else 0
+            if ring.latest_seq() > seen_seq:
+                shared = ring.read_jpeg()
+                if shared is not None:
+                    seq, timestamp, data = shared
+                    self._shared_seq[camera_id] = (ring.identity, seq)
+                    return self.publish(camera_id, data, datetime.fromtimestamp(timestamp))
+
+        return self._frames.get(camera_id)
+
+    def peek(self, camera_id: str) -> Optional[CachedFrame]:
+        """Връща кадъра в кеша, без да проверява споделената памет"""
+        return self._frames.get(camera_id)
+
+    def clear(self, camera_id: str = None):
+        """Изчиства кеша за дадена камера или изцяло"""
+        with self._lock:
+            if camera_id is None:
+                self._frames.clear()
+            else:
+                self._frames.pop(camera_id, None)
+
+def is_not_modified(frame: CachedFrame, if_none_match: Optional[str], if_modified_since: Optional[str]) -> bool:
+    """Проверява условните заглавки на заявката спрямо кеширания кадър"""
+    if if_none_match:
+        # If-None-Match има предимство пред If-Modified-Since (RFC 9110)
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or any(tag.replace("W/", "", 1) == frame.etag for tag in tags)
+
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+            return frame.timestamp.astimezone().replace(microsecond=0) <= since
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+# Глобален кеш на модула
+_frame_cache = FrameCache()
+
+def get_frame_cache() -> FrameCache:
+    """Връща глобалния кеш на кадрите"""
+    return _frame_cache
@@ -0,0 +1,133 @@
+"""
+Мениджър за периодично извличане на кадри от много камери
+
+Един планиращ thread следи кога е ред на всяка камера и подава извличането
+към ограничен пул от работници, вместо всяка камера да има собствен спящ thread.
+"""
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, Any, Optional
+
+from .config import list_cameras
+from .capture import capture_frame
+from utils.logger import setup_logger
+
+# Инициализиране на логър
+logger = setup_logger("rtsp_manager")
+
+class CaptureManager:
+    """Планира извличането на кадри за всички регистрирани камери"""
+
+    def __init__(self, max_workers: int = 4):
+        self.max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._thread: Optional[threading.Thread] = None
+        self._wakeup = threading.Event()
+        self._running = False
+        self._next_due: Dict[str, float] = {}
+        self._in_flight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def start(self) -> bool:
+        """Стартира планиращия thread и пула от работници"""
+        if self._thread is not None and self._thread.is_alive():
+            if self._running:
+                return False
+            # Предишният thread още излиза след stop() - изчакваме го, преди да откажем
+            self._wakeup.set()
+            self._thread.join(timeout=5)
+            if self._thread.is_alive():
+                logger.warning("Предишният планиращ thread не спря навреме, мениджърът не е стартиран")
+                return False
+
+        self._running = True
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="rtsp-capture")
+        self._thread = threading.Thread(target=self._scheduler_loop, name="rtsp-scheduler")
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info(f"Capture manager started ({self.max_workers} работници)")
+        return True
+
+    def stop(self):
+        """Спира планирането; текущите извличания се довършват във фонов режим"""
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._next_due.clear()
+        logger.info("Capture manager stopping")
+
+    def trigger(self, camera_id: str):
+        """Насрочва незабавно извличане за дадена камера"""
+        self._next_due[camera_id] = 0
+        self._wakeup.set()
+
+    def _submit(self, camera_id: str):
+        """Подава извличане към пула, ако камерата вече няма такова в процес"""
+        with self._lock:
+            if camera_id in self._in_flight:
+                return
+            future = self._executor.submit(capture_frame, camera_id)
+            self._in_flight[camera_id] = future
+
+        def _done(_future, camera_id=camera_id):
+            with self._lock:
+                self._in_flight.pop(camera_id, None)
+
+        future.add_done_callback(_done)
+
+    def _scheduler_loop(self):
+        """Основен цикъл: подава камерите, на които им е дошъл редът"""
+        while self._running:
+            now = time.time()
+            sleep_for = 1.0
+
+            for config in list_cameras():
+                if not config.running:
+                    continue
+
+                due = self._next_due.get(config.camera_id)
+                if due is None:
+                    # Първото извличане е един интервал след последния записан кадър
+                    due = config.last_frame_time.timestamp() + config.interval if config.last_frame_time else 0
+                if now >= due:
+                    try:
+                        self._submit(config.camera_id)
+                    except RuntimeError:
+                        # Пулът е спрян по време на итерацията
+                        return
+                    due = now + config.interval
+                    self._next_due[config.camera_id] = due
+
+                sleep_for = min(sleep_for, max(due - now, 0))
+
+            self._wakeup.wait(sleep_for)
+            self._wakeup.clear()
+
+    def get_status(self) -> Dict[str, Any]:
+        """Връща състоянието на планирането по камери"""
+        now = time.time()
+        return {
+            "running": self._running,
+            "max_workers": self.max_workers,
+            "cameras": {
+                camera_id: {
+                    "next_capture_in": max(due - now, 0),
+                    "in_flight": camera_id in self._in_flight
+                }
+                for camera_id, due in self._next_due.items()
+            }
+        }
+
+# Глобален мениджър на модула
+_manager = CaptureManager(max_workers=int(os.getenv("CAPTURE_WORKERS", "4")))
+
+def get_capture_manager() -> CaptureManager:
+    """Връща глобалния мениджър за извличане на кадри"""
+    return _manager
@@ -0,0 +1,53 @@
+"""
+Асинхронна услуга за извличане на кадри
+
+Блокиращата работа с OpenCV, диска и SQLite се изпълнява в отделен executor,
+така че event loop-ът на uvicorn не спира. Едновременните заявки за извличане
+от една и съща камера споделят едно извличане в процес.
+"""
+
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+from .capture import capture_frame
+from utils.logger import setup_logger
+
+# Инициализиране на логър
+logger = setup_logger("rtsp_service")
+
+class CaptureService:
+    """Awaitable API над блокиращите операции на capture модула"""
+
+    def __init__(self, max_workers: int = 4):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rtsp-io")
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """Изпълнява блокираща функция в executor-а на услугата"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def capture(self, camera_id: str = "default") -> bool:
+        """Извлича кадър от камерата; едновременните извиквания чакат едно и също извличане"""
+        future = self._in_flight.get(camera_id)
+
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._executor, capture_frame, camera_id)
+            self._in_flight[camera_id] = future
+            future.add_done_callback(lambda _future: self._in_flight.pop(camera_id, None))
+        else:
+            logger.info(f"[{camera_id}] Присъединяване към текущото извличане")
+
+        # shield - прекъсната заявка не отменя извличането за останалите
+        return await asyncio.shield(future)
+
+# Глобална услуга на модула
+_service = CaptureService(max_workers=int(os.getenv("CAPTURE_IO_WORKERS", "4")))
+
+def get_capture_service() -> CaptureService:
+    """Връща глобалната услуга за извличане"""
+    return _service
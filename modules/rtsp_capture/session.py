@@ -0,0 +1,273 @@
+"""
+Дълготрайна RTSP сесия с фоново декодиране на кадри
+
+Вместо да отваряме потока при всяко извличане (DESCRIBE/SETUP/PLAY, проба на кодека
+и изчакване на ключов кадър), сесията държи потока отворен, чете непрекъснато
+във фонов thread и винаги пази последния декодиран кадър.
+
+Непрекъснатото декодиране струва по едно ядро (частично) на камера. За камери
+с дълъг интервал (поне RTSP_IDLE_INTERVAL секунди) това не си струва: там
+сесията затваря потока, ако никой не е искал кадър RTSP_IDLE_TIMEOUT секунди,
+и го отваря отново при следващото извличане или MJPEG поток.
+"""
+
+import os
+import time
+import threading
+from datetime import datetime
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+
+from utils.logger import setup_logger
+from utils.metrics import Histogram
+
+# cv2/numpy се импортират при първо отваряне на поток, за да е бърз import-ът
+if TYPE_CHECKING:
+    import numpy as np
+
+# Инициализиране на логър
+logger = setup_logger("rtsp_session")
+
+RTSP_OPEN_SECONDS = Histogram(
+    "rtsp_open_seconds", "Време за отваряне на RTSP потока", ["outcome"]
+)
+
+class RTSPSession:
+    """Поддържа отворен RTSP поток и последния декодиран кадър"""
+
+    def __init__(self, rtsp_url: str, min_backoff: float = 1.0, max_backoff: float = 60.0,
+                 idle_timeout: Optional[float] = None):
+        self.rtsp_url = rtsp_url
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        # Затваряне на потока след толкова секунди без заявка за кадър (None - никога)
+        self.idle_timeout = idle_timeout
+        self._last_used = time.monotonic()
+        self.idle = False
+
+        self._frame: Optional["np.ndarray"] = None
+        self._frame_time: Optional[datetime] = None
+        self._frame_seq = 0
+        self._lock = threading.Lock()
+        self._new_frame = threading.Condition(self._lock)
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+        self.connected = False
+        self.reconnects = 0
+
+    def start(self) -> bool:
+        """Стартира фоновото четене на потока"""
+        if self._thread is not None and self._thread.is_alive():
+            return False
+
+        self._running = True
+        self._thread = threading.Thread(target=self._reader_loop, name="rtsp-session")
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info(f"RTSP сесията е стартирана: {self.rtsp_url}")
+        return True
+
+    def stop(self):
+        """Спира фоновото четене и освобождава потока"""
+        self._running = False
+        with self._new_frame:
+            self._new_frame.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        self._thread = None
+        logger.info("RTSP сесията е спряна")
+
+    def is_alive(self) -> bool:
+        """Проверява дали фоновият thread работи"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def _open(self):
+        """Отваря потока с FFMPEG backend"""
+        import cv2
+        
+        started = time.perf_counter()
+        cap = cv2.VideoCapture(self.rtsp_url, cv2.CAP_FFMPEG)
+        if not cap.isOpened():
+            cap.release()
+            RTSP_OPEN_SECONDS.observe(time.perf_counter() - started, outcome="error")
+            return None
+        RTSP_OPEN_SECONDS.observe(time.perf_counter() - started, outcome="ok")
+
+        # Минимален буфер, за да държим винаги най-новия кадър
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return cap
+
+    def _touch(self):
+        """Отбелязва заявка за кадър и събужда неактивната сесия (извиква се под self._lock)"""
+        self._last_used = time.monotonic()
+        if self.idle:
+            self._new_frame.notify_all()
+
+    def _idle_expired(self) -> bool:
+        """Дали никой не е искал кадър по-дълго от idle_timeout"""
+        return self.idle_timeout is not None and time.monotonic() - self._last_used > self.idle_timeout
+
+    def _wait_while_idle(self):
+        """Чака, без отворен поток, до следващата заявка за кадър"""
+        with self._new_frame:
+            self.idle = True
+            while self._running and self._idle_expired():
+                self._new_frame.wait(1.0)
+            self.idle = False
+
+    def _reader_loop(self):
+        """Фонов цикъл: чете кадри и се свързва отново с backoff при прекъсване"""
+        backoff = self.min_backoff
+
+        while self._running:
+            if self._idle_expired():
+                self._wait_while_idle()
+                continue
+
+            logger.info(f"Опит за свързване с RTSP поток: {self.rtsp_url}")
+            cap = self._open()
+
+            if cap is None:
+                logger.error(f"Не може да се отвори RTSP потока, нов опит след {backoff:.0f} секунди")
+                self._sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+
+            logger.info("RTSP потокът е отворен успешно")
+            self.connected = True
+            failures = 0
+            idle = False
+
+            try:
+                while self._running:
+                    if self._idle_expired():
+                        logger.info(f"Няма заявки за кадри от {self.idle_timeout:.0f} секунди, потокът се затваря")
+                        idle = True
+                        break
+
+                    ret, frame = cap.read()
+                    if not ret or frame is None:
+                        failures += 1
+                        # Няколко поредни неуспеха означават прекъснат поток
+                        if failures >= 50:
+                            logger.warning("RTSP потокът е прекъснат, ново свързване")
+                            break
+                        time.sleep(0.1)
+                        continue
+
+                    failures = 0
+                    backoff = self.min_backoff
+                    with self._new_frame:
+                        self._frame = frame
+                        self._frame_time = datetime.now()
+                        self._frame_seq += 1
+                        self._new_frame.notify_all()
+            except Exception as e:
+                logger.error(f"Грешка при четене от RTSP потока: {str(e)}")
+            finally:
+                cap.release()
+                self.connected = False
+
+            if self._running and not idle:
+                self.reconnects += 1
+                self._sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def _sleep(self, seconds: float):
+        """Спи, но се събужда веднага при спиране на сесията"""
+        deadline = time.time() + seconds
+        while self._running and time.time() < deadline:
+            time.sleep(min(0.2, deadline - time.time()))
+
+    def get_frame(self, timeout: float = 5.0, max_age: float = None) -> Tuple[Optional["np.ndarray"], Optional[datetime]]:
+        """
+        Връща последния декодиран кадър
+
+        Args:
+            timeout: Колко секунди да чакаме, ако още няма (достатъчно пресен) кадър
+            max_age: Максимална възраст на кадъра в секунди (None - без ограничение)
+
+        Returns:
+            (кадър, време на декодиране) или (None, None)
+        """
+        deadline = time.time() + timeout
+
+        with self._new_frame:
+            self._touch()
+            while True:
+                if self._frame is not None:
+                    age = (datetime.now() - self._frame_time).total_seconds()
+                    if max_age is None or age <= max_age:
+                        return self._frame, self._frame_time
+
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._running:
+                    return None, None
+                self._new_frame.wait(remaining)
+
+    def wait_for_frame(self, after_seq: int, timeout: float = 5.0) -> Tuple[Optional["np.ndarray"], Optional[datetime], int]:
+        """
+        Чака кадър, по-нов от after_seq
+
+        Returns:
+            (кадър, време на декодиране, пореден номер) или (None, None, after_seq) при таймаут
+        """
+        deadline = time.time() + timeout
+
+        with self._new_frame:
+            self._touch()
+            while self._frame_seq <= after_seq or self._frame is None:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._running:
+                    return None, None, after_seq
+                self._new_frame.wait(remaining)
+
+            return self._frame, self._frame_time, self._frame_seq
+
+# Камери с интервал поне толкова секунди затварят потока между извличанията (0 - никога)
+IDLE_INTERVAL = float(os.getenv("RTSP_IDLE_INTERVAL", "300"))
+# Секунди без заявка за кадър, след които потокът на такава камера се затваря
+IDLE_TIMEOUT = float(os.getenv("RTSP_IDLE_TIMEOUT", "15"))
+
+# Сесии по камери
+_sessions: Dict[str, RTSPSession] = {}
+_session_lock = threading.Lock()
+
+def _idle_timeout(camera_id: str) -> Optional[float]:
+    """Времето без заявки, след което потокът на камерата се затваря, или None"""
+    from .config import get_camera_config
+
+    config = get_camera_config(camera_id)
+    if config is None or IDLE_INTERVAL <= 0 or config.interval < IDLE_INTERVAL:
+        return None
+    return IDLE_TIMEOUT
+
+def get_session(rtsp_url: str, camera_id: str = "default") -> RTSPSession:
+    """Връща работеща сесия за камерата, като я пресъздава при смяна на URL"""
+    with _session_lock:
+        session = _sessions.get(camera_id)
+        
+        if session is not None and session.rtsp_url != rtsp_url:
+            session.stop()
+            session = None
+
+        if session is None:
+            session = RTSPSession(rtsp_url)
+            _sessions[camera_id] = session
+
+        # Интервалът може да е сменен след създаването на сесията
+        session.idle_timeout = _idle_timeout(camera_id)
+
+        if not session.is_alive():
+            session.start()
+
+        return session
+
+def stop_session(camera_id: str = None):
+    """Спира сесията на дадена камера или всички сесии, ако не е зададена камера"""
+    with _session_lock:
+        camera_ids = [camera_id] if camera_id is not None else list(_sessions.keys())
+        
+        for key in camera_ids:
+            session = _sessions.pop(key, None)
+            if session is not None:
+                session.stop()
@@ -0,0 +1,208 @@
+"""
+MJPEG поток на живо с един споделен енкодер за всички зрители
+
+За всяка камера работи един broadcaster thread, който взима декодираните кадри
+от RTSP сесията, кодира ги веднъж като JPEG и уведомява зрителите. Всеки зрител
+чете само най-новия кадър, когато е готов за следващия, така че бавните клиенти
+пропускат кадри вместо да трупат буфер.
+
+В процес без собствено извличане broadcaster-ът никога не отваря RTSP потока:
+взима готовите JPEG кадри от споделената памет (SHARED_FRAMES=1), а без нея -
+последния кадър на лидера от кеша в паметта.
+"""
+
+import os
+import time
+import asyncio
+import threading
+from typing import Any, AsyncIterator, Dict, Optional, Set, Tuple
+
+from .config import get_camera_config
+from .session import get_session
+from .frame_cache import get_frame_cache
+from utils.logger import setup_logger
+from utils.shared_frames import open_ring
+from utils.state import is_leader
+
+# Инициализиране на логър
+logger = setup_logger("rtsp_stream")
+
+# Граница между частите на multipart отговора
+BOUNDARY = "frame"
+
+class StreamBroadcaster:
+    """Кодира кадрите на една камера веднъж и ги разпраща към всички зрители"""
+
+    def __init__(self, camera_id: str, fps: float = 5.0):
+        self.camera_id = camera_id
+        self.fps = fps
+
+        self._jpeg: Optional[bytes] = None
+        self._seq = 0
+        self._subscribers: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def viewers(self) -> int:
+        """Брой активни зрители"""
+        return len(self._subscribers)
+
+    def subscribe(self) -> Tuple[asyncio.AbstractEventLoop, asyncio.Event]:
+        """Регистрира нов зрител и стартира кодирането, ако е нужно"""
+        subscriber = (asyncio.get_running_loop(), asyncio.Event())
+
+        with self._lock:
+            self._subscribers.add(subscriber)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._encode_loop, name=f"mjpeg-{self.camera_id}")
+                self._thread.daemon = True
+                self._thread.start()
+
+        # Ако вече има кодиран кадър, новият зрител го получава веднага
+        if self._jpeg is not None:
+            subscriber[1].set()
+
+        return subscriber
+
+    def unsubscribe(self, subscriber: Tuple[asyncio.AbstractEventLoop, asyncio.Event]):
+        """Премахва зрител; кодирането спира, когато няма повече зрители"""
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def latest(self) -> Tuple[Optional[bytes], int]:
+        """Връща последния кодиран кадър и поредния му номер"""
+        return self._jpeg, self._seq
+
+    def _publish(self, jpeg: bytes):
+        """Запазва новия кадър и уведомява зрителите"""
+        self._jpeg = jpeg
+        self._seq += 1
+
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for loop, event in subscribers:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # Event loop-ът на зрителя е затворен
+                self.unsubscribe((loop, event))
+
+    def _encode_loop(self):
+        """Фонов цикъл: кодира нов кадър не по-често от fps и уведомява зрителите"""
+        logger.info(f"[{self.camera_id}] MJPEG broadcaster стартиран")
+        state = {"last_seq": 0, "last_shared_seq": 0, "shared_identity": None, "cached_version": 0}
+        min_interval = 1.0 / self.fps if self.fps > 0 else 0
+
+        try:
+            while True:
+                with self._lock:
+                    if not self._subscribers:
+                        # Освобождаваме мястото под lock, за да не изпуснем нов зрител
+                        self._thread = None
+                        break
+
+                config = get_camera_config(self.camera_id)
+                if config is None:
+                    break
+
+                started = time.time()
+                try:
+                    encoded = self._encode_next(config, state)
+                except Exception as e:
+                    # Грешка в една итерация не бива да спира потока за всички зрители
+                    logger.error(f"[{self.camera_id}] Грешка в MJPEG broadcaster-а: {str(e)}")
+                    time.sleep(1.0)
+                    continue
+
+                # Ограничаваме честотата на кодиране
+                elapsed = time.time() - started
+                if encoded and elapsed < min_interval:
+                    time.sleep(min_interval - elapsed)
+        finally:
+            with self._lock:
+                if self._thread is threading.current_thread():
+                    self._thread = None
+
+        logger.info(f"[{self.camera_id}] MJPEG broadcaster спрян (няма зрители)")
+
+    def _encode_next(self, config, state: Dict[str, Any]) -> bool:
+        """Изчаква и публикува следващия кадър; връща True, ако е кодиран от RTSP сесията"""
+        import cv2
+
+        # Кадрите се извличат от друг процес - RTSP потокът не се отваря повторно
+        ring = open_ring(self.camera_id)
+        if ring is not None and not ring.owner:
+            # Номерата в пресъздаден буфер започват отначало
+            if ring.identity != state["shared_identity"]:
+                state["shared_identity"] = ring.identity
+                state["last_shared_seq"] = 0
+            shared_seq = ring.wait_for(state["last_shared_seq"], timeout=1.0)
+            # None - буферът е затворен; следващата итерация го отваря наново
+            if shared_seq is not None and shared_seq > state["last_shared_seq"]:
+                shared = ring.read_jpeg(shared_seq)
+                if shared is not None:
+                    state["last_shared_seq"] = shared[0]
+                    self._publish(shared[2])
+            return False
+
+        if not is_leader():
+            # Само лидерът отваря RTSP потока - тук се показва последният му кадър
+            cached = get_frame_cache().get(self.camera_id)
+            if cached is not None and cached.version != state["cached_version"]:
+                state["cached_version"] = cached.version
+                self._publish(cached.data)
+            time.sleep(1.0)
+            return False
+
+        session = get_session(config.rtsp_url, self.camera_id)
+        frame, _, seq = session.wait_for_frame(state["last_seq"], timeout=1.0)
+        if frame is None:
+            return False
+        state["last_seq"] = seq
+
+        if config.width > 0 and config.height > 0:
+            frame = cv2.resize(frame, (config.width, config.height))
+        is_success, buffer = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, config.quality])
+        if is_success:
+            self._publish(buffer.tobytes())
+        return True
+
+# Broadcaster-и по камери
+_broadcasters: Dict[str, StreamBroadcaster] = {}
+_broadcasters_lock = threading.Lock()
+
+def get_broadcaster(camera_id: str) -> StreamBroadcaster:
+    """Връща broadcaster-а за дадена камера"""
+    with _broadcasters_lock:
+        broadcaster = _broadcasters.get(camera_id)
+        if broadcaster is None:
+            broadcaster = StreamBroadcaster(camera_id, fps=float(os.getenv("STREAM_FPS", "5")))
+            _broadcasters[camera_id] = broadcaster
+        return broadcaster
+
+async def mjpeg_generator(camera_id: str) -> AsyncIterator[bytes]:
+    """Генерира multipart/x-mixed-replace части за един зрител"""
+    broadcaster = get_broadcaster(camera_id)
+    subscriber = broadcaster.subscribe()
+    _, event = subscriber
+    last_seq = 0
+
+    try:
+        while True:
+            await event.wait()
+            event.clear()
+
+            # Взимаме само най-новия кадър - междинните се пропускат при бавен клиент
+            jpeg, seq = broadcaster.latest()
+            if jpeg is None or seq == last_seq:
+                continue
+            last_seq = seq
+
+            yield (
+                f"--{BOUNDARY}\r\n"
+                f"Content-Type: image/jpeg\r\n"
+                f"Content-Length: {len(jpeg)}\r\n\r\n"
+            ).encode() + jpeg + b"\r\n"
+    finally:
+        broadcaster.unsubscribe(subscriber)
@@ -0,0 +1,162 @@
+"""
+Генериране на timelapse видео от архивираните кадри
+
+Кадрите за деня се взимат от каталога и се декодират последователно, един по
+един, а видеото се кодира с cv2.VideoWriter във фонов работник. Резултатът се
+кешира на диска по (камера, ден, fps, резолюция, формат) и се преизползва от
+всички зрители; видеото за текущия ден се обновява периодично, ако има нови кадри.
+Видео за минал ден е актуално, ако е изградено след края на деня или след
+последния му кадър. Неуспешно изграждане (например ден без кадри) не се
+повтаря при всяка заявка, а след refresh_interval секунди.
+"""
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Tuple
+
+from .config import get_camera_config
+from .catalog import get_frame_catalog
+from utils.logger import setup_logger
+
+# Инициализиране на логър
+logger = setup_logger("rtsp_timelapse")
+
+# Поддържани формати: разширение -> (FourCC, MIME тип)
+FORMATS = {
+    "mp4": ("mp4v", "video/mp4"),
+    "webm": ("VP80", "video/webm")
+}
+
+# Брой кадри, които се четат от каталога наведнъж
+_PAGE_SIZE = 500
+
+# Граници на параметрите на видеото (за да не се заделят огромни кадри)
+MAX_FPS = 60
+MIN_SIZE = 16
+MAX_WIDTH = 3840
+MAX_HEIGHT = 2160
+
+TimelapseKey = Tuple[str, date, int, int, int, str]
+
+class TimelapseBuilder:
+    """Изгражда и кешира timelapse видеа във фонов работник"""
+
+    def __init__(self, max_workers: int = 1, refresh_interval: int = 600):
+        self.refresh_interval = refresh_interval
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="timelapse")
+        self._jobs: Dict[TimelapseKey, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def output_path(self, key: TimelapseKey) -> str:
+        """Връща пътя до кешираното видео"""
+        camera_id, day, fps, width, height, fmt = key
+        config = get_camera_config(camera_id)
+        cache_dir = os.path.join(config.save_dir, "timelapse")
+        return os.path.join(cache_dir, f"timelapse_{day.strftime('%Y%m%d')}_{fps}fps_{width}x{height}.{fmt}")
+
+    def is_fresh(self, key: TimelapseKey) -> bool:
+        """Проверява дали кешираното видео съществува и е актуално"""
+        path = self.output_path(key)
+        if not os.path.exists(path):
+            return False
+
+        camera_id, day = key[0], key[1]
+        start = datetime.combine(day, datetime.min.time())
+        end = start + timedelta(days=1)
+
+        # Изградено след края на деня - съдържа всички кадри
+        mtime = os.path.getmtime(path)
+        if mtime >= end.timestamp():
+            return True
+
+        # За текущия ден видеото се обновява най-често веднъж на refresh_interval секунди
+        if day >= date.today() and time.time() - mtime < self.refresh_interval:
+            return True
+
+        # Иначе (и за минал ден, изграден преди полунощ) - само ако има по-нови кадри
+        newest = get_frame_catalog().latest(camera_id, start, end)
+        return newest is None or newest["ts"] <= mtime
+
+    def request(self, key: TimelapseKey) -> Dict[str, Any]:
+        """Насрочва изграждане, ако видеото не е кеширано и не се изгражда в момента"""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job["status"] in ("queued", "running"):
+                return job
+
+            # Неуспешното изграждане се помни, за да не се пуска наново при всяка заявка
+            if job is not None and job["status"] == "error" and time.time() - job["failed_at"] < self.refresh_interval:
+                return job
+
+            job = {"status": "queued", "frames": 0, "error": None, "queued_at": datetime.now().isoformat()}
+            self._jobs[key] = job
+            self._executor.submit(self._build, key, job)
+            return job
+
+    def _build(self, key: TimelapseKey, job: Dict[str, Any]):
+        """Декодира кадрите последователно и кодира видеото"""
+        import cv2
+        
+        camera_id, day, fps, width, height, fmt = key
+        job["status"] = "running"
+        output_path = self.output_path(key)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        tmp_path = f"{output_path}.tmp.{fmt}"
+
+        fourcc = cv2.VideoWriter_fourcc(*FORMATS[fmt][0])
+        writer = cv2.VideoWriter(tmp_path, fourcc, fps, (width, height))
+
+        try:
+            if not writer.isOpened():
+                raise RuntimeError(f"Не може да се отвори VideoWriter за формат {fmt}")
+
+            catalog = get_frame_catalog()
+            start = datetime.combine(day, datetime.min.time())
+            end = start + timedelta(days=1)
+
+            # Страниране по време, за да не държим всички записи в паметта
+            after = None
+            while True:
+                items = catalog.query(camera_id, start, end, limit=_PAGE_SIZE, after=after)
+                for item in items:
+                    frame = cv2.imread(item["path"])
+                    if frame is None:
+                        continue
+                    if frame.shape[1] != width or frame.shape[0] != height:
+                        frame = cv2.resize(frame, (width, height))
+                    writer.write(frame)
+                    job["frames"] += 1
+
+                if len(items) < _PAGE_SIZE:
+                    break
+                after = items[-1]["ts"]
+
+            writer.release()
+
+            if job["frames"] == 0:
+                raise RuntimeError("Няма кадри за избрания ден")
+
+            os.replace(tmp_path, output_path)
+            job["status"] = "done"
+            logger.info(f"[{camera_id}] Timelapse за {day} е готов: {output_path} ({job['frames']} кадъра)")
+        except Exception as e:
+            writer.release()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            job["status"] = "error"
+            job["error"] = str(e)
+            job["failed_at"] = time.time()
+            logger.error(f"[{camera_id}] Грешка при генериране на timelapse за {day}: {str(e)}")
+
+# Глобален builder на модула
+_builder = TimelapseBuilder(
+    max_workers=int(os.getenv("TIMELAPSE_WORKERS", "1")),
+    refresh_interval=int(os.getenv("TIMELAPSE_REFRESH", "600"))
+)
+
+def get_timelapse_builder() -> TimelapseBuilder:
+    """Връща глобалния timelapse builder"""
+    return _builder
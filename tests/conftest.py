@@ -0,0 +1,12 @@
+"""
+Общи настройки на тестовете
+
+Тестовете се пускат от корена на проекта: python -m pytest -q
+"""
+
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
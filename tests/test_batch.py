@@ -0,0 +1,83 @@
+import json
+import asyncio
+
+import httpx
+import pytest
+
+from modules.image_analysis import batch
+from modules.image_analysis.batch import AnalysisBatcher, BatchStats, parse_batch_response
+from modules.image_analysis.config import get_analysis_config, update_analysis_config
+
+def test_parse_batch_response_by_image_index():
+    content = "Ето резултатите:\n" + json.dumps([
+        {"image": 1, "cloud_coverage": 20},
+        {"image": 0, "cloud_coverage": 80}
+    ])
+    outcomes = parse_batch_response(content, 2)
+    assert outcomes[0] == (True, {"image": 0, "cloud_coverage": 80})
+    assert outcomes[1] == (True, {"image": 1, "cloud_coverage": 20})
+
+def test_parse_batch_response_uses_position_without_index():
+    outcomes = parse_batch_response('[{"cloud_coverage": 5}, {"cloud_coverage": 6}]', 2)
+    assert [analysis["cloud_coverage"] for _, analysis in outcomes] == [5, 6]
+
+def test_parse_batch_response_missing_and_invalid_items():
+    outcomes = parse_batch_response('[{"image": 0}, "text", {"image": 7}]', 2)
+    assert outcomes[0][0] is True
+    assert outcomes[1] == (False, {"error": "Липсва резултат за изображението"})
+
+def test_parse_batch_response_without_array():
+    outcomes = parse_batch_response("Не мога да анализирам", 3)
+    assert len(outcomes) == 3
+    assert all(not success and "raw_response" in result for success, result in outcomes)
+
+def test_parse_batch_response_invalid_json():
+    success, result = parse_batch_response("[{broken]", 1)[0]
+    assert not success and "JSON" in result["error"]
+
+class FailingScheduler:
+    def __init__(self, error: Exception):
+        self.error = error
+
+    async def run(self, priority, factory):
+        raise self.error
+
+@pytest.fixture
+def batch_config():
+    config = get_analysis_config()
+    previous = {"analysis_batch_size": config.analysis_batch_size, "analysis_batch_wait": config.analysis_batch_wait}
+    update_analysis_config(analysis_batch_size=2, analysis_batch_wait=0.01)
+    yield
+    update_analysis_config(**previous)
+
+@pytest.mark.parametrize("error", [httpx.ConnectError("няма връзка"), ValueError("грешка при разбор")])
+def test_send_failure_resolves_every_waiter(batch_config, monkeypatch, error):
+    monkeypatch.setattr(batch, "get_analysis_scheduler", lambda: FailingScheduler(error))
+
+    async def scenario():
+        batcher = AnalysisBatcher(BatchStats())
+        return await asyncio.wait_for(
+            asyncio.gather(batcher.submit(b"one"), batcher.submit(b"two"), batcher.submit(b"three")),
+            timeout=5
+        )
+
+    outcomes = asyncio.run(scenario())
+    assert len(outcomes) == 3
+    for success, result in outcomes:
+        assert not success
+        assert result["retryable"] is isinstance(error, httpx.TransportError)
+
+def test_short_outcome_list_resolves_remaining_waiters(batch_config, monkeypatch):
+    class ShortScheduler:
+        async def run(self, priority, factory):
+            return [(True, {"cloud_coverage": 10})]
+
+    monkeypatch.setattr(batch, "get_analysis_scheduler", lambda: ShortScheduler())
+
+    async def scenario():
+        batcher = AnalysisBatcher(BatchStats())
+        return await asyncio.wait_for(asyncio.gather(batcher.submit(b"one"), batcher.submit(b"two")), timeout=5)
+
+    first, second = asyncio.run(scenario())
+    assert first == (True, {"cloud_coverage": 10})
+    assert second[0] is False
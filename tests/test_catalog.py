@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from modules.rtsp_capture.catalog import FrameCatalog
+
+BASE = datetime(2024, 5, 1, 12, 0, 0)
+
+@pytest.fixture
+def catalog(tmp_path):
+    catalog = FrameCatalog(str(tmp_path / "catalog.db"))
+    # Кадър на всеки 10 секунди в продължение на 10 минути и един на друга камера
+    catalog.add_frames([
+        ("cam", BASE + timedelta(seconds=10 * index), f"/frames/cam_{index}.jpg", 100, 640, 480)
+        for index in range(60)
+    ])
+    catalog.add_frame("other", BASE, "/frames/other_0.jpg", 100, 640, 480)
+    return catalog
+
+def seconds(items):
+    return [round(item["ts"] - BASE.timestamp()) for item in items]
+
+def test_query_pages_through_interval(catalog):
+    pages = []
+    start = BASE
+    while True:
+        page = catalog.query("cam", start, BASE + timedelta(minutes=5), limit=7)
+        pages.extend(page)
+        if len(page) < 7:
+            break
+        start = datetime.fromtimestamp(page[-1]["ts"] + 0.000001)
+
+    assert seconds(pages) == list(range(0, 300, 10))
+
+def test_query_frames_within_the_same_second(tmp_path):
+    catalog = FrameCatalog(str(tmp_path / "catalog.db"))
+    catalog.add_frames([
+        ("cam", BASE + timedelta(microseconds=index * 1000), f"/frames/{index}.jpg", 1, 1, 1)
+        for index in range(3)
+    ])
+
+    first = catalog.query("cam", BASE, limit=2)
+    second = catalog.query("cam", BASE, limit=2, after=first[-1]["ts"])
+    assert [item["filename"] for item in first + second] == ["0.jpg", "1.jpg", "2.jpg"]
+
+def test_query_after_cursor_pages_through_interval(catalog):
+    pages = []
+    after = None
+    while True:
+        page = catalog.query("cam", BASE, BASE + timedelta(minutes=5), limit=7, after=after)
+        pages.extend(page)
+        if len(page) < 7:
+            break
+        after = page[-1]["ts"]
+
+    assert seconds(pages) == list(range(0, 300, 10))
+
+def test_query_with_step_returns_first_frame_of_each_interval(catalog):
+    items = catalog.query("cam", BASE, BASE + timedelta(minutes=10), step=60, limit=100)
+    assert seconds(items) == list(range(0, 600, 60))
+    assert all(item["camera_id"] == "cam" for item in items)
+
+def test_nearest(catalog):
+    assert seconds([catalog.nearest("cam", BASE + timedelta(seconds=13))]) == [10]
+    assert seconds([catalog.nearest("cam", BASE + timedelta(seconds=17))]) == [20]
+    assert seconds([catalog.nearest("cam", BASE - timedelta(hours=1))]) == [0]
+    assert seconds([catalog.nearest("cam", BASE + timedelta(hours=1))]) == [590]
+    assert catalog.nearest("missing", BASE) is None
+
+def test_latest_in_range(catalog):
+    item = catalog.latest("cam", BASE, BASE + timedelta(seconds=95))
+    assert seconds([item]) == [90]
+    assert catalog.latest("cam", BASE - timedelta(hours=1), BASE) is None
+
+def test_remove(catalog):
+    catalog.remove_range("cam", BASE, BASE + timedelta(minutes=5))
+    catalog.remove_paths(["/frames/cam_59.jpg"])
+    assert catalog.count("cam") == 29
+    assert catalog.count("other") == 1
+
+def test_add_frame_replaces_same_timestamp(catalog):
+    catalog.add_frame("cam", BASE, "/frames/replacement.jpg", 200, 640, 480)
+    assert catalog.count("cam") == 60
+    assert catalog.nearest("cam", BASE)["path"] == "/frames/replacement.jpg"
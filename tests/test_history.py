@@ -0,0 +1,85 @@
+from datetime import datetime, timedelta
+
+from modules.image_analysis.config import AnalysisResult
+from modules.image_analysis.history import CATEGORY_LIMIT, AnalysisHistoryStore, CompactHistory
+
+BASE = datetime(2024, 5, 1, 12, 0, 0)
+
+def result(seconds: int, coverage: float = 10.0, **kwargs) -> AnalysisResult:
+    return AnalysisResult(timestamp=BASE + timedelta(seconds=seconds), cloud_coverage=coverage, **kwargs)
+
+def test_pagination_keeps_records_with_equal_timestamps(tmp_path):
+    store = AnalysisHistoryStore(str(tmp_path / "history.db"))
+    # Пет записа в един и същ момент и два след него
+    for index in range(5):
+        store.append(result(0, coverage=index))
+    store.append(result(1))
+    store.append(result(2))
+
+    seen = []
+    after = None
+    while True:
+        page = store.query(BASE, BASE + timedelta(minutes=1), limit=2, after_id=after)
+        seen.extend(item.history_id for item in page)
+        if len(page) < 2:
+            break
+        after = page[-1].history_id
+
+    assert seen == list(range(1, 8))
+
+def test_pagination_with_camera_filter(tmp_path):
+    store = AnalysisHistoryStore(str(tmp_path / "history.db"))
+    for index in range(4):
+        store.append(result(0, camera_id="a" if index % 2 else "b"))
+
+    first = store.query(camera_id="a", limit=1)
+    second = store.query(camera_id="a", limit=1, after_id=first[0].history_id)
+    assert [item.history_id for item in first + second] == [2, 4]
+
+def test_store_round_trip_of_optional_fields(tmp_path):
+    store = AnalysisHistoryStore(str(tmp_path / "history.db"))
+    history_id = store.append(result(0, brightness=42.5, visibility="добра", cached=True, reused_from=BASE))
+
+    stored = store.get(history_id)
+    assert stored.brightness == 42.5
+    assert stored.visibility == "добра"
+    assert stored.cached is True
+    assert stored.reused_from == BASE
+
+def test_compact_rows_include_optional_fields():
+    history = CompactHistory(4)
+    history.append(result(0, brightness=42.5, visibility="добра", cached=True, reused_from=BASE))
+    history.append(result(1))
+
+    with_values, without_values = history.rows()
+    assert with_values["brightness"] == 42.5
+    assert with_values["visibility"] == "добра"
+    assert with_values["cached"] is True
+    assert with_values["reused_from"] == BASE.isoformat()
+    assert without_values["brightness"] is None
+    assert without_values["reused_from"] is None
+    assert without_values["cached"] is False
+
+def test_compact_categories_stay_bounded_and_keep_values():
+    history = CompactHistory(4)
+    for n in range(CATEGORY_LIMIT + 10):
+        history.append(result(n, cloud_type=f"тип {n}", weather_conditions=f"условия {n}"))
+
+    rows = history.rows()
+    assert [row["cloud_type"] for row in rows] == [f"тип {n}" for n in range(CATEGORY_LIMIT + 6, CATEGORY_LIMIT + 10)]
+    assert rows[-1]["weather_conditions"] == f"условия {CATEGORY_LIMIT + 9}"
+    assert len(history._categories["cloud_type"]) <= CATEGORY_LIMIT
+    assert not history._spill
+
+def test_compact_keeps_long_values_out_of_line():
+    history = CompactHistory(2)
+    long_conditions = "дълго описание " * 40
+    history.append(result(0, camera_id="cam  1", weather_conditions=long_conditions))
+    history.append(result(1, camera_id="cam 2", weather_conditions="ясно"))
+
+    assert history.rows(camera_id="cam 1")[0]["weather_conditions"] == long_conditions.strip()
+    assert len(history._spill) == 1
+
+    history.append(result(2, weather_conditions="облачно"))
+    assert not history._spill
+    assert [r.weather_conditions for r in history.results()] == ["ясно", "облачно"]
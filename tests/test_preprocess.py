@@ -0,0 +1,28 @@
+import cv2
+import numpy as np
+
+from modules.image_analysis.preprocess import read_image_size
+
+def jpeg(width: int = 160, height: int = 120) -> bytes:
+    pixels = np.random.default_rng(1).integers(0, 255, (height, width, 3), dtype=np.uint8)
+    return cv2.imencode(".jpg", pixels)[1].tobytes()
+
+def test_jpeg_size():
+    assert read_image_size(jpeg()) == (160, 120)
+
+def test_jpeg_with_trailing_bytes():
+    # Някои камери добавят данни след EOI
+    assert read_image_size(jpeg() + b"\x00" * 4096) == (160, 120)
+
+def test_truncated_jpeg_is_invalid():
+    data = jpeg()
+    assert read_image_size(data[:-2]) is None
+    assert read_image_size(data[:len(data) // 2]) is None
+
+def test_png_size():
+    data = cv2.imencode(".png", np.zeros((5, 7, 3), dtype=np.uint8))[1].tobytes()
+    assert read_image_size(data) == (7, 5)
+
+def test_invalid_data():
+    assert read_image_size(b"") is None
+    assert read_image_size(b"not an image") is None
@@ -0,0 +1,76 @@
+import time
+
+import pytest
+
+from modules.image_analysis.config import get_analysis_config, update_analysis_config
+from modules.image_analysis.result_cache import AnalysisCache, make_cache_key
+
+@pytest.fixture
+def cache_config(tmp_path):
+    config = get_analysis_config()
+    previous = {
+        "analysis_cache_size": config.analysis_cache_size,
+        "analysis_cache_ttl": config.analysis_cache_ttl,
+        "analysis_cache_dir": config.analysis_cache_dir
+    }
+    update_analysis_config(analysis_cache_size=2, analysis_cache_ttl=60, analysis_cache_dir="")
+    yield tmp_path
+    update_analysis_config(**previous)
+
+def test_key_depends_on_image_and_parameters():
+    key = make_cache_key(b"image", "model", "prompt", 0.2, 100)
+    assert key == make_cache_key(b"image", "model", "prompt", 0.2, 100)
+    assert key != make_cache_key(b"other", "model", "prompt", 0.2, 100)
+    assert key != make_cache_key(b"image", "model", "prompt", 0.3, 100)
+    assert key != make_cache_key(b"image", "model", "prompt", 0.2, 100, variant="crop")
+
+def test_lru_evicts_least_recently_used(cache_config):
+    cache = AnalysisCache()
+    cache.put("a", {"value": 1})
+    cache.put("b", {"value": 2})
+    assert cache.get("a") == {"value": 1}  # "a" става най-скорошен
+
+    cache.put("c", {"value": 3})
+    assert cache.get("b") is None
+    assert cache.get("a") == {"value": 1}
+    assert cache.get("c") == {"value": 3}
+    assert cache.stats["evictions"] == 1
+
+def test_expired_entry_is_a_miss(cache_config, monkeypatch):
+    cache = AnalysisCache()
+    cache.put("a", {"value": 1})
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert cache.get("a") is None
+    assert cache.stats["expired"] == 1
+    assert cache.snapshot()["entries"] == 0
+
+def test_zero_ttl_never_expires(cache_config, monkeypatch):
+    update_analysis_config(analysis_cache_ttl=0)
+    cache = AnalysisCache()
+    cache.put("a", {"value": 1})
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 10 ** 6)
+    assert cache.get("a") == {"value": 1}
+
+def test_disk_tier_survives_new_instance(cache_config):
+    update_analysis_config(analysis_cache_dir=str(cache_config))
+    AnalysisCache().put("abcdef", {"value": 1})
+
+    cache = AnalysisCache()
+    assert cache.get("abcdef") == {"value": 1}
+    assert cache.stats["disk_hits"] == 1
+    # Вторият път е от паметта
+    assert cache.get("abcdef") == {"value": 1}
+    assert cache.stats["memory_hits"] == 1
+
+def test_corrupt_disk_entry_is_removed(cache_config):
+    update_analysis_config(analysis_cache_dir=str(cache_config))
+    path = cache_config / "ab" / "abcdef.json"
+    path.parent.mkdir()
+    path.write_text("{not json")
+
+    assert AnalysisCache().get("abcdef") is None
+    assert not path.exists()
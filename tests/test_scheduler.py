@@ -0,0 +1,171 @@
+import time
+import asyncio
+
+import pytest
+
+from modules.image_analysis.config import get_analysis_config, update_analysis_config
+from modules.image_analysis.scheduler import AnalysisScheduler, PrioritySlots, TokenBucket, retry_hint
+
+@pytest.fixture
+def scheduler_config():
+    config = get_analysis_config()
+    fields = (
+        "analysis_rate_limit", "analysis_rate_burst", "analysis_max_concurrency",
+        "analysis_max_retries", "analysis_backoff_base", "analysis_batch_size"
+    )
+    previous = {field: getattr(config, field) for field in fields}
+    update_analysis_config(
+        analysis_rate_limit=60, analysis_rate_burst=2, analysis_max_concurrency=1,
+        analysis_max_retries=2, analysis_backoff_base=0, analysis_batch_size=1
+    )
+    yield
+    update_analysis_config(**previous)
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    return now
+
+def test_bucket_allows_burst_then_spaces_requests(scheduler_config, clock):
+    bucket = TokenBucket()
+    assert bucket._reserve() == 0
+    assert bucket._reserve() == 0
+    # Една заявка в секунда - третата чака секунда, четвъртата две
+    assert bucket._reserve() == pytest.approx(1.0)
+    assert bucket._reserve() == pytest.approx(2.0)
+
+def test_bucket_refills_over_time(scheduler_config, clock):
+    bucket = TokenBucket()
+    bucket._reserve()
+    bucket._reserve()
+    clock[0] += 10
+    # Натрупването е ограничено до burst
+    assert bucket._reserve() == 0
+    assert bucket._reserve() == 0
+    assert bucket._reserve() == pytest.approx(1.0)
+
+def test_bucket_pause(scheduler_config, clock):
+    bucket = TokenBucket()
+    bucket.pause(5)
+    assert bucket._reserve() == pytest.approx(5.0)
+
+def test_bucket_without_limit(scheduler_config):
+    update_analysis_config(analysis_rate_limit=0)
+    bucket = TokenBucket()
+
+    async def scenario():
+        return [await bucket.acquire() for _ in range(20)]
+
+    assert asyncio.run(scenario()) == [0.0] * 20
+
+def test_slots_are_granted_by_priority(scheduler_config):
+    slots = PrioritySlots()
+    order = []
+
+    async def waiter(priority):
+        await slots.acquire(priority)
+        order.append(priority)
+        slots.release()
+
+    async def scenario():
+        await slots.acquire(0)
+        tasks = [asyncio.create_task(waiter(priority)) for priority in (5, 1, 3)]
+        await asyncio.sleep(0.01)
+        assert slots.waiting == 3
+        slots.release()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    assert order == [1, 3, 5]
+    assert slots.active == 0
+
+def test_cancelled_waiter_does_not_leak_a_slot(scheduler_config):
+    slots = PrioritySlots()
+
+    async def scenario():
+        await slots.acquire(0)
+        cancelled = asyncio.create_task(slots.acquire(1))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        slots.release()
+
+        await asyncio.wait_for(slots.acquire(2), timeout=1)
+        slots.release()
+
+    asyncio.run(scenario())
+    assert slots.active == 0 and slots.waiting == 0
+
+def test_retry_hint():
+    assert retry_hint((True, {})) == (False, None)
+    assert retry_hint((False, {"status_code": 429, "retry_after": 3})) == (True, 3)
+    assert retry_hint((False, {"status_code": 400})) == (False, None)
+    assert retry_hint((False, {"retryable": True})) == (True, None)
+    # Групата се повтаря само ако всички изображения са неуспешни
+    assert retry_hint([(True, {}), (False, {"status_code": 503})]) == (False, None)
+    assert retry_hint([(False, {"status_code": 503}), (False, {"status_code": 503})]) == (True, None)
+
+def test_run_retries_transient_errors(scheduler_config):
+    update_analysis_config(analysis_rate_limit=0)
+    scheduler = AnalysisScheduler()
+    outcomes = [(False, {"status_code": 503}), (False, {"status_code": 502}), (True, {"cloud_coverage": 10})]
+
+    async def request():
+        return outcomes.pop(0)
+
+    assert asyncio.run(scheduler.run(10, request)) == (True, {"cloud_coverage": 10})
+    assert scheduler.stats["requests"] == 3
+    assert scheduler.stats["retries"] == 2
+    assert scheduler.stats["failed"] == 0
+
+def test_run_gives_up_after_max_retries(scheduler_config):
+    update_analysis_config(analysis_rate_limit=0)
+    scheduler = AnalysisScheduler()
+
+    async def request():
+        return (False, {"status_code": 500})
+
+    assert asyncio.run(scheduler.run(10, request)) == (False, {"status_code": 500})
+    assert scheduler.stats["requests"] == 3
+    assert scheduler.stats["failed"] == 1
+
+def test_throttled_request_does_not_hold_a_slot(scheduler_config):
+    update_analysis_config(analysis_rate_limit=600, analysis_rate_burst=1)
+    scheduler = AnalysisScheduler()
+
+    async def request():
+        return (True, {})
+
+    async def scenario():
+        scheduler.bucket._reserve()
+        throttled = asyncio.create_task(scheduler.run(10, request))
+        await asyncio.sleep(0.01)
+        # Заявката чака токен, но мястото остава свободно за останалите
+        assert scheduler.slots.active == 0
+        await scheduler.slots.acquire(0)
+        scheduler.slots.release()
+        return await throttled
+
+    assert asyncio.run(scenario()) == (True, {})
+    assert scheduler.stats["throttle_wait"] > 0
+
+def test_identical_images_share_one_analysis(scheduler_config, monkeypatch):
+    from modules.image_analysis import scheduler as scheduler_module
+
+    calls = []
+
+    async def analyze(image_data):
+        calls.append(image_data)
+        await asyncio.sleep(0.01)
+        return True, {"cloud_coverage": 20}
+
+    monkeypatch.setattr(scheduler_module, "analyze_image_with_anthropic", analyze)
+    scheduler = AnalysisScheduler()
+
+    async def scenario():
+        return await asyncio.gather(*(scheduler.submit(b"same", "default") for _ in range(3)))
+
+    assert asyncio.run(scenario()) == [(True, {"cloud_coverage": 20})] * 3
+    assert calls == [b"same"]
+    assert scheduler.stats["deduplicated"] == 2
@@ -0,0 +1,198 @@
+import os
+import time
+import uuid
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+from utils import shared_frames
+from utils.shared_frames import SharedFrameRing, open_ring, segment_name
+
+@pytest.fixture
+def camera(monkeypatch):
+    monkeypatch.setenv("SHARED_FRAMES", "1")
+    monkeypatch.setenv("SHARED_FRAMES_NAME", f"obzor_test_{uuid.uuid4().hex[:8]}")
+    yield "cam"
+    shared_frames.close_rings()
+    try:
+        stale = shared_memory.SharedMemory(name=segment_name("cam"))
+        stale.close()
+        stale.unlink()
+    except FileNotFoundError:
+        pass
+
+def make_writer(name: str) -> SharedFrameRing:
+    return SharedFrameRing(name, slots=4, max_width=8, max_height=6, create=True)
+
+def pixels(value: int) -> np.ndarray:
+    return np.full((6, 8, 3), value, dtype=np.uint8)
+
+def test_write_and_read_latest(camera):
+    writer = make_writer(segment_name(camera))
+    try:
+        for index in range(1, 6):
+            assert writer.write(pixels(index), f"A{index}".encode(), float(index)) == index
+
+        reader = open_ring(camera)
+        assert reader is not None and not reader.owner
+        assert reader.read_jpeg() == (5, 5.0, b"A5")
+
+        frame = reader.view()
+        assert int(frame.pixels[0, 0, 0]) == 5
+        # По-старите от броя слотове кадри вече са презаписани
+        assert reader.view(1) is None
+        assert reader.read_jpeg(2) == (2, 2.0, b"A2")
+    finally:
+        writer.close()
+
+def test_overwritten_slot_is_not_valid(camera):
+    writer = make_writer(segment_name(camera))
+    try:
+        writer.write(pixels(1), b"A1", 1.0)
+        reader = open_ring(camera)
+        frame = reader.view(1)
+        assert reader.valid(frame)
+
+        # Слот 1 се използва отново от кадър 5
+        for index in range(2, 6):
+            writer.write(pixels(index), f"A{index}".encode(), float(index))
+        assert not reader.valid(frame)
+        assert reader.view(1) is None
+    finally:
+        writer.close()
+
+def test_oversized_jpeg_is_skipped(camera):
+    writer = make_writer(segment_name(camera))
+    try:
+        writer.write(pixels(1), b"x" * (writer.jpeg_capacity + 1), 1.0)
+        assert writer.read_jpeg() is None
+        assert writer.view().pixels is not None
+    finally:
+        writer.close()
+
+def test_reader_reopens_after_clean_restart(camera):
+    first = make_writer(segment_name(camera))
+    for index in range(1, 50):
+        first.write(pixels(1), f"A{index}".encode(), float(index))
+
+    reader = open_ring(camera)
+    assert reader.read_jpeg()[2] == b"A49"
+    old_identity = reader.identity
+    first.close()
+
+    second = make_writer(segment_name(camera))
+    try:
+        second.write(pixels(2), b"B1", 100.0)
+
+        reopened = open_ring(camera)
+        assert reopened is not reader
+        assert reopened.identity != old_identity
+        assert reopened.read_jpeg() == (1, 100.0, b"B1")
+    finally:
+        second.close()
+
+def test_frame_cache_resets_seq_on_new_ring(camera):
+    from modules.rtsp_capture.frame_cache import FrameCache
+
+    cache = FrameCache()
+    first = make_writer(segment_name(camera))
+    for index in range(1, 50):
+        first.write(pixels(1), f"A{index}".encode(), float(index))
+    assert cache.get(camera).data == b"A49"
+    first.close()
+
+    second = make_writer(segment_name(camera))
+    try:
+        second.write(pixels(2), b"B1", 100.0)
+        # Поредният номер 1 е по-малък от 49, но е от нов буфер
+        assert cache.get(camera).data == b"B1"
+    finally:
+        second.close()
+
+def _crashing_writer(name: str):
+    ring = SharedFrameRing(name, slots=4, max_width=8, max_height=6, create=True)
+    for index in range(1, 50):
+        ring.write(np.full((6, 8, 3), 1, dtype=np.uint8), f"A{index}".encode(), float(index))
+    # Без close() - сегментът остава, а флагът за затворен не е вдигнат
+    os._exit(0)
+
+def test_reader_drops_ring_of_dead_writer(camera):
+    context = multiprocessing.get_context("fork")
+    process = context.Process(target=_crashing_writer, args=(segment_name(camera),))
+    process.start()
+    process.join(10)
+    assert process.exitcode == 0
+
+    # Сегментът още съществува, но записващият процес е спрял
+    assert open_ring(camera) is None
+
+def test_cached_reader_notices_writer_crash(camera):
+    context = multiprocessing.get_context("fork")
+    ready = context.Event()
+    release = context.Event()
+
+    def writer():
+        ring = SharedFrameRing(segment_name(camera), slots=4, max_width=8, max_height=6, create=True)
+        ring.write(np.full((6, 8, 3), 1, dtype=np.uint8), b"A1", 1.0)
+        ready.set()
+        release.wait(10)
+        os._exit(0)
+
+    process = context.Process(target=writer)
+    process.start()
+    try:
+        assert ready.wait(10)
+        reader = open_ring(camera)
+        assert reader is not None and reader.read_jpeg()[2] == b"A1"
+    finally:
+        release.set()
+        process.join(10)
+
+    deadline = time.monotonic() + 5
+    while open_ring(camera) is not None and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert open_ring(camera) is None
+
+def test_reads_after_close_return_none(camera):
+    writer = make_writer(segment_name(camera))
+    try:
+        writer.write(pixels(1), b"A1", 1.0)
+        reader = open_ring(camera)
+        reader.close()
+
+        assert reader.closed
+        assert reader.latest_seq() == 0
+        assert reader.view() is None
+        assert reader.read_jpeg() is None
+        assert reader.wait_for(0, timeout=0.1) is None
+        assert not reader.writer_alive()
+    finally:
+        writer.close()
+
+def test_close_waits_for_reader_in_progress(camera):
+    import threading
+
+    writer = make_writer(segment_name(camera))
+    try:
+        writer.write(pixels(1), b"A1", 1.0)
+        reader = open_ring(camera)
+        result = {}
+
+        def wait():
+            result["seq"] = reader.wait_for(1, timeout=0.5)
+            result["jpeg"] = reader.read_jpeg()
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        time.sleep(0.05)
+        # Затварянето от друг thread не освобождава паметта под чакащия
+        reader.close()
+        thread.join(5)
+
+        assert not thread.is_alive()
+        assert result == {"seq": None, "jpeg": None}
+        assert reader._header is None
+    finally:
+        writer.close()
@@ -0,0 +1,96 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from modules.image_analysis.config import AnalysisResult
+from modules.image_analysis.trend import WINDOWS, TrendSeries, TrendTracker
+
+START = 1_700_000_000.0
+
+def brute_force(points, now):
+    stats = {}
+    for name, seconds in WINDOWS.items():
+        values = [value for ts, value in points if ts >= now - seconds]
+        stats[name] = {
+            "count": len(values),
+            "mean": round(sum(values) / len(values), 1) if values else None,
+            "min": min(values) if values else None,
+            "max": max(values) if values else None
+        }
+    return stats
+
+def test_windows_match_brute_force():
+    rng = np.random.default_rng(7)
+    # Малък капацитет - масивите се компактират и разширяват по време на теста
+    series = TrendSeries(capacity=16)
+    points = []
+    ts = START
+    for _ in range(3000):
+        ts += float(rng.integers(60, 900))
+        value = float(rng.integers(0, 101))
+        series.add(ts, value)
+        points.append((ts, value))
+
+        if len(points) % 97 == 0:
+            assert series.window_stats(ts) == brute_force(points, ts)
+
+    # Без нови точки прозорците се изпразват с времето
+    later = ts + WINDOWS["24h"] + 1
+    assert series.window_stats(later) == brute_force(points, later)
+    assert series.window_stats(later)["1h"]["count"] == 0
+
+def test_older_point_is_ignored():
+    series = TrendSeries()
+    series.add(START + 10, 50)
+    series.add(START, 0)
+    assert len(series) == 1
+    assert series.window_stats(START + 10)["1h"]["mean"] == 50
+
+def test_change_point_finds_step():
+    series = TrendSeries()
+    for index in range(40):
+        series.add(START + index * 600, 10.0 if index < 25 else 80.0)
+    now = START + 40 * 600
+
+    change = series.change_point(WINDOWS["24h"], threshold=20, now=now)
+    assert change is not None
+    assert change["timestamp"] == datetime.fromtimestamp(START + 25 * 600).isoformat()
+    assert change["mean_before"] == 10.0
+    assert change["mean_after"] == 80.0
+    assert change["shift"] == 70.0
+
+def test_change_point_below_threshold_or_too_few_points():
+    series = TrendSeries()
+    for index in range(40):
+        series.add(START + index * 600, 50.0 + (index % 2))
+    now = START + 40 * 600
+    assert series.change_point(WINDOWS["24h"], threshold=20, now=now) is None
+
+    short = TrendSeries()
+    for index in range(4):
+        short.add(START + index * 600, 0.0 if index < 2 else 100.0)
+    assert short.change_point(WINDOWS["24h"], threshold=20, now=START + 2400) is None
+
+@pytest.mark.parametrize("recent, event", [(90.0, "sudden_clouding"), (5.0, "sudden_clearing")])
+def test_sudden_change(recent, event):
+    series = TrendSeries()
+    for index in range(12):
+        series.add(START + index * 600, 40.0 if index < 6 else recent)
+    now = START + 12 * 600
+
+    change = series.sudden_change(window=3600, threshold=20, now=now)
+    assert change["event"] == event
+    assert change["previous_mean"] == 40.0
+    assert change["recent_mean"] == recent
+
+def test_tracker_skips_errors_and_separates_cameras():
+    tracker = TrendTracker()
+    now = datetime.now()
+    tracker.add(AnalysisResult(timestamp=now, camera_id="a", cloud_coverage=30))
+    tracker.add(AnalysisResult(timestamp=now, camera_id="b", cloud_coverage=70))
+    tracker.add(AnalysisResult(timestamp=now, camera_id="a", cloud_coverage=0, error="timeout"))
+
+    assert sorted(tracker.cameras()) == ["a", "b"]
+    assert tracker.snapshot("a")["windows"]["1h"] == {"count": 1, "mean": 30.0, "min": 30.0, "max": 30.0}
+    assert tracker.snapshot("missing") is None
@@ -1,5 +1,5 @@
-"""
-Инициализация на utils пакета
-"""
-
+"""
+Инициализация на utils пакета
+"""
+
 # Празен файл, само за да обозначи директорията като Python пакет
\ No newline at end of file
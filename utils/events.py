@@ -0,0 +1,193 @@
+"""
+Шина за събития между модулите в процеса
+
+capture_frame() публикува всеки нов кадър (JPEG байтове и метаданни) като
+FrameEvent. Всеки етап от обработката (архив, анализ) се абонира със собствена
+ограничена опашка и политика при препълване, така че бавен етап не спира
+извличането и не забавя останалите етапи.
+"""
+
+import time
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from pydantic import BaseModel
+
+from utils.logger import setup_logger
+from utils.metrics import Gauge
+
+# Инициализиране на логър
+logger = setup_logger("event_bus")
+
+# Политики при пълна опашка
+DROP_OLDEST = "drop_oldest"  # Изхвърля най-стария чакащ кадър (за етапи, на които им трябва най-новият)
+DROP_NEWEST = "drop_newest"  # Отказва новия кадър (запазва реда на вече чакащите)
+POLICIES = (DROP_OLDEST, DROP_NEWEST)
+
+class FrameEvent(BaseModel):
+    """Нов кадър от камера"""
+    camera_id: str
+    data: bytes  # Кодиран JPEG
+    timestamp: datetime
+    width: int = 0
+    height: int = 0
+    seq: int = 0  # Пореден номер на събитието в шината
+
+class StageQueue:
+    """Ограничена опашка на един етап от обработката"""
+
+    def __init__(self, name: str, maxsize: int = 8, policy: str = DROP_OLDEST,
+                 on_drop: Optional[Callable[[FrameEvent], None]] = None):
+        if policy not in POLICIES:
+            raise ValueError(f"Непозната политика за опашката: {policy}")
+
+        self.name = name
+        self.maxsize = max(maxsize, 1)
+        self.policy = policy
+        self.on_drop = on_drop  # Извиква се (извън заключването) с всяко изхвърлено събитие
+        self._items: Deque[FrameEvent] = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self.stats: Dict[str, int] = {"accepted": 0, "dropped": 0, "delivered": 0}
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def put(self, event: FrameEvent) -> bool:
+        """Добавя събитие според политиката; връща False, ако то е отхвърлено"""
+        dropped = None
+        with self._condition:
+            if self._closed:
+                return False
+
+            if len(self._items) >= self.maxsize:
+                self.stats["dropped"] += 1
+                if self.policy == DROP_NEWEST:
+                    dropped = event
+                else:
+                    dropped = self._items.popleft()
+
+            if dropped is not event:
+                self._items.append(event)
+                self.stats["accepted"] += 1
+                self._condition.notify()
+
+        if dropped is not None and self.on_drop is not None:
+            self.on_drop(dropped)
+        return dropped is not event
+
+    def get(self, timeout: Optional[float] = None) -> Optional[FrameEvent]:
+        """Взима следващото събитие; връща None при изтичане на времето или затворена опашка"""
+        with self._condition:
+            deadline = time.monotonic() + timeout if timeout is not None else None
+            while not self._items:
+                if self._closed:
+                    return None
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+            self.stats["delivered"] += 1
+            return self._items.popleft()
+
+    def drain(self) -> List[FrameEvent]:
+        """Взима всички чакащи събития без изчакване"""
+        with self._condition:
+            items = list(self._items)
+            self._items.clear()
+            self.stats["delivered"] += len(items)
+            return items
+
+    def close(self):
+        """Затваря опашката и събужда чакащия консуматор"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Връща броячите и текущата дълбочина на опашката"""
+        return {
+            "depth": len(self._items),
+            "maxsize": self.maxsize,
+            "policy": self.policy,
+            **self.stats
+        }
+
+class EventBus:
+    """Разпраща кадрите до опашките на абонираните етапи"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: Dict[str, StageQueue] = {}
+        self._seq = 0
+        self._last_event: Dict[str, float] = {}  # Камера -> monotonic време на последния кадър
+
+    def subscribe(self, name: str, maxsize: int = 8, policy: str = DROP_OLDEST,
+                  on_drop: Optional[Callable[[FrameEvent], None]] = None) -> StageQueue:
+        """Регистрира етап; предишна опашка със същото име се затваря"""
+        queue = StageQueue(name, maxsize, policy, on_drop)
+        with self._lock:
+            previous = self._stages.get(name)
+            self._stages[name] = queue
+        if previous is not None:
+            previous.close()
+        logger.info(f"Етап {name} абониран (опашка {queue.maxsize}, {queue.policy})")
+        return queue
+
+    def unsubscribe(self, name: str, queue: StageQueue = None):
+        """Премахва етапа (само ако опашката е тази, която е подадена)"""
+        with self._lock:
+            current = self._stages.get(name)
+            if current is None or (queue is not None and current is not queue):
+                return
+            del self._stages[name]
+        current.close()
+
+    def has_stage(self, name: str) -> bool:
+        """Проверява дали има абониран етап с това име"""
+        return name in self._stages
+
+    def publish(self, event: FrameEvent) -> int:
+        """Публикува събитието към всички етапи и връща броя на приелите го"""
+        with self._lock:
+            self._seq += 1
+            event.seq = self._seq
+            self._last_event[event.camera_id] = time.monotonic()
+            stages = list(self._stages.values())
+
+        return sum(1 for queue in stages if queue.put(event))
+
+    def seconds_since_event(self, camera_id: str) -> Optional[float]:
+        """Секунди от последния кадър на камерата или None, ако няма такъв"""
+        last = self._last_event.get(camera_id)
+        return time.monotonic() - last if last is not None else None
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Връща състоянието на етапите"""
+        with self._lock:
+            stages = dict(self._stages)
+        return {
+            "published": self._seq,
+            "stages": {name: queue.snapshot() for name, queue in stages.items()}
+        }
+
+# Глобална шина на процеса
+_bus = EventBus()
+
+def get_event_bus() -> EventBus:
+    """Връща глобалната шина за събития"""
+    return _bus
+
+def _stage_depths():
+    return [((name,), stage["depth"]) for name, stage in _bus.snapshot()["stages"].items()]
+
+STAGE_QUEUE_DEPTH = Gauge(
+    "stage_queue_depth", "Чакащи кадри в опашката на етапа", ["stage"], callback=_stage_depths
+)
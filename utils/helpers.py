@@ -0,0 +1,48 @@
+"""
+Помощни функции
+"""
+
+import os
+import tempfile
+
+def atomic_write(path: str, data: bytes):
+    """
+    Записва файл атомарно: данните се пишат във временен файл в същата
+    директория и след това се преименуват върху целевия път.
+    Читателите виждат или стария, или новия файл, никога наполовина записан.
+    """
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_", suffix=os.path.basename(path))
+    
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # mkstemp създава файла с права 0600
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def atomic_link(src: str, dst: str, data: bytes = None):
+    """
+    Публикува src под името dst атомарно чрез hardlink и преименуване,
+    без да копира съдържанието. Ако файловата система не поддържа hardlink,
+    записва data (или съдържанието на src) атомарно.
+    """
+    directory = os.path.dirname(dst) or "."
+    tmp_path = os.path.join(directory, f".tmp_link_{os.getpid()}_{os.path.basename(dst)}")
+    
+    try:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        os.link(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        if data is None:
+            with open(src, "rb") as f:
+                data = f.read()
+        atomic_write(dst, data)
@@ -0,0 +1,451 @@
+"""
+Споделена памет с последните кадри на камера
+
+Когато приложението работи с няколко процеса (например uvicorn --workers N),
+само процесът, който извлича кадрите, записва всеки нов кадър в кръгов буфер в
+multiprocessing.shared_memory: декодираните пиксели и кодирания JPEG, заедно с
+пореден номер и време. Останалите процеси четат директно от сегмента чрез
+NumPy изгледи, без файловата система и без pickle.
+
+Разположение на сегмента:
+- заглавка (int64): маркер, брой слотове, максимални размери, капацитет за
+  JPEG, пореден номер на последния кадър, PID на записващия, флаг за затворен,
+  поколение (уникално за всяко създаване на сегмента)
+- метаданни на слотовете: пореден номер, време, ширина, височина, дължина на JPEG
+- пиксели: slots x max_height x max_width x 3 (uint8, BGR)
+- JPEG байтове: slots x jpeg_capacity
+
+Всеки слот е защитен като seqlock: записващият нулира поредния номер на слота,
+записва данните и едва тогава поставя новия номер. Читателят проверява номера
+преди и след четенето и повтаря, ако междувременно слотът е презаписан.
+
+Читателите държат сегмента отворен, докато записващият е жив: при затворен
+сегмент или спрял процес (проверка на PID) буферът се отваря наново.
+Поредните номера започват от 1 при всяко създаване, затова последният видян
+номер се пази заедно с identity (име и поколение) на буфера. Всяко четене
+държи референция към буфера, така че close() от друг thread го освобождава
+едва след последното четене; след затваряне четенията връщат None.
+"""
+
+import os
+import re
+import time
+import threading
+from multiprocessing import shared_memory, resource_tracker
+from typing import TYPE_CHECKING, Any, Dict, NamedTuple, Optional, Tuple
+
+from utils.logger import setup_logger
+
+# numpy се импортира при първо използване, за да е бърз import-ът
+if TYPE_CHECKING:
+    import numpy as np
+
+# Инициализиране на логър
+logger = setup_logger("shared_frames")
+
+_MAGIC = 0x4F425A524632  # "OBZRF2"
+_HEADER_FIELDS = 9
+(
+    _MAGIC_FIELD, _SLOTS_FIELD, _WIDTH_FIELD, _HEIGHT_FIELD, _JPEG_FIELD,
+    _SEQ_FIELD, _OWNER_FIELD, _CLOSED_FIELD, _GENERATION_FIELD
+) = range(_HEADER_FIELDS)
+
+def _meta_dtype():
+    import numpy as np
+    return np.dtype([
+        ("seq", "<u8"),
+        ("timestamp", "<f8"),
+        ("width", "<u4"),
+        ("height", "<u4"),
+        ("jpeg_len", "<u4"),
+        ("reserved", "<u4")
+    ])
+
+class SharedFrame(NamedTuple):
+    """Изглед към един кадър в споделената памет (валиден, докато слотът не е презаписан)"""
+    seq: int
+    timestamp: float
+    pixels: Optional["np.ndarray"]  # Изглед height x width x 3 или None, ако кадърът не се е побрал
+    jpeg: memoryview
+
+class SharedFrameRing:
+    """Кръгов буфер от кадри в един сегмент на споделената памет"""
+
+    def __init__(self, name: str, slots: int = 4, max_width: int = 0, max_height: int = 0, create: bool = False):
+        import numpy as np
+
+        self.name = name
+        if create:
+            jpeg_capacity = max_width * max_height * 3 // 2
+            size = self._layout_size(slots, max_width, max_height, jpeg_capacity)
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            header = np.ndarray((_HEADER_FIELDS,), dtype=np.int64, buffer=self._shm.buf)
+            header[:] = [_MAGIC, slots, max_width, max_height, jpeg_capacity, 0, os.getpid(), 0, time.time_ns()]
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            # Сегментът принадлежи на записващия процес - читателят не трябва да го изтрие при изход
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+            header = np.ndarray((_HEADER_FIELDS,), dtype=np.int64, buffer=self._shm.buf)
+            if header[_MAGIC_FIELD] != _MAGIC:
+                self._shm.close()
+                raise ValueError(f"Сегментът {name} не е буфер с кадри")
+
+        self.owner = create
+        self._header = header
+        self.slots = int(header[_SLOTS_FIELD])
+        self.max_width = int(header[_WIDTH_FIELD])
+        self.max_height = int(header[_HEIGHT_FIELD])
+        self.jpeg_capacity = int(header[_JPEG_FIELD])
+        self.generation = int(header[_GENERATION_FIELD])
+
+        offset = _HEADER_FIELDS * 8
+        meta_dtype = _meta_dtype()
+        self._meta = np.ndarray((self.slots,), dtype=meta_dtype, buffer=self._shm.buf, offset=offset)
+        offset += self.slots * meta_dtype.itemsize
+        self._pixels = np.ndarray(
+            (self.slots, self.max_height, self.max_width, 3), dtype=np.uint8, buffer=self._shm.buf, offset=offset
+        )
+        offset += self._pixels.nbytes
+        self._jpeg = np.ndarray((self.slots, self.jpeg_capacity), dtype=np.uint8, buffer=self._shm.buf, offset=offset)
+
+        # Брой текущи четения и заявено затваряне
+        self._users = 0
+        self._closing = False
+        self._users_lock = threading.Lock()
+
+    @staticmethod
+    def _layout_size(slots: int, max_width: int, max_height: int, jpeg_capacity: int) -> int:
+        return (
+            _HEADER_FIELDS * 8
+            + slots * _meta_dtype().itemsize
+            + slots * max_height * max_width * 3
+            + slots * jpeg_capacity
+        )
+
+    def _enter(self) -> bool:
+        """Започва четене; False, ако буферът вече е затворен в този процес"""
+        with self._users_lock:
+            if self._closing:
+                return False
+            self._users += 1
+            return True
+
+    def _leave(self):
+        """Завършва четене и освобождава буфера, ако междувременно е затворен"""
+        with self._users_lock:
+            self._users -= 1
+            release = self._closing and self._users == 0
+        if release:
+            self._release()
+
+    @property
+    def closed(self) -> bool:
+        """Буферът е затворен в този процес или записващият го е затворил (например при смяна на размерите)"""
+        if not self._enter():
+            return True
+        try:
+            return bool(self._header[_CLOSED_FIELD])
+        finally:
+            self._leave()
+
+    @property
+    def writer_pid(self) -> int:
+        """PID на записващия процес (0 след затваряне)"""
+        if not self._enter():
+            return 0
+        try:
+            return int(self._header[_OWNER_FIELD])
+        finally:
+            self._leave()
+
+    @property
+    def identity(self) -> Tuple[str, int]:
+        """Име и поколение - различни за всяко създаване на сегмента"""
+        return self.name, self.generation
+
+    def writer_alive(self) -> bool:
+        """Проверява дали процесът, който записва в буфера, още работи"""
+        if self.owner:
+            return True
+        pid = self.writer_pid
+        if pid <= 0:
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # Процесът съществува, но е на друг потребител
+            return True
+        return True
+
+    def fits(self, width: int, height: int) -> bool:
+        """Проверява дали кадър с тези размери се побира в слот"""
+        return width <= self.max_width and height <= self.max_height
+
+    def latest_seq(self) -> int:
+        """Пореден номер на последния записан кадър (0 - няма или буферът е затворен)"""
+        if not self._enter():
+            return 0
+        try:
+            return self._latest_seq()
+        finally:
+            self._leave()
+
+    def _latest_seq(self) -> int:
+        return int(self._header[_SEQ_FIELD])
+
+    def write(self, pixels: Optional["np.ndarray"], jpeg_data: bytes, timestamp: float) -> int:
+        """Записва кадър в следващия слот и връща поредния му номер"""
+        seq = self._latest_seq() + 1
+        slot = seq % self.slots
+        meta = self._meta[slot]
+
+        # Слотът е невалиден, докато се записва
+        meta["seq"] = 0
+
+        width = height = 0
+        if pixels is not None and self.fits(pixels.shape[1], pixels.shape[0]):
+            height, width = pixels.shape[:2]
+            self._pixels[slot, :height, :width] = pixels
+
+        jpeg_len = len(jpeg_data)
+        if jpeg_len > self.jpeg_capacity:
+            logger.warning(f"[{self.name}] JPEG кадърът ({jpeg_len} bytes) не се побира в слота")
+            jpeg_len = 0
+        else:
+            self._jpeg[slot, :jpeg_len] = memoryview(jpeg_data)
+
+        meta["timestamp"] = timestamp
+        meta["width"] = width
+        meta["height"] = height
+        meta["jpeg_len"] = jpeg_len
+        meta["seq"] = seq
+        self._header[_SEQ_FIELD] = seq
+        return seq
+
+    def view(self, seq: Optional[int] = None) -> Optional[SharedFrame]:
+        """
+        Връща изгледи към кадъра без копиране (по подразбиране последния)
+
+        Изгледите сочат в споделената памет - след използването им valid()
+        показва дали слотът не е бил презаписан междувременно. Връща None и
+        след затваряне на буфера.
+        """
+        if not self._enter():
+            return None
+        try:
+            return self._view(seq)
+        finally:
+            self._leave()
+
+    def _view(self, seq: Optional[int]) -> Optional[SharedFrame]:
+        latest = self._latest_seq()
+        seq = latest if seq is None else seq
+        if seq <= 0 or seq <= latest - self.slots:
+            return None
+
+        slot = seq % self.slots
+        meta = self._meta[slot]
+        if int(meta["seq"]) != seq:
+            return None
+
+        width, height, jpeg_len = int(meta["width"]), int(meta["height"]), int(meta["jpeg_len"])
+        frame = SharedFrame(
+            seq=seq,
+            timestamp=float(meta["timestamp"]),
+            pixels=self._pixels[slot, :height, :width] if width and height else None,
+            jpeg=self._jpeg[slot, :jpeg_len].data
+        )
+        return frame if self._valid(frame) else None
+
+    def valid(self, frame: SharedFrame) -> bool:
+        """Проверява дали слотът на кадъра все още съдържа същия кадър"""
+        if not self._enter():
+            return False
+        try:
+            return self._valid(frame)
+        finally:
+            self._leave()
+
+    def _valid(self, frame: SharedFrame) -> bool:
+        return int(self._meta[frame.seq % self.slots]["seq"]) == frame.seq
+
+    def read_jpeg(self, seq: Optional[int] = None) -> Optional[Tuple[int, float, bytes]]:
+        """Копира JPEG байтовете на кадъра; връща (пореден номер, време, байтове) или None"""
+        if not self._enter():
+            return None
+        try:
+            for _ in range(3):
+                frame = self._view(seq)
+                if frame is None or not len(frame.jpeg):
+                    return None
+                data = bytes(frame.jpeg)
+                if self._valid(frame):
+                    return frame.seq, frame.timestamp, data
+            return None
+        finally:
+            self._leave()
+
+    def wait_for(self, after_seq: int, timeout: float = 1.0, poll: float = 0.02) -> Optional[int]:
+        """Изчаква кадър, по-нов от after_seq; връща последния пореден номер или None при затворен буфер"""
+        if not self._enter():
+            return None
+        try:
+            deadline = time.monotonic() + timeout
+            seq = self._latest_seq()
+            while seq <= after_seq and time.monotonic() < deadline:
+                if self._closing or self._header[_CLOSED_FIELD]:
+                    return None
+                time.sleep(poll)
+                seq = self._latest_seq()
+            return seq
+        finally:
+            self._leave()
+
+    def close(self):
+        """
+        Затваря сегмента; записващият го и изтрива
+
+        Ако друг thread още чете, сегментът се освобождава след края на четенето.
+        """
+        with self._users_lock:
+            if self._closing:
+                return
+            self._closing = True
+            if self.owner:
+                self._header[_CLOSED_FIELD] = 1
+            release = self._users == 0
+        if release:
+            self._release()
+
+    def _release(self):
+        """Освобождава изгледите и сегмента (без активни четения)"""
+        self._header = self._meta = self._pixels = self._jpeg = None
+        try:
+            self._shm.close()
+        except BufferError:
+            # Някой още държи изглед към кадър - паметта се освобождава при изхода на процеса
+            logger.warning(f"[{self.name}] Сегментът е затворен с активни изгледи")
+        if self.owner:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Описание на буфера"""
+        if not self._enter():
+            return {"name": self.name, "owner": self.owner, "generation": self.generation, "closed": True}
+        try:
+            return self._snapshot()
+        finally:
+            self._leave()
+
+    def _snapshot(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "owner": self.owner,
+            "writer_pid": self.writer_pid,
+            "generation": self.generation,
+            "slots": self.slots,
+            "max_width": self.max_width,
+            "max_height": self.max_height,
+            "jpeg_capacity": self.jpeg_capacity,
+            "latest_seq": self._latest_seq(),
+            "size_bytes": self._shm.size
+        }
+
+def shared_frames_enabled() -> bool:
+    """Споделената памет се използва само при SHARED_FRAMES=1"""
+    return os.getenv("SHARED_FRAMES", "0") in ("1", "true", "True")
+
+def segment_name(camera_id: str) -> str:
+    """Име на сегмента за камерата"""
+    prefix = os.getenv("SHARED_FRAMES_NAME", "obzor_frames")
+    return f"{prefix}_{re.sub(r'[^A-Za-z0-9_]', '_', camera_id)}"
+
+# Отворените буфери в този процес по камера
+_rings: Dict[str, SharedFrameRing] = {}
+_rings_lock = threading.Lock()
+
+def _usable(ring: SharedFrameRing) -> bool:
+    return not ring.closed and ring.writer_alive()
+
+def open_ring(camera_id: str) -> Optional[SharedFrameRing]:
+    """Отваря буфера на камерата за четене; None, ако няма записващ процес"""
+    if not shared_frames_enabled():
+        return None
+
+    ring = _rings.get(camera_id)
+    if ring is not None and _usable(ring):
+        return ring
+
+    with _rings_lock:
+        ring = _rings.get(camera_id)
+        if ring is not None:
+            if _usable(ring):
+                return ring
+            # Записващият е пресъздал сегмента или процесът му е спрял - отваряме наново
+            _rings.pop(camera_id, None)
+            ring.close()
+        try:
+            ring = SharedFrameRing(segment_name(camera_id))
+        except (FileNotFoundError, ValueError):
+            return None
+        if not _usable(ring):
+            # Сегмент, останал от спрял процес - последният му кадър не е актуален
+            ring.close()
+            return None
+        _rings[camera_id] = ring
+        return ring
+
+def publish_shared_frame(camera_id: str, pixels: "np.ndarray", jpeg_data: bytes, timestamp: float) -> Optional[int]:
+    """
+    Записва кадъра в буфера на камерата, като го създава (или пресъздава при
+    по-голям кадър) при нужда. Връща поредния номер или None, ако е изключено.
+    """
+    if not shared_frames_enabled():
+        return None
+
+    height, width = pixels.shape[:2]
+    with _rings_lock:
+        ring = _rings.get(camera_id)
+        if ring is not None and (not ring.owner or not ring.fits(width, height)):
+            _rings.pop(camera_id, None)
+            ring.close()
+            ring = None
+
+        if ring is None:
+            name = segment_name(camera_id)
+            try:
+                # Остатък от предишно стартиране
+                stale = shared_memory.SharedMemory(name=name)
+                stale.close()
+                stale.unlink()
+            except FileNotFoundError:
+                pass
+
+            ring = SharedFrameRing(
+                name,
+                slots=int(os.getenv("SHARED_FRAMES_SLOTS", "4")),
+                max_width=max(width, int(os.getenv("SHARED_FRAMES_MAX_WIDTH", "0"))),
+                max_height=max(height, int(os.getenv("SHARED_FRAMES_MAX_HEIGHT", "0"))),
+                create=True
+            )
+            _rings[camera_id] = ring
+            logger.info(f"[{camera_id}] Споделен буфер с кадри: {name} ({ring.snapshot()['size_bytes']} bytes)")
+
+        return ring.write(pixels, jpeg_data, timestamp)
+
+def close_rings():
+    """Затваря всички буфери на процеса (собствените се и изтриват)"""
+    with _rings_lock:
+        for ring in _rings.values():
+            ring.close()
+        _rings.clear()
+
+def rings_snapshot() -> Dict[str, Any]:
+    """Описание на отворените буфери"""
+    with _rings_lock:
+        return {camera_id: ring.snapshot() for camera_id, ring in _rings.items()}
@@ -0,0 +1,399 @@
+"""
+Споделено състояние и избор на лидер между процесите на приложението
+
+При uvicorn --workers N всеки процес има собствени копия на конфигурациите.
+За да не извличат всички процеси кадри и да не връщат различно състояние:
+- StateBackend пази текущото състояние (статус, последен кадър, последен
+  анализ) под ключове; MemoryStateBackend е за един процес, а
+  SQLiteStateBackend - общ файл за всички процеси на машината;
+- LeaderElection държи lease в backend-а: точно един процес (лидерът)
+  извлича кадри и анализира, а всички процеси обслужват заявките за четене;
+- StateRefresher във фонова нишка на последователите взима състоянието от
+  backend-а, така че заявките четат само копието в паметта.
+
+Backend-ът се избира със STATE_BACKEND=memory|sqlite (по подразбиране memory).
+"""
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, List, Optional
+
+from utils.logger import setup_logger
+
+# Инициализиране на логър
+logger = setup_logger("state")
+
+class StateBackend(ABC):
+    """Общ интерфейс на хранилищата за състояние"""
+
+    # Дали състоянието се вижда от други процеси
+    shared = False
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Стойността под ключа или None"""
+
+    @abstractmethod
+    def set(self, key: str, value: Dict[str, Any]):
+        """Записва стойността под ключа"""
+
+    @abstractmethod
+    def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        """Взима или подновява lease; връща True, ако holder го държи"""
+
+    @abstractmethod
+    def release_lease(self, name: str, holder: str):
+        """Освобождава lease, ако holder го държи"""
+
+    @abstractmethod
+    def lease_holder(self, name: str) -> Optional[str]:
+        """Текущият притежател на lease или None"""
+
+class MemoryStateBackend(StateBackend):
+    """Състояние в паметта на процеса (един worker)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values: Dict[str, Dict[str, Any]] = {}
+        self._leases: Dict[str, tuple] = {}
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self._values.get(key)
+
+    def set(self, key: str, value: Dict[str, Any]):
+        with self._lock:
+            self._values[key] = value
+
+    def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            current = self._leases.get(name)
+            if current is None or current[0] == holder or current[1] < now:
+                self._leases[name] = (holder, now + ttl)
+                return True
+            return False
+
+    def release_lease(self, name: str, holder: str):
+        with self._lock:
+            current = self._leases.get(name)
+            if current is not None and current[0] == holder:
+                del self._leases[name]
+
+    def lease_holder(self, name: str) -> Optional[str]:
+        current = self._leases.get(name)
+        return current[0] if current is not None and current[1] >= time.time() else None
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+"""
+
+class SQLiteStateBackend(StateBackend):
+    """Състояние в SQLite файл, общо за всички процеси на машината"""
+
+    shared = True
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value: Dict[str, Any]):
+        data = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO state (key, value, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated = excluded.updated",
+                (key, data, time.time())
+            )
+
+    def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            # IMMEDIATE - проверката и записът са атомарни спрямо другите процеси
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT holder, expires FROM leases WHERE name = ?", (name,)).fetchone()
+                acquired = row is None or row[0] == holder or row[1] < now
+                if acquired:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO leases (name, holder, expires) VALUES (?, ?, ?)",
+                        (name, holder, now + ttl)
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return acquired
+
+    def release_lease(self, name: str, holder: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+    def lease_holder(self, name: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT holder FROM leases WHERE name = ? AND expires >= ?", (name, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+class LeaderElection:
+    """
+    Избор на лидер чрез lease с ограничена валидност
+
+    Лидерът подновява lease на всеки ttl/3 секунди. Ако процесът спре или
+    блокира, lease изтича и друг процес го поема в рамките на ttl.
+    """
+
+    def __init__(self, backend: StateBackend, name: str = "leader", ttl: float = 15.0):
+        self.backend = backend
+        self.name = name
+        self.ttl = ttl
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+        self.is_leader = False
+        self._callbacks: List[Callable[[bool], None]] = []
+        self._thread: Optional[threading.Thread] = None
+        self._wakeup = threading.Event()
+        self._running = False
+
+    @property
+    def active(self) -> bool:
+        """Изборът е стартиран"""
+        return self._running
+
+    def on_change(self, callback: Callable[[bool], None]):
+        """Регистрира функция, която се извиква при спечелване (True) или загуба (False) на лидерството"""
+        self._callbacks.append(callback)
+
+    def start(self) -> bool:
+        """Прави първия опит веднага и стартира фоновото подновяване"""
+        if self._thread is not None and self._thread.is_alive():
+            return False
+
+        self._running = True
+        self._tick()
+        self._thread = threading.Thread(target=self._loop, name="leader-election")
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def stop(self):
+        """Спира подновяването и освобождава lease, за да го поеме друг процес веднага"""
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        self._thread = None
+
+        if self.is_leader:
+            try:
+                self.backend.release_lease(self.name, self.holder)
+            except Exception as e:
+                logger.error(f"Грешка при освобождаване на lease: {str(e)}")
+            self.is_leader = False
+
+    def _loop(self):
+        while self._running:
+            self._wakeup.wait(self.ttl / 3)
+            self._wakeup.clear()
+            if self._running:
+                self._tick()
+
+    def _tick(self):
+        """Един опит за взимане/подновяване на lease"""
+        try:
+            leader = self.backend.acquire_lease(self.name, self.holder, self.ttl)
+        except Exception as e:
+            # Без връзка с backend-а не можем да сме сигурни, че сме единственият лидер
+            logger.error(f"Грешка при подновяване на lease: {str(e)}")
+            leader = False
+
+        if leader == self.is_leader:
+            return
+
+        self.is_leader = leader
+        logger.info(f"Процес {self.holder}: {'лидер' if leader else 'последовател'}")
+        for callback in self._callbacks:
+            try:
+                callback(leader)
+            except Exception as e:
+                logger.error(f"Грешка при смяна на лидерството: {str(e)}")
+
+    def get_status(self) -> Dict[str, Any]:
+        """Връща състоянието на избора"""
+        return {
+            "holder": self.holder,
+            "is_leader": self.is_leader,
+            "leader": self.backend.lease_holder(self.name),
+            "ttl": self.ttl,
+            "backend": type(self.backend).__name__
+        }
+
+class StateRefresher:
+    """
+    Фоново обновяване на състоянието в процесите-последователи
+
+    Модулите регистрират функции с on_refresh; нишката ги извиква на всеки
+    interval секунди, докато процесът не е лидер и backend-ът е споделен.
+    Така четенето от базата (състояние, нови записи в историята) не е по
+    пътя на заявките, а get_*_config() връщат само копието в паметта.
+    """
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self._callbacks: List[Callable[[], None]] = []
+        self._thread: Optional[threading.Thread] = None
+        self._wakeup = threading.Event()
+        self._running = False
+
+    def on_refresh(self, callback: Callable[[], None]):
+        """Регистрира функция за обновяване на състоянието"""
+        if callback not in self._callbacks:
+            self._callbacks.append(callback)
+
+    def start(self) -> bool:
+        """Стартира фоновата нишка"""
+        if self._thread is not None and self._thread.is_alive():
+            return False
+
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name="state-refresher")
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def stop(self):
+        """Спира фоновата нишка"""
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        self._thread = None
+
+    def _loop(self):
+        while self._running:
+            self.refresh()
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def refresh(self):
+        """Едно обновяване; в лидера и без споделен backend не прави нищо"""
+        if is_leader() or not get_state_backend().shared:
+            return
+        for callback in list(self._callbacks):
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Грешка при обновяване на състоянието: {str(e)}")
+
+def get_state_db_path() -> str:
+    """Път до базата със споделеното състояние (в Docker средата - под /app)"""
+    base_dir = "/app/data" if os.path.exists("/app") else "data"
+    return os.getenv("STATE_DB", os.path.join(base_dir, "state.db"))
+
+# Глобални обекти на процеса (създават се при първо използване)
+_backend: Optional[StateBackend] = None
+_election: Optional[LeaderElection] = None
+_refresher: Optional[StateRefresher] = None
+_init_lock = threading.Lock()
+
+def get_state_backend() -> StateBackend:
+    """Връща backend-а, избран със STATE_BACKEND"""
+    global _backend
+
+    if _backend is not None:
+        return _backend
+
+    with _init_lock:
+        if _backend is None:
+            if os.getenv("STATE_BACKEND", "memory") == "sqlite":
+                _backend = SQLiteStateBackend(get_state_db_path())
+                logger.info(f"Споделено състояние: {_backend.db_path}")
+            else:
+                _backend = MemoryStateBackend()
+        return _backend
+
+def get_leader_election() -> LeaderElection:
+    """Връща избора на лидер за процеса"""
+    global _election
+
+    if _election is not None:
+        return _election
+
+    backend = get_state_backend()
+    with _init_lock:
+        if _election is None:
+            _election = LeaderElection(backend, ttl=float(os.getenv("LEADER_LEASE_TTL", "15")))
+        return _election
+
+def get_state_refresher() -> StateRefresher:
+    """Връща фоновото обновяване на състоянието за процеса"""
+    global _refresher
+
+    if _refresher is not None:
+        return _refresher
+
+    with _init_lock:
+        if _refresher is None:
+            _refresher = StateRefresher(interval=float(os.getenv("STATE_REFRESH_INTERVAL", "1")))
+        return _refresher
+
+def on_refresh(callback: Callable[[], None]):
+    """Регистрира функция, която последователите извикват периодично във фонова нишка"""
+    get_state_refresher().on_refresh(callback)
+
+def is_leader() -> bool:
+    """Дали процесът извлича и анализира (без стартиран избор - винаги)"""
+    return _election is None or not _election.active or _election.is_leader
+
+def publish_state(key: str, value: Dict[str, Any]):
+    """Записва състоянието за останалите процеси (само лидерът и само при споделен backend)"""
+    backend = get_state_backend()
+    if not backend.shared or not is_leader():
+        return
+    try:
+        backend.set(key, value)
+    except Exception as e:
+        logger.error(f"Грешка при запис на състоянието {key}: {str(e)}")
+
+def read_state(key: str) -> Optional[Dict[str, Any]]:
+    """
+    Чете състоянието, записано от лидера (за последователите при споделен backend)
+
+    Чете базата синхронно - извиква се от StateRefresher, а не от заявките.
+    Връща None в лидера, без споделен backend и при грешка.
+    """
+    if is_leader():
+        return None
+    backend = get_state_backend()
+    if not backend.shared:
+        return None
+
+    try:
+        return backend.get(key)
+    except Exception as e:
+        logger.error(f"Грешка при четене на състоянието {key}: {str(e)}")
+        return None